@@ -0,0 +1,96 @@
+import time
+import json
+import logging
+import asyncio
+import tempfile
+import statistics
+
+from ai_streamer_twitch.service import Service
+from ai_streamer_twitch.config import ServerConfig, APIConfig
+from ai_streamer_twitch.synthetic import SyntheticAPI, fake_chat_message
+from fastsocket import Message
+
+CONFIG = """
+[ws]
+port = 8000
+host = "127.0.0.1"
+
+[twitch]
+secret = ""
+id = ""
+update_delay = 1
+delivery = "push"
+max_latency = 0.005
+max_batch = 100
+
+[clients]
+queue_size = 16
+overflow = "{overflow}"
+
+[buffers]
+chat = 10000
+sub = 1000
+cheer = 1000
+"""
+
+class FakeWS():
+    def __init__(self) -> None:
+        self.stalled = False
+        self.latencies = []
+
+    async def send(self, frame: str):
+        if self.stalled:
+            # A consumer that stopped reading, the send never completes
+            await asyncio.sleep(3600)
+        # Latency of the oldest event in the frame, event timestamps are time.time()
+        chat = json.loads(frame)["data"].get("chat")
+        if chat:
+            self.latencies.append(time.time() - chat[0]["timestamp"])
+
+    async def close(self):
+        pass
+
+async def run(n_clients: int, stalled: bool, overflow: str, n_messages: int = 2000, rate: float = 2000) -> list[float]:
+    with tempfile.NamedTemporaryFile("w", suffix=".toml", delete=False) as f:
+        f.write(CONFIG.format(overflow=overflow))
+    service = Service(ServerConfig(f.name), log_level=logging.WARNING)
+    await service.start()
+
+    # Synthetic, the supervisor started with the service would restart an API that never connected
+    api = SyntheticAPI(APIConfig("token", 1, "bench", service._config), log_level=logging.WARNING)
+    await api.start()
+    key = service.add_api(api)
+
+    clients = [FakeWS() for _ in range(n_clients + 1)]
+    for ws in clients:
+        service.attach(key, ws)
+        await service.subscribe(Message(uuid=1, code="Subscribe", data={"user_name": key}), ws)
+    clients[-1].stalled = stalled
+
+    for i in range(n_messages):
+        api.handle_chat_message(fake_chat_message(i))
+        await asyncio.sleep(1 / rate)
+    await asyncio.sleep(0.1)
+
+    latencies = []
+    for ws in clients:
+        if not ws.stalled:
+            latencies.extend(ws.latencies)
+
+    for client in list(service._clients.values()):
+        await client.close()
+    for dispatcher in service._dispatchers.values():
+        await dispatcher.stop()
+    return latencies
+
+async def main():
+    print(f"{'overflow':>12} {'stalled':>8} {'frames':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for overflow in ("drop_oldest", "coalesce", "disconnect"):
+        for stalled in (False, True):
+            latencies = sorted(await run(10, stalled, overflow))
+            p50 = statistics.median(latencies) * 1000
+            p99 = latencies[int(len(latencies) * 0.99)] * 1000
+            print(f"{overflow:>12} {str(stalled):>8} {len(latencies):>8} {p50:>8.2f} {p99:>8.2f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
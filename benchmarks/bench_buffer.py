@@ -0,0 +1,55 @@
+import time
+
+from ai_streamer_twitch.utils import CircularBuffer
+
+class ListBuffer():
+    # The old list backed implementation, kept here as the baseline
+    def __init__(self, max_elems: int) -> None:
+        self._array = []
+        self._max_elems = max_elems
+
+    def append(self, elem):
+        if len(self._array) == self._max_elems:
+            self._array.pop(0)
+        self._array.append(elem)
+
+    def get_all(self, clear=False):
+        out_arr = self._array
+        if clear:
+            self._array = []
+        return out_arr
+
+def bench_append(buffer_cls, capacity: int, n: int) -> float:
+    buffer = buffer_cls(capacity)
+    # Fill it first so every measured append has to evict
+    for i in range(capacity):
+        buffer.append(i)
+
+    start = time.perf_counter()
+    for i in range(n):
+        buffer.append(i)
+    return (time.perf_counter() - start) / n
+
+def bench_read(capacity: int, n: int) -> float:
+    buffer = CircularBuffer(capacity)
+    for i in range(capacity):
+        buffer.append(i)
+
+    seq = buffer.first_seq
+    start = time.perf_counter()
+    for i in range(n):
+        buffer.append(i)
+        _, seq = buffer.get_since(seq)
+    return (time.perf_counter() - start) / n
+
+def main():
+    n = 100_000
+    print(f"{'capacity':>10} {'list ns/append':>16} {'ring ns/append':>16} {'ring ns/append+read':>20}")
+    for capacity in (1_000, 10_000, 100_000):
+        list_t = bench_append(ListBuffer, capacity, n)
+        ring_t = bench_append(CircularBuffer, capacity, n)
+        read_t = bench_read(capacity, n)
+        print(f"{capacity:>10} {list_t * 1e9:>16.1f} {ring_t * 1e9:>16.1f} {read_t * 1e9:>20.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import time
+import random
+import asyncio
+import logging
+import argparse
+
+from ai_streamer_twitch.channels import ChannelSync
+
+# JOINs sent and time until every channel is joined when a large watch list changes,
+# with the join limit scaled down to --period seconds. "full" joins the whole list on
+# every change like before, "diff" only joins and parts what changed.
+
+class FakeIRC():
+    # Confirms every JOIN after latency seconds, like Twitch does
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.joins = 0
+        self.parts = 0
+        self.sync = None
+
+    async def join(self, channels: list[str]):
+        self.joins += len(channels)
+        loop = asyncio.get_running_loop()
+        for channel in channels:
+            loop.call_later(self.latency, self.sync.joined, channel)
+
+    async def part(self, channels: list[str]):
+        self.parts += len(channels)
+
+async def converge(sync: ChannelSync, timeout: float = 600) -> float:
+    start = time.perf_counter()
+    while len(sync.joined_channels()) < len(sync.desired):
+        if time.perf_counter() - start > timeout:
+            break
+        await asyncio.sleep(0.005)
+    return time.perf_counter() - start
+
+async def run(mode: str, channels: int, changes: int, churn: int, rate: int, period: float, latency: float):
+    rng = random.Random(0)
+    irc = FakeIRC(latency)
+    sync = ChannelSync(irc.join, irc.part, rate=rate, period=period, log_level=logging.WARNING)
+    irc.sync = sync
+
+    watch = [f"channel_{i}" for i in range(channels)]
+    await sync.set_desired(watch)
+    await converge(sync)
+    irc.joins = irc.parts = 0
+
+    next_id = channels
+    elapsed = 0.0
+    for _ in range(changes):
+        # churn channels leave the list and as many new ones come in
+        for i in rng.sample(range(channels), churn):
+            watch[i] = f"channel_{next_id}"
+            next_id += 1
+        if mode == "full":
+            # What a plain join_channels(list) did, every channel is joined again
+            await sync.set_desired([])
+        await sync.set_desired(watch)
+        elapsed += await converge(sync)
+
+    await sync.close()
+    return irc.joins / changes, irc.parts / changes, elapsed / changes
+
+async def main(args):
+    print(f"{args.channels} channels, {args.churn} replaced per change, {args.rate} JOINs per {args.period}s")
+    print(f"{'mode':>6} {'joins':>7} {'parts':>7} {'converge s':>11}")
+    for mode in ("full", "diff"):
+        joins, parts, seconds = await run(mode, args.channels, args.changes, args.churn, args.rate, args.period, args.latency)
+        print(f"{mode:>6} {joins:>7.0f} {parts:>7.0f} {seconds:>11.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--channels", type=int, default=200)
+    parser.add_argument("--changes", type=int, default=3)
+    parser.add_argument("--churn", type=int, default=10, help="Channels replaced per change")
+    parser.add_argument("--rate", type=int, default=20, help="JOINs per period")
+    parser.add_argument("--period", type=float, default=0.5, help="Seconds, Twitch uses 10")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds until a JOIN is confirmed")
+    args = parser.parse_args()
+    asyncio.run(main(args))
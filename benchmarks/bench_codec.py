@@ -0,0 +1,33 @@
+import time
+import json
+
+from ai_streamer_twitch.models import ChatMessage
+from ai_streamer_twitch.codec import ENCODINGS, encode_events, decode_events
+
+def make_batch(n: int) -> list[ChatMessage]:
+    return [ChatMessage(f"user_{i % 500}", 100000 + i % 500, f"message number {i} PogChamp") for i in range(n)]
+
+def bench(events: list, encoding: str, repeat: int) -> tuple[float, float, int]:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        frame = json.dumps({"chat": encode_events(events, encoding)})
+    encode_t = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        decode_events(json.loads(frame)["chat"])
+    decode_t = (time.perf_counter() - start) / repeat
+
+    return encode_t, decode_t, len(frame.encode())
+
+def main():
+    print(f"{'batch':>7} {'encoding':>10} {'encode us':>11} {'decode us':>11} {'frame bytes':>12}")
+    for n in (10, 1_000, 10_000):
+        events = make_batch(n)
+        repeat = max(1, 100_000 // n)
+        for encoding in ENCODINGS:
+            encode_t, decode_t, size = bench(events, encoding, repeat)
+            print(f"{n:>7} {encoding:>10} {encode_t * 1e6:>11.1f} {decode_t * 1e6:>11.1f} {size:>12}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import os
+import time
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import statistics
+
+from ai_streamer_twitch import Service, ServerConfig, TwitchClient
+from ai_streamer_twitch.config import APIConfig
+from ai_streamer_twitch.codec import decode_events
+from ai_streamer_twitch.synthetic import SyntheticAPI, LoadGenerator, PROFILES
+
+CONFIG = """
+[ws]
+port = {port}
+host = "127.0.0.1"
+
+[twitch]
+secret = ""
+id = ""
+update_delay = 1
+delivery = "{delivery}"
+max_latency = 0.02
+max_batch = 500
+
+[clients]
+queue_size = 256
+overflow = "coalesce"
+
+[buffers]
+chat = 100000
+sub = 10000
+cheer = 10000
+"""
+
+class LatencyClient(TwitchClient):
+    # Records ingest to client latency from the event timestamps
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+        self.received = 0
+
+    async def handle_new_messages(self, msg):
+        now = time.time()
+        await super().handle_new_messages(msg)
+        for key in ("chat", "cheers", "subs"):
+            for event in decode_events(msg.data.get(key, [])):
+                self.latencies.append(now - event["timestamp"])
+                self.received += 1
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def rss_mb() -> float:
+    with open(f"/proc/{os.getpid()}/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+
+async def run(profile_name: str, duration: float, n_clients: int, delivery: str, encoding: str, port: int):
+    with tempfile.NamedTemporaryFile("w", suffix=".toml", delete=False) as f:
+        f.write(CONFIG.format(port=port, delivery=delivery))
+
+    service = Service(ServerConfig(f.name), log_level=logging.WARNING)
+    await service.start()
+
+    api = SyntheticAPI(APIConfig("token", 1, "synthetic", service._config), log_level=logging.WARNING)
+    await api.start()
+    service.add_api(api)
+
+    clients = [LatencyClient(f"ws://127.0.0.1:{port}", log_level=logging.WARNING, encoding=encoding) for _ in range(n_clients)]
+    for client in clients:
+        await client.connect("synthetic", "token", ["synthetic"])
+
+    generator = LoadGenerator(api, PROFILES[profile_name]())
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    await generator.run(duration)
+    # Give the last batches time to arrive
+    await asyncio.sleep(0.5)
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    latencies = [latency for client in clients for latency in client.latencies]
+    sent = generator.chat_sent + generator.subs_sent + generator.cheers_sent
+    received = sum(client.received for client in clients)
+
+    print(f"profile={profile_name} delivery={delivery} encoding={encoding} clients={n_clients}")
+    print(f"  sent {sent} events ({sent / duration:.0f}/s), delivered {received} ({received / wall:.0f}/s over all clients)")
+    print(f"  latency p50 {percentile(latencies, 0.5) * 1000:.2f} ms, p99 {percentile(latencies, 0.99) * 1000:.2f} ms")
+    print(f"  cpu {cpu / wall * 100:.0f}%, rss {rss_mb():.1f} MB, max rss {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1000:.1f} MB")
+
+    for client in clients:
+        await client.ws.disconnect()
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end latency benchmark over loopback with a synthetic Twitch API")
+    parser.add_argument("--profile", choices=sorted(PROFILES.keys()), default="steady")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--delivery", choices=["interval", "push"], default="push")
+    parser.add_argument("--encoding", choices=["json", "columnar"], default="json")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    asyncio.run(run(args.profile, args.duration, args.clients, args.delivery, args.encoding, args.port))
+
+if __name__ == "__main__":
+    main()
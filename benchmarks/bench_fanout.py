@@ -0,0 +1,113 @@
+import time
+import json
+import logging
+import asyncio
+import tempfile
+
+from ai_streamer_twitch.service import Service
+from ai_streamer_twitch.api import API, chat_buffer_key
+from ai_streamer_twitch.config import ServerConfig, APIConfig
+from ai_streamer_twitch.models import ChatMessage, serialize_events
+from ai_streamer_twitch.codec import encode_events_json, placeholder, splice_fragments
+from ai_streamer_twitch.synthetic import fake_chat_message
+from fastsocket import Message
+
+# Broadcast cost per subscriber with 1, 10 and 100 subscribers. "shared" clients are all
+# caught up and get the same frame, "staggered" clients are moved back to a different
+# cursor every round, like clients resuming, so every one needs its own frame. That is
+# where the per event fragments are reused.
+
+CONFIG = """
+[ws]
+port = 8000
+host = "127.0.0.1"
+
+[twitch]
+secret = ""
+id = ""
+update_delay = 1
+
+[clients]
+queue_size = 100000
+overflow = "drop_oldest"
+
+[buffers]
+chat = 100000
+sub = 1000
+cheer = 1000
+"""
+
+BATCH = 200
+ROUNDS = 20
+
+class FakeWS():
+    def __init__(self) -> None:
+        self.frames = {}
+
+    async def send(self, frame: str):
+        # Shared frames are the very same string object for every client
+        self.frames[id(frame)] = frame
+
+    async def close(self):
+        pass
+
+async def run(n_clients: int, staggered: bool) -> tuple[float, int]:
+    with tempfile.NamedTemporaryFile("w", suffix=".toml", delete=False) as f:
+        f.write(CONFIG)
+    service = Service(ServerConfig(f.name), log_level=logging.WARNING)
+
+    api = API(APIConfig("token", 1, "bench", service._config), log_level=logging.WARNING)
+    key = service.add_api(api)
+    for i in range(n_clients):
+        api.handle_chat_message(fake_chat_message(i))
+
+    clients = [FakeWS() for _ in range(n_clients)]
+    for ws in clients:
+        service.attach(key, ws)
+        await service.subscribe(Message(uuid=1, code="Subscribe", data={"user_name": key}), ws)
+        # Only count NewMessages frames
+        ws.frames.clear()
+
+    elapsed = 0.0
+    for r in range(ROUNDS):
+        for i in range(BATCH):
+            api.handle_chat_message(fake_chat_message(r * BATCH + i))
+        if staggered:
+            for i, ws in enumerate(clients):
+                service._clients[ws].cursors[key][chat_buffer_key("synthetic")] -= i
+        start = time.perf_counter()
+        await service.broadcast_new_messages(skip_empty=True)
+        elapsed += time.perf_counter() - start
+        await asyncio.sleep(0)
+
+    frames = len(set().union(*(ws.frames for ws in clients)))
+    for client in list(service._clients.values()):
+        await client.close()
+    return elapsed / ROUNDS / n_clients, frames
+
+def bench_batch_encoding():
+    # One batch as plain dicts in the frame versus spliced cached fragments
+    events = [ChatMessage(f"user_{i}", i, "some chat message here") for i in range(BATCH)]
+    n = 200
+    start = time.perf_counter()
+    for _ in range(n):
+        Message(uuid=1, code="NewMessages", data={"chat": serialize_events(events)}).to_json()
+    dicts = (time.perf_counter() - start) / n
+    start = time.perf_counter()
+    for _ in range(n):
+        frame = Message(uuid=1, code="NewMessages", data={"chat": placeholder("chat")}).to_json()
+        frame = splice_fragments(frame, {"chat": encode_events_json(events)})
+    fragments = (time.perf_counter() - start) / n
+    assert json.loads(frame)["data"]["chat"] == serialize_events(events)
+    print(f"{BATCH} event batch: dicts {dicts * 1e6:.0f} us, cached fragments {fragments * 1e6:.0f} us")
+
+async def main():
+    bench_batch_encoding()
+    print(f"{'clients':>8} {'cursors':>10} {'us/client':>10} {'frames':>8}")
+    for staggered in (False, True):
+        for n_clients in (1, 10, 100):
+            per_client, frames = await run(n_clients, staggered)
+            print(f"{n_clients:>8} {'staggered' if staggered else 'shared':>10} {per_client * 1e6:>10.1f} {frames:>8}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
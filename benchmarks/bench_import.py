@@ -0,0 +1,62 @@
+import sys
+import argparse
+import subprocess
+
+# Cold import time of the client and the server entry points, from python -X importtime.
+# Every import runs in a fresh interpreter. --max-ms makes this fail when an entry point
+# gets slower than the budget, and the client must not load any server dependency.
+
+TARGETS = {
+    "client": "from ai_streamer_twitch import TwitchClient",
+    "service": "from ai_streamer_twitch import Service",
+    "main": "import ai_streamer_twitch.__main__",
+}
+
+# Modules the client side must never import
+SERVER_ONLY = ("twitchio", "aiohttp", "toml", "ai_streamer_twitch.service", "ai_streamer_twitch.api")
+
+def import_times(statement: str) -> tuple[float, list[tuple[float, str]]]:
+    # Returns the total in ms and the cumulative time of every top level module
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], capture_output=True, text=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):
+            modules.append((int(cumulative) / 1000, name.strip()))
+    return sum(ms for ms, _ in modules), modules
+
+def loaded_modules(statement: str) -> set[str]:
+    code = f"import sys\n{statement}\nprint('\\n'.join(sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    return set(result.stdout.split())
+
+def main(runs: int, top: int, max_ms: float | None) -> int:
+    failed = False
+    for name, statement in TARGETS.items():
+        totals = []
+        for _ in range(runs):
+            total, modules = import_times(statement)
+            totals.append(total)
+        best = min(totals)
+        print(f"{name:>8}: {best:7.1f} ms (best of {runs})")
+        for ms, module in sorted(modules, reverse=True)[:top]:
+            print(f"{'':>10}{ms:7.1f} ms  {module}")
+        if max_ms is not None and best > max_ms:
+            print(f"{'':>10}over the {max_ms} ms budget")
+            failed = True
+
+    leaked = sorted(loaded_modules(TARGETS["client"]).intersection(SERVER_ONLY))
+    if leaked:
+        print(f"client imports server modules: {leaked}")
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5, help="Slowest top level imports to list per entry point")
+    parser.add_argument("--max-ms", type=float, default=None, help="Fail if an entry point takes longer")
+    args = parser.parse_args()
+    sys.exit(main(args.runs, args.top, args.max_ms))
@@ -0,0 +1,94 @@
+import time
+import json
+import asyncio
+import logging
+import tempfile
+import statistics
+
+from ai_streamer_twitch.service import Service
+from ai_streamer_twitch.config import ServerConfig, APIConfig
+from ai_streamer_twitch.synthetic import SyntheticAPI, LoadGenerator, LoadProfile
+from fastsocket import Message
+
+CONFIG = """
+[ws]
+port = 8000
+host = "127.0.0.1"
+
+[twitch]
+secret = ""
+id = ""
+update_delay = 1
+delivery = "push"
+max_latency = 0.05
+max_batch = 1000
+priority_max_latency = 0
+
+[clients]
+queue_size = 256
+overflow = "coalesce"
+
+[buffers]
+chat = 100000
+sub = 10000
+cheer = 10000
+"""
+
+class FakeWS():
+    # Records the delivery latency per event kind from the event timestamps
+    def __init__(self) -> None:
+        self.latencies = {"chat": [], "cheers": [], "subs": []}
+
+    async def send(self, frame: str):
+        now = time.time()
+        data = json.loads(frame)["data"]
+        for kind, latencies in self.latencies.items():
+            for event in data.get(kind) or []:
+                latencies.append(now - event["timestamp"])
+
+    async def close(self):
+        pass
+
+def p99(values: list[float]) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[int(len(values) * 0.99)] * 1000
+
+async def run(chat_rate: float, duration: float = 3) -> FakeWS:
+    with tempfile.NamedTemporaryFile("w", suffix=".toml", delete=False) as f:
+        f.write(CONFIG)
+    service = Service(ServerConfig(f.name), log_level=logging.WARNING)
+    await service.start()
+
+    api = SyntheticAPI(APIConfig("token", 1, "bench", service._config), log_level=logging.WARNING)
+    await api.start()
+    key = service.add_api(api)
+
+    ws = FakeWS()
+    service.attach(key, ws)
+    await service.subscribe(Message(uuid=1, code="Subscribe", data={"user_name": key}), ws)
+
+    # Keep about 20 subs and cheers per second whatever the chat rate is
+    per_1k = 20 / chat_rate * 1000
+    generator = LoadGenerator(api, LoadProfile("bench", chat_rate, subs_per_1k=per_1k, cheers_per_1k=per_1k))
+    await generator.run(duration)
+    await asyncio.sleep(0.2)
+
+    for client in list(service._clients.values()):
+        await client.close()
+    for dispatcher in service._dispatchers.values():
+        await dispatcher.stop()
+    return ws
+
+async def main():
+    print(f"{'chat/s':>8} {'chat p50 ms':>12} {'chat p99 ms':>12} {'sub/cheer p50 ms':>17} {'sub/cheer p99 ms':>17}")
+    for chat_rate in (100, 1000, 5000, 20000):
+        ws = await run(chat_rate)
+        chat = ws.latencies["chat"]
+        priority = ws.latencies["cheers"] + ws.latencies["subs"]
+        print(f"{chat_rate:>8} {statistics.median(chat) * 1000:>12.2f} {p99(chat):>12.2f} "
+              f"{statistics.median(priority) * 1000:>17.2f} {p99(priority):>17.2f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,51 @@
+import os
+import time
+import logging
+
+from ai_streamer_twitch.utils import setup_logging, setup_logger, TEXT_FORMAT
+from ai_streamer_twitch.models import ChatMessage
+
+N = 100_000
+
+def handle_old(logger: logging.Logger):
+    # What the event handlers used to do, the f-string builds the dict even with DEBUG off
+    for i in range(N):
+        cm = ChatMessage("user", i, "hello chat")
+        logger.debug(f"Got Chat Message: {cm.to_dict()}")
+
+def handle_new(logger: logging.Logger):
+    for i in range(N):
+        cm = ChatMessage("user", i, "hello chat")
+        logger.debug("Got Chat Message: %r", cm, extra={"sampled": True})
+
+def measure(handle, logger: logging.Logger) -> float:
+    start = time.perf_counter()
+    handle(logger)
+    return N / (time.perf_counter() - start)
+
+def main():
+    devnull = open(os.devnull, "w")
+
+    old_logger = logging.getLogger("bench old")
+    old_logger.propagate = False
+    handler = logging.StreamHandler(devnull)
+    handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    old_logger.addHandler(handler)
+
+    print(f"{'setup':>34} {'DEBUG off ev/s':>15} {'DEBUG on ev/s':>15}")
+    rates = []
+    for level in (logging.INFO, logging.DEBUG):
+        old_logger.setLevel(level)
+        rates.append(measure(handle_old, old_logger))
+    print(f"{'sync StreamHandler + f-string':>34} {rates[0]:>15.0f} {rates[1]:>15.0f}")
+
+    for sample_rate, name in ((1.0, "queue handler"), (0.01, "queue handler, 1% debug sample")):
+        setup_logging(sample_rate=sample_rate, stream=devnull)
+        rates = []
+        for level in (logging.INFO, logging.DEBUG):
+            logger, _ = setup_logger("bench new", level)
+            rates.append(measure(handle_new, logger))
+        print(f"{name:>34} {rates[0]:>15.0f} {rates[1]:>15.0f}")
+
+if __name__ == "__main__":
+    main()
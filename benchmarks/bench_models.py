@@ -0,0 +1,52 @@
+import time
+import uuid
+import json
+import tracemalloc
+
+from ai_streamer_twitch.models import ChatMessage, serialize_events
+
+class DictChatMessage():
+    # The old dict backed ChatMessage, kept here as the baseline
+    def __init__(self, user_name: str, user_id: int, content: str) -> None:
+        self.user_name = user_name
+        self.user_id = user_id
+        self.content = content
+        self.timestamp = time.time()
+        self.uuid = str(uuid.uuid4())
+
+    def to_dict(self) -> dict:
+        return {
+                "user_name": self.user_name,
+                "user_id": self.user_id,
+                "content": self.content,
+                "timestamp": self.timestamp,
+                "uuid": self.uuid,
+        }
+
+def bytes_per_event(cls, n: int) -> float:
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    events = [cls("some_user", 123456, "hello chat") for _ in range(n)]
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del events
+    return (after - before) / n
+
+def events_per_second(cls, n: int, serialize) -> float:
+    start = time.perf_counter()
+    events = [cls("some_user", 123456, "hello chat") for _ in range(n)]
+    json.dumps(serialize(events))
+    return n / (time.perf_counter() - start)
+
+def main():
+    n = 100_000
+    old_serialize = lambda events: [x.to_dict() for x in events]
+
+    print(f"{'model':>16} {'bytes/event':>12} {'events/s':>12}")
+    for name, cls, serialize in (("dict + uuid4", DictChatMessage, old_serialize), ("slots + counter", ChatMessage, serialize_events)):
+        size = bytes_per_event(cls, n)
+        rate = events_per_second(cls, n, serialize)
+        print(f"{name:>16} {size:>12.1f} {rate:>12.0f}")
+
+if __name__ == "__main__":
+    main()
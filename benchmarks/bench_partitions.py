@@ -0,0 +1,117 @@
+import json
+import random
+import logging
+import asyncio
+import argparse
+import tempfile
+
+from ai_streamer_twitch.service import Service
+from ai_streamer_twitch.api import API
+from ai_streamer_twitch.config import ServerConfig, APIConfig
+from ai_streamer_twitch.utils import CircularBuffer
+from ai_streamer_twitch.synthetic import fake_chat_message
+from fastsocket import Message
+
+# Chat partitioned per channel, with one busy channel and --channels - 1 quiet ones.
+#   isolation: how much of the quiet channels' chat is still buffered after a burst in the
+#              busy channel, for one buffer shared by all channels and one per channel.
+#   scoped:    bytes sent to a client subscribed to every channel and to one that only
+#              asked for a single quiet channel.
+
+CONFIG = """
+[ws]
+port = 8000
+host = "127.0.0.1"
+
+[twitch]
+secret = ""
+id = ""
+update_delay = 1
+
+[clients]
+queue_size = 100000
+
+[buffers]
+chat = {size}
+sub = 1000
+cheer = 1000
+"""
+
+class FakeWS():
+    def __init__(self) -> None:
+        self.bytes = 0
+        self.chat = 0
+
+    async def send(self, frame: str):
+        self.bytes += len(frame)
+        self.chat += len(json.loads(frame)["data"].get("chat") or [])
+
+    async def close(self):
+        pass
+
+def traffic(channels: int, messages: int, busy_share: float, rng: random.Random):
+    # The busy channel gets busy_share of the messages, the rest is spread over the quiet ones
+    for i in range(messages):
+        if rng.random() < busy_share:
+            yield i, "busy"
+        else:
+            yield i, f"quiet_{rng.randrange(channels - 1)}"
+
+def bench_isolation(channels: int, messages: int, busy_share: float, size: int):
+    rng = random.Random(0)
+    shared = CircularBuffer(size)
+    partitioned = {}
+    sent = 0
+    for i, channel in traffic(channels, messages, busy_share, rng):
+        shared.append(channel)
+        partitioned.setdefault(channel, CircularBuffer(size)).append(channel)
+        sent += channel != "busy"
+
+    kept_shared = sum(1 for channel in shared.get_all() if channel != "busy")
+    kept_partitioned = sum(len(buffer) for channel, buffer in partitioned.items() if channel != "busy")
+    print(f"{messages} messages, {busy_share:.0%} in the busy channel, {size} per buffer")
+    print(f"{'buffers':>12} {'quiet kept':>11}")
+    print(f"{'shared':>12} {kept_shared / sent:>11.1%}")
+    print(f"{'per channel':>12} {kept_partitioned / sent:>11.1%}")
+
+async def bench_scoped(channels: int, messages: int, busy_share: float, size: int):
+    with tempfile.NamedTemporaryFile("w", suffix=".toml", delete=False) as f:
+        f.write(CONFIG.format(size=size))
+    service = Service(ServerConfig(f.name), log_level=logging.WARNING)
+    api = API(APIConfig("token", 1, "bench", service._config), log_level=logging.WARNING)
+    key = service.add_api(api)
+
+    clients = {"all": FakeWS(), "one": FakeWS()}
+    for ws in clients.values():
+        service.attach(key, ws)
+    await service.subscribe(Message(uuid=1, code="Subscribe", data={"user_name": key}), clients["all"])
+    await service.subscribe(Message(uuid=1, code="Subscribe", data={"user_name": key, "channels": ["quiet_0"]}), clients["one"])
+
+    rng = random.Random(0)
+    for i, channel in traffic(channels, messages, busy_share, rng):
+        api.handle_chat_message(fake_chat_message(i, channel))
+        if i % 200 == 199:
+            await service.broadcast_new_messages(skip_empty=True)
+            await asyncio.sleep(0)
+    await service.broadcast_new_messages(skip_empty=True)
+    await asyncio.sleep(0.1)
+
+    print(f"{'subscribed':>12} {'messages':>9} {'kB':>9}")
+    for name, ws in clients.items():
+        print(f"{name:>12} {ws.chat:>9} {ws.bytes / 1000:>9.1f}")
+    for client in list(service._clients.values()):
+        await client.close()
+
+async def main(args):
+    bench_isolation(args.channels, args.messages, args.busy_share, args.size)
+    print()
+    await bench_scoped(args.channels, args.messages, args.busy_share, args.size)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--busy-share", type=float, default=0.9, help="Share of the messages in the busy channel")
+    parser.add_argument("--size", type=int, default=1000, help="Chat messages per buffer")
+    args = parser.parse_args()
+    asyncio.run(main(args))
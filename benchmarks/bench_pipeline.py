@@ -0,0 +1,77 @@
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+
+from ai_streamer_twitch import Service, ServerConfig, TwitchClient
+from ai_streamer_twitch.config import APIConfig
+from ai_streamer_twitch.constants import GET_STATS
+from ai_streamer_twitch.synthetic import SyntheticAPI
+
+# Request throughput of one TwitchClient over loopback: GetStats calls with 1 to 256 in
+# flight, and the same calls sent as Batch frames.
+
+CONFIG = """
+[ws]
+port = {port}
+host = "127.0.0.1"
+
+[twitch]
+secret = ""
+id = ""
+update_delay = 1
+
+[buffers]
+chat = 1000
+sub = 1000
+cheer = 1000
+"""
+
+async def pipelined(client: TwitchClient, concurrency: int, total: int) -> float:
+    remaining = total
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            await client.get_stats()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return total / (time.perf_counter() - start)
+
+async def batched(client: TwitchClient, size: int, total: int) -> float:
+    requests = [(GET_STATS, {"user_name": client.user_name})] * size
+    start = time.perf_counter()
+    for _ in range(total // size):
+        await client.batch(requests)
+    return total / (time.perf_counter() - start)
+
+async def main(port: int, total: int):
+    with tempfile.NamedTemporaryFile("w", suffix=".toml", delete=False) as f:
+        f.write(CONFIG.format(port=port))
+
+    service = Service(ServerConfig(f.name), log_level=logging.WARNING)
+    await service.start()
+    api = SyntheticAPI(APIConfig("token", 1, "synthetic", service._config), log_level=logging.WARNING)
+    await api.start()
+    service.add_api(api)
+
+    client = TwitchClient(f"ws://127.0.0.1:{port}", log_level=logging.WARNING, max_in_flight=256)
+    await client.connect("synthetic", "token", ["synthetic"])
+
+    print(f"{'mode':>10} {'n':>5} {'ops/s':>10}")
+    for concurrency in (1, 4, 16, 64, 256):
+        print(f"{'inflight':>10} {concurrency:>5} {await pipelined(client, concurrency, total):>10.0f}")
+    for size in (10, 100):
+        print(f"{'batch':>10} {size:>5} {await batched(client, size, total):>10.0f}")
+
+    await client.ws.disconnect()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+    asyncio.run(main(args.port, args.requests))
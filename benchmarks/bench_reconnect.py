@@ -0,0 +1,320 @@
+import time
+import json
+import asyncio
+import logging
+import argparse
+import tempfile
+
+import aiohttp
+from aiohttp import web
+from websockets.exceptions import ConnectionClosed
+
+from ai_streamer_twitch.api import API
+from ai_streamer_twitch.client import TwitchClient
+from ai_streamer_twitch.config import ServerConfig, APIConfig
+from ai_streamer_twitch.service import Service
+from ai_streamer_twitch.supervisor import APISupervisor
+from ai_streamer_twitch.synthetic import SyntheticAPI, fake_chat_message
+from fastsocket import Message
+
+# Recovery after dropped connections, against local fakes so nothing touches Twitch.
+#   twitch: a real API talks to a fake IRC and PubSub server that drops every connection
+#           and refuses new ones for --outage seconds. Reports how long until chat flows
+#           again in every channel and the gap the supervisor recorded.
+#   link:   a TwitchClient talks to a Service over an in-process fake websocket that gets
+#           cut, while the server keeps buffering. Reports time to resume, whether the
+#           session was resumed and how many events were lost.
+
+CONFIG = """
+[ws]
+port = 8000
+host = "127.0.0.1"
+
+[twitch]
+secret = ""
+id = ""
+update_delay = 1
+delivery = "push"
+
+[health]
+interval = {interval}
+unhealthy_checks = 2
+backoff_cap = 2
+
+[buffers]
+chat = 100000
+sub = 1000
+cheer = 1000
+"""
+
+class FakeTwitch():
+    # Just enough IRC and PubSub for twitchio to connect, join and receive chat
+    def __init__(self) -> None:
+        self.irc = set()
+        self.pubsub = set()
+        self.joined = {}
+        self.down = False
+        self.connects = 0
+
+    async def handle_irc(self, request: web.Request):
+        if self.down:
+            raise web.HTTPServiceUnavailable()
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.irc.add(ws)
+        self.joined[ws] = set()
+        self.connects += 1
+        nick = "bench"
+        async for msg in ws:
+            for line in msg.data.split("\r\n"):
+                if line.startswith("NICK"):
+                    nick = line.split()[1]
+                    await ws.send_str(f":tmi.twitch.tv 001 {nick} :Welcome\r\n:tmi.twitch.tv 376 {nick} :>\r\n")
+                elif line.startswith("JOIN"):
+                    for channel in line.split()[1].split(","):
+                        self.joined[ws].add(channel.lstrip("#"))
+                        await ws.send_str(
+                            f":{nick}!{nick}@{nick}.tmi.twitch.tv JOIN {channel}\r\n"
+                            f":{nick}.tmi.twitch.tv 353 {nick} = {channel} :{nick}\r\n"
+                            f":{nick}.tmi.twitch.tv 366 {nick} {channel} :End of /NAMES list\r\n"
+                        )
+                elif line.startswith("PART"):
+                    for channel in line.split()[1].split(","):
+                        self.joined[ws].discard(channel.lstrip("#"))
+                elif line.startswith("PING"):
+                    await ws.send_str("PONG :tmi.twitch.tv\r\n")
+        self.irc.discard(ws)
+        self.joined.pop(ws, None)
+        return ws
+
+    async def handle_pubsub(self, request: web.Request):
+        if self.down:
+            raise web.HTTPServiceUnavailable()
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.pubsub.add(ws)
+        async for msg in ws:
+            data = json.loads(msg.data)
+            if data["type"] == "PING":
+                await ws.send_json({"type": "PONG"})
+            elif data["type"] == "LISTEN":
+                await ws.send_json({"type": "RESPONSE", "nonce": data["nonce"], "error": ""})
+        self.pubsub.discard(ws)
+        return ws
+
+    async def chat(self, channel: str, i: int) -> int:
+        # Sends one message to every connection that joined channel
+        line = (
+            f"@badge-info=;badges=;color=;display-name=User_{i};emotes=;id=msg-{i};mod=0;room-id=1;"
+            f"subscriber=0;tmi-sent-ts={int(time.time() * 1000)};turbo=0;user-id={100000 + i};user-type= "
+            f":user_{i}!user_{i}@user_{i}.tmi.twitch.tv PRIVMSG #{channel} :hello {i}\r\n"
+        )
+        sent = 0
+        for ws, channels in list(self.joined.items()):
+            if channel in channels:
+                await ws.send_str(line)
+                sent += 1
+        return sent
+
+    async def drop(self):
+        for ws in list(self.irc) + list(self.pubsub):
+            await ws.close()
+
+    async def outage(self, seconds: float):
+        self.down = True
+        await self.drop()
+        await asyncio.sleep(seconds)
+        self.down = False
+
+async def start_fake_twitch(port: int) -> tuple[FakeTwitch, web.AppRunner]:
+    import twitchio.websocket
+    from twitchio.http import TwitchHTTP
+    from twitchio.ext.pubsub.websocket import PubSubWebsocket
+
+    fake = FakeTwitch()
+    app = web.Application()
+    app.router.add_get("/irc", fake.handle_irc)
+    app.router.add_get("/pubsub", fake.handle_pubsub)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    async def validate(self, *, token: str = None):
+        if not self.session:
+            self.session = aiohttp.ClientSession()
+        self.nick = "bench"
+        return {"login": "bench", "user_id": "1", "client_id": "bench", "scopes": []}
+
+    twitchio.websocket.HOST = f"ws://127.0.0.1:{port}/irc"
+    PubSubWebsocket.ENDPOINT = f"ws://127.0.0.1:{port}/pubsub"
+    TwitchHTTP.validate = validate
+    return fake, runner
+
+async def wait_for(condition, timeout: float) -> float | None:
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if await condition():
+            return time.perf_counter() - start
+        await asyncio.sleep(0.01)
+    return None
+
+async def bench_twitch(port: int, outage: float, interval: float, channels: int):
+    fake, runner = await start_fake_twitch(port)
+    with tempfile.NamedTemporaryFile("w", suffix=".toml", delete=False) as f:
+        f.write(CONFIG.format(interval=interval))
+    config = ServerConfig(f.name)
+
+    api = API(APIConfig("token", 1, "bench", config), log_level=logging.WARNING)
+    await api.start()
+    names = [f"channel_{i}" for i in range(channels)]
+    await api.set_channels(names)
+    supervisor = APISupervisor(
+        {"bench": api},
+        interval=config.health_interval,
+        unhealthy_checks=config.health_unhealthy_checks,
+        backoff_cap=config.health_backoff_cap,
+        log_level=logging.WARNING
+    )
+    supervisor.start()
+
+    sent = 0
+
+    def chat_size() -> int:
+        # Chat is buffered per channel
+        return sum(stats["size"] for key, stats in api.get_buffer_stats().items() if key.startswith("chat:"))
+
+    async def chat_flows() -> bool:
+        # Every channel has to deliver again, not just the connection
+        nonlocal sent
+        before = chat_size()
+        delivered = 0
+        for name in names:
+            sent += 1
+            delivered += await fake.chat(name, sent)
+        await asyncio.sleep(0.02)
+        return delivered == len(names) and chat_size() - before == len(names)
+
+    print(f"flowing before the outage: {await wait_for(chat_flows, 5) is not None}")
+    start = time.perf_counter()
+    await fake.outage(outage)
+    recovered = await wait_for(chat_flows, 60)
+    total = None if recovered is None else time.perf_counter() - start
+    print(f"outage {outage:.1f}s, chat in all {channels} channels again after {total if total is None else round(total, 2)}s")
+    print(f"irc connects: {fake.connects}, supervisor: {supervisor.get_stats()}")
+    for gap in api.gaps:
+        print(f"gap: {gap['until'] - gap['since']:.2f}s restarted={gap['restarted']}")
+
+    await supervisor.stop()
+    await api.close()
+    await fake.drop()
+    await runner.cleanup()
+
+class FakeLink():
+    # In-process stand-in for the fastsocket Client, wired straight to the Service handlers.
+    # cut() kills it like a dropped TCP connection: sends fail and nothing arrives.
+    def __init__(self, service: Service) -> None:
+        self._service = service
+        self._handlers = {}
+        self.cut_at = None
+
+    def cut(self):
+        self.cut_at = time.perf_counter()
+
+    def on_message(self, code: str, handler):
+        self._handlers[code] = handler
+
+    async def connect(self):
+        pass
+
+    async def disconnect(self):
+        self.cut()
+
+    async def send_msg(self, msg: Message, blocking=False):
+        if self.cut_at is not None:
+            raise ConnectionError("link is down")
+        msg = Message.from_json(msg.to_json())
+        asyncio.create_task(self._service._handlers[msg.code](msg, self))
+
+    # Server side of the link
+    async def send(self, frame: str):
+        if self.cut_at is not None:
+            raise ConnectionClosed(None, None)
+        msg = Message.from_json(frame)
+        handler = self._handlers.get(msg.code)
+        if handler is not None:
+            asyncio.create_task(handler(msg))
+
+    async def close(self):
+        self.cut()
+
+async def bench_link(interval: float, drops: int, rate: int, restart_every: int):
+    with tempfile.NamedTemporaryFile("w", suffix=".toml", delete=False) as f:
+        f.write(CONFIG.format(interval=interval))
+    service = Service(ServerConfig(f.name), log_level=logging.ERROR)
+    for dispatcher in service._dispatchers.values():
+        dispatcher.start()
+
+    async def add_session() -> SyntheticAPI:
+        api = SyntheticAPI(APIConfig("token", 1, "bench", service._config), log_level=logging.WARNING)
+        await api.start()
+        service.add_api(api)
+        return api
+
+    api = await add_session()
+    links = []
+
+    def factory(url, log_level):
+        links.append(FakeLink(service))
+        return links[-1]
+
+    client = TwitchClient("ws://fake", log_level=logging.ERROR, client_factory=factory, health_interval=interval, backoff_base=0.05)
+    await client.connect("bench", "token", ["bench"])
+
+    sent = 0
+
+    async def produce(seconds: float):
+        nonlocal sent
+        for _ in range(int(seconds * rate / 10)):
+            for _ in range(10):
+                service._apis["bench"].handle_chat_message(fake_chat_message(sent))
+                sent += 1
+            await asyncio.sleep(0.01)
+
+    print(f"{'drop':>5} {'server':>10} {'resume s':>9} {'resumed':>8} {'missed':>7}")
+    for i in range(drops):
+        await produce(0.2)
+        # Every restart_every-th drop the server loses the session as well
+        restarted = restart_every and (i + 1) % restart_every == 0
+        reconnects = client.reconnects
+        links[-1].cut()
+        if restarted:
+            await service._close_api("bench")
+            api = await add_session()
+        await produce(interval)
+        await wait_for(lambda: asyncio.sleep(0, client.reconnects > reconnects), 30)
+        resumed_after = time.perf_counter() - links[-2].cut_at
+        print(f"{i:>5} {'restarted' if restarted else 'kept':>10} {resumed_after:>9.2f} {str(client.resumed):>8} {client.last_missed:>7}")
+
+    print(f"reconnects: {client.reconnects}, gaps flagged: {len(client.gaps)}")
+    await client.disconnect()
+    for dispatcher in service._dispatchers.values():
+        await dispatcher.stop()
+
+async def main(args):
+    if args.scenario in ("twitch", "all"):
+        await bench_twitch(args.port, args.outage, args.interval, args.channels)
+    if args.scenario in ("link", "all"):
+        await bench_link(args.interval, args.drops, args.rate, args.restart_every)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenario", choices=("twitch", "link", "all"), nargs="?", default="all")
+    parser.add_argument("--port", type=int, default=8020, help="Port of the fake Twitch server")
+    parser.add_argument("--outage", type=float, default=3, help="Seconds the fake Twitch server refuses connections")
+    parser.add_argument("--interval", type=float, default=0.5, help="Seconds between health checks")
+    parser.add_argument("--channels", type=int, default=3)
+    parser.add_argument("--drops", type=int, default=4)
+    parser.add_argument("--rate", type=int, default=1000, help="Chat messages per second during the link test")
+    parser.add_argument("--restart-every", type=int, default=2, help="Every n-th drop also loses the server session, 0 never")
+    args = parser.parse_args()
+    asyncio.run(main(args))
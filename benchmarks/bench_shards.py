@@ -0,0 +1,94 @@
+import os
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+
+from ai_streamer_twitch.config import ServerConfig, APIConfig
+from ai_streamer_twitch.shard import ShardPool
+from ai_streamer_twitch.synthetic import SyntheticAPI, LoadGenerator, PROFILES
+
+# Ingest throughput of the synthetic load generator in one process versus spread over
+# worker processes. Every session runs the spike profile, throughput is counted at the
+# front-end buffers, where the fan-out would read from.
+
+CONFIG = """
+[ws]
+port = 8000
+host = "127.0.0.1"
+
+[twitch]
+secret = ""
+id = ""
+update_delay = 1
+max_batch = 2000
+
+[shards]
+batch_latency = 0.005
+
+[buffers]
+chat = 200000
+sub = 20000
+cheer = 20000
+"""
+
+def received(apis) -> int:
+    return sum(buffer.next_seq for api in apis for buffer in api._buffers.values())
+
+async def run_local(config: ServerConfig, sessions: int, rate: float, duration: float) -> float:
+    apis = []
+    for i in range(sessions):
+        api = SyntheticAPI(APIConfig("token", i, f"session_{i}", config), log_level=logging.WARNING)
+        await api.start()
+        apis.append(api)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(LoadGenerator(api, PROFILES["spike"](rate), seed=i).run(duration) for i, api in enumerate(apis)))
+    return received(apis) / (time.perf_counter() - start)
+
+async def run_sharded(config: ServerConfig, workers: int, sessions: int, rate: float, duration: float) -> float:
+    pool = ShardPool(config, workers, log_level=logging.WARNING)
+    await pool.start()
+
+    apis = []
+    for i in range(sessions):
+        api = pool.create_api(APIConfig("token", i, f"session_{i}", config), log_level=logging.WARNING, synthetic=True)
+        await api.start()
+        apis.append(api)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        pool.worker_for(api.user_name.lower()).request("load", session=api.user_name.lower(), profile="spike", duration=duration, options={"rate": rate}, seed=i)
+        for i, api in enumerate(apis)
+    ))
+    # Let the last batches arrive
+    await asyncio.sleep(0.1)
+    throughput = received(apis) / (time.perf_counter() - start)
+
+    for api in apis:
+        await api.close()
+    await pool.stop()
+    return throughput
+
+async def main(workers: list[int], sessions: int, rate: float, duration: float):
+    with tempfile.NamedTemporaryFile("w", suffix=".toml", delete=False) as f:
+        f.write(CONFIG)
+    config = ServerConfig(f.name)
+
+    print(f"cpus: {os.cpu_count()}, sessions: {sessions}, offered: {sessions * rate:.0f} chat/s")
+    baseline = await run_local(config, sessions, rate, duration)
+    print(f"{'in process':>12}: {baseline:10.0f} events/s")
+    for count in workers:
+        throughput = await run_sharded(config, count, sessions, rate, duration)
+        print(f"{f'{count} workers':>12}: {throughput:10.0f} events/s  ({throughput / baseline:.2f}x)")
+    os.unlink(f.name)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--sessions", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=50000, help="Offered chat messages per second per session")
+    parser.add_argument("--duration", type=float, default=3)
+    args = parser.parse_args()
+    asyncio.run(main(args.workers, args.sessions, args.rate, args.duration))
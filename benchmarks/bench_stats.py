@@ -0,0 +1,39 @@
+import time
+import random
+
+from ai_streamer_twitch.models import ChatMessage, CheerMessage, SubMessage
+from ai_streamer_twitch.stats import SessionStats
+
+# Per event cost of the windowed aggregates and the cost of one GetStats snapshot
+
+N = 200000
+USERS = 20000
+
+def main():
+    rng = random.Random(0)
+    events = []
+    for i in range(N):
+        user = int(rng.paretovariate(1.2)) % USERS
+        events.append(("chat", ChatMessage(f"user_{user}", user, "hello chat")))
+        if i % 500 == 0:
+            events.append(("cheers", CheerMessage(False, f"user_{user}", user, "Cheer100", 100)))
+        if i % 700 == 0:
+            events.append(("subs", SubMessage(f"user_{user}", user, "", 1, i % 2 == 0, False)))
+
+    stats = SessionStats(window=60, top=10)
+    now = 0.0
+    start = time.perf_counter()
+    for kind, event in events:
+        stats.add(kind, event, now)
+        now += 0.0005
+    elapsed = time.perf_counter() - start
+    print(f"add: {elapsed / len(events) * 1e6:.2f} us/event ({len(events) / elapsed:.0f} events/s)")
+
+    start = time.perf_counter()
+    for _ in range(100):
+        snapshot = stats.to_dict(now)
+    print(f"to_dict: {(time.perf_counter() - start) / 100 * 1e3:.2f} ms")
+    print(f"unique chatters: {snapshot['chat']['unique_chatters']}, top: {snapshot['chat']['top_chatters'][:3]}")
+
+if __name__ == "__main__":
+    main()
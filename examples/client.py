@@ -6,9 +6,10 @@ async def main():
     # Token with atleast these scopes: chat:read bits:read channel:read:subscriptions channel:manage:broadcast user:edit:broadcast
     await twitch_client.connect("user_name", "token", ["channels"])
 
-    while True:
-        print(twitch_client.get_newest_messages())
-        await asyncio.sleep(2)
+    # Events arrive as soon as the server pushes them, no polling
+    async with twitch_client.events() as events:
+        async for event in events:
+            print(event.type, event.model)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -1,5 +1,27 @@
-from .client import TwitchClient
-from .service import Service
-from .config import ServerConfig
+from typing import TYPE_CHECKING
 
-__all__ = ["TwitchClient", "Service", "ServerConfig"]
\ No newline at end of file
+# Exports are imported on first access, so "from ai_streamer_twitch import TwitchClient"
+# does not load the server side (twitchio, aiohttp, toml) and the server does not load the client
+_EXPORTS = {
+    "TwitchClient": ".client",
+    "Service": ".service",
+    "ServerConfig": ".config",
+}
+
+if TYPE_CHECKING:
+    from .client import TwitchClient
+    from .service import Service
+    from .config import ServerConfig
+
+__all__ = ["TwitchClient", "Service", "ServerConfig"]
+
+def __getattr__(name: str):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+    value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
@@ -1,22 +1,29 @@
 import asyncio
 import click
-import toml
 import logging
 from pathlib import Path
 
-from .service import Service
-from .config import ServerConfig
-
 @click.command()
 @click.option('--config', '-c', type=click.Path(exists=True), required=True, help='Path to the TOML configuration file')
 @click.option('--log-level', '-l', type=click.Choice(['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']), default='INFO', help='Set the logging level')
-def main(config: str, log_level: str):
+@click.option('--log-format', type=click.Choice(['text', 'json']), default='text', help='Write plain text or one JSON object per line')
+@click.option('--debug-sample', type=click.FloatRange(0, 1), default=1.0, help='Fraction of the per event debug logs to keep')
+@click.option('--workers', '-w', type=click.IntRange(min=0), default=None, help='Worker processes for the Twitch sessions, overrides [shards] workers')
+def main(config: str, log_level: str, log_format: str, debug_sample: float, workers: int | None):
+    # Imported after the options are parsed so --help and bad arguments return right away
+    from .service import Service
+    from .config import ServerConfig
+    from .utils import setup_logging
+
     config_path = Path(config)
     server_config = ServerConfig(config_path)
+    if workers is not None:
+        server_config.shard_workers = workers
 
+    setup_logging(json_format=log_format == 'json', sample_rate=debug_sample)
     logging_level = getattr(logging, log_level.upper())
 
-    service = Service(server_config, log_level=logging_level)
+    service = Service(server_config, log_level=logging_level, log_json=log_format == 'json')
 
     async def run_service():
         try:
@@ -1,86 +1,436 @@
+import time
 import asyncio
 import uuid
 import logging
-
-import twitchio
-from twitchio.ext import pubsub
+from operator import attrgetter
+from collections import deque
+from typing import TYPE_CHECKING
 
 from .config import APIConfig
-from .utils import setup_logger, CircularBuffer
+from .utils import setup_logger, CircularBuffer, SAMPLED
 from .models import ChatMessage, CCL, CheerMessage, SubMessage
+from .metrics import REGISTRY
+from .pipeline import ChatPipeline
+from .eventlog import EventLog
+from .stats import SessionStats
+from .scheduler import PRIORITY_HIGH
+from .channels import ChannelSync
+
+def chat_buffer_key(channel: str) -> str:
+    # Name of a channel's chat buffer in cursors and buffer stats
+    return f"chat:{channel}"
+
+if TYPE_CHECKING:
+    import twitchio
+    from twitchio.ext import pubsub
+
+    from .metadata import StreamMetadata
+    from .helix import HelixClient
 
 class API():
     def __init__(self, config: APIConfig, log_level=logging.DEBUG) -> None:
         self._config = config
 
-        self._logger, self._stream_hndl = setup_logger("TwitchAPI", log_level)
+        self._logger, _ = setup_logger("TwitchAPI", log_level)
 
         self._twitch_client = None
         self._pubsub = None
         self._user = None
 
-        self._chat_buffer = CircularBuffer(self._config.server_config.twitch_chat_buffer_size)
+        # Chat is buffered per channel so a busy channel can not push out the messages of a
+        # quiet one, each is created on its first message. Subs and cheers only come from the
+        # broadcaster's own channel and have one buffer each.
+        self._chat_buffers = {}
         self._sub_buffer = CircularBuffer(self._config.server_config.twitch_sub_buffer_size)
         self._cheer_buffer = CircularBuffer(self._config.server_config.twitch_cheer_buffer_size)
+        # Every buffer by its cursor key, chat buffers as chat_buffer_key(channel)
+        self._buffers = {
+            "cheers": self._cheer_buffer,
+            "subs": self._sub_buffer
+        }
+        # Channels parted while they had a chat buffer, the buffer goes once every reader is past it
+        self._parted = {}
+        # Chat messages dropped because max_channels chat buffers were in use
+        self.chat_overflow = 0
+
+        # Sequence numbers restart with every API instance, cursors carry this to detect that
+        self.session_id = uuid.uuid4().hex
 
         self.started_raid = False
 
+        # Channels asked for through set_channels and their join status. Only the difference
+        # to what is joined is sent, JOINs are rate limited.
+        self._channels = ChannelSync(
+            self._join_channels,
+            self._part_channels,
+            rate=self._config.server_config.channel_join_rate,
+            period=self._config.server_config.channel_join_period,
+            max_attempts=self._config.server_config.channel_join_attempts,
+            log_level=log_level
+        )
+
+        # Outages of the Twitch connection, events sent during one were never received
+        self.gaps = deque(maxlen=100)
+        # Called with the gap dict whenever one is recorded
+        self.on_gap = None
+
+        # Called with the event kind after every buffered event, used for push delivery
+        self.on_event = None
+
+        # Optional write ahead log every buffered event is appended to
+        self._event_log = None
+
+        # Optional filter, dedup and sampling stage for chat messages
+        self._pipeline = None
+        if self._config.server_config.chat_filter:
+            self._pipeline = ChatPipeline.from_dict(self._config.server_config.chat_filter)
+
+        # Optional manager that sends channel info through Helix instead of twitchio
+        self._metadata = None
+        # Shared Helix client, raids go through its scheduler when set
+        self._helix = None
+
+        self._stats = None
+        if self._config.server_config.stats_enabled:
+            self._stats = SessionStats(self._config.server_config.stats_window, top=self._config.server_config.stats_top)
+
+        key = self.user_name.lower()
+        self._events_total = REGISTRY.counter("events_ingested_total", "Events received from Twitch", ("session", "type"))
+        self._filtered_total = REGISTRY.counter("events_filtered_total", "Chat messages dropped by the filter pipeline", ("session",))
+        handler_seconds = REGISTRY.histogram("event_handler_seconds", "Time spent handling one Twitch event", ("type",))
+        self._chat_events = self._events_total.labels(key, "chat")
+        self._chat_filtered = self._filtered_total.labels(key)
+        self._sub_events = self._events_total.labels(key, "subs")
+        self._cheer_events = self._events_total.labels(key, "cheers")
+        self._chat_seconds = handler_seconds.labels("chat")
+        self._sub_seconds = handler_seconds.labels("subs")
+        self._cheer_seconds = handler_seconds.labels("cheers")
+
+    def remove_metrics(self):
+        # Drops the samples of this session, a session started later under the same name gets new ones
+        key = self.user_name.lower()
+        for kind in ("chat", "subs", "cheers"):
+            self._events_total.remove(key, kind)
+        self._filtered_total.remove(key)
+
+    @property
+    def user_name(self) -> str:
+        return self._config.user_name
+
+    @property
+    def user_id(self) -> int:
+        return self._config.user_id
+
+    @property
+    def user_token(self) -> str:
+        return self._config.user_token
+
     async def close(self):
         self._logger.info("Closing Twitch API")
-        await self._twitch_client.close()
+        if self._metadata is not None:
+            await self._metadata.close()
+        await self._channels.close()
+        await self._close_twitch(self._twitch_client, self._pubsub)
         self._logger.info("Closed Twitch API")
-        self._logger.removeHandler(self._stream_hndl)
+
+    @staticmethod
+    async def _close_twitch(client: "twitchio.Client", pubsub_api: "pubsub.PubSubPool | None"):
+        # twitchio's close leaves the PubSub sockets open and fails on a client that never connected
+        if pubsub_api is not None:
+            for node in pubsub_api._pool:
+                await node.disconnect()
+                if node.session is not None:
+                    await node.session.close()
+        if client._closing is not None:
+            await client.close()
+        elif client._http.session is not None:
+            await client._http.session.close()
 
     async def start(self):
         self._logger.info("Starting Twitch API")
+        # Imported here so processes that only run synthetic or remote sessions never load twitchio
+        import twitchio
+        from twitchio.ext import pubsub
+
         client = twitchio.Client(self._config.user_token)
         pubsub_api = pubsub.PubSubPool(client)
         user = client.create_user(self._config.user_id, self._config.user_name)
 
         @client.event()
-        async def event_message(msg: twitchio.Message):
-            cm = ChatMessage.from_twitch_msg(msg)
-            self._chat_buffer.append(cm)
-            self._logger.debug(f"Got Chat Message: {cm.to_dict()}")
+        async def event_message(msg: "twitchio.Message"):
+            self.handle_chat_message(msg)
+
+        @client.event()
+        async def event_channel_joined(channel: "twitchio.Channel"):
+            self._channels.joined(channel.name)
 
         @client.event()
-        async def event_pubsub_subscriptions(event: pubsub.PubSubChannelSubscribe):
-            cm = SubMessage.from_event(event)
-            self._sub_buffer.append(cm)
-            self._logger.debug(f"Got Chat Message: {cm.to_dict()}")
+        async def event_channel_join_failure(channel: str):
+            self._channels.failed(channel)
 
         @client.event()
-        async def event_pubsub_bits(event: pubsub.PubSubBitsMessage):
-            cm = CheerMessage.from_event(event)
-            self._cheer_buffer.append(cm)
-            self._logger.debug(f"Got Chat Message: {cm.to_dict()}")
+        async def event_pubsub_subscriptions(event: "pubsub.PubSubChannelSubscribe"):
+            self.handle_sub(event)
+
+        @client.event()
+        async def event_pubsub_bits(event: "pubsub.PubSubBitsMessage"):
+            self.handle_bits(event)
         
         pubsub_topics = [
             pubsub.bits(self._config.user_token)[self._config.user_id],
             pubsub.channel_subscriptions(self._config.user_token)[self._config.user_id]
         ]
-        await pubsub_api.subscribe_topics(pubsub_topics)
-        await client.connect()
+        try:
+            await pubsub_api.subscribe_topics(pubsub_topics)
+            await client.connect()
+        except Exception:
+            await self._close_twitch(client, pubsub_api)
+            raise
 
         self._twitch_client = client
         self._pubsub = pubsub_api
         self._user = user
 
         self._logger.info("Started Twitch API")
+
+    def is_healthy(self) -> bool:
+        # twitchio keeps the IRC socket and every PubSub socket open while it is connected
+        if self._twitch_client is None:
+            return False
+        connection = getattr(self._twitch_client, "_connection", None)
+        if connection is not None and not connection.is_alive:
+            return False
+        if self._pubsub is not None:
+            for node in self._pubsub._pool:
+                if node.connection is None or node.connection.closed:
+                    return False
+        return True
+
+    async def restart(self):
+        # Buffers, cursors and the session id stay, only the Twitch connections are new
+        self._logger.info("Restarting Twitch API")
+        if self._twitch_client is not None:
+            try:
+                await self._close_twitch(self._twitch_client, self._pubsub)
+            except Exception as e:
+                self._logger.warning(f"Closing the old Twitch client failed: {e}")
+        await self.start()
+        await self.restore()
+
+    async def restore(self):
+        # Joins the channels again, twitchio only rejoins the ones the client was created with
+        self._channels.reset()
+
+    def add_gap(self, gap: dict):
+        self.gaps.append(gap)
+        if self.on_gap is not None:
+            self.on_gap(gap)
     
-    def get_chat_messages(self, clear=True) -> list[ChatMessage]:
-        return self._chat_buffer.get_all(clear=clear)
+    def handle_chat_message(self, msg: "twitchio.Message"):
+        start = time.perf_counter()
+        cm = ChatMessage.from_twitch_msg(msg)
+        if self._pipeline is not None and not self._pipeline.accept(cm):
+            self._chat_filtered.inc()
+            return
+        self.add_event("chat", cm)
+        self._logger.debug("Got Chat Message: %r", cm, extra=SAMPLED)
+        self._chat_events.inc()
+        self._chat_seconds.observe(time.perf_counter() - start)
+
+    def handle_sub(self, event: "pubsub.PubSubChannelSubscribe"):
+        start = time.perf_counter()
+        cm = SubMessage.from_event(event)
+        self.add_event("subs", cm)
+        self._logger.debug("Got Sub Message: %r", cm, extra=SAMPLED)
+        self._sub_events.inc()
+        self._sub_seconds.observe(time.perf_counter() - start)
+
+    def handle_bits(self, event: "pubsub.PubSubBitsMessage"):
+        start = time.perf_counter()
+        cm = CheerMessage.from_event(event)
+        self.add_event("cheers", cm)
+        self._logger.debug("Got Cheer Message: %r", cm, extra=SAMPLED)
+        self._cheer_events.inc()
+        self._cheer_seconds.observe(time.perf_counter() - start)
+
+    def add_event(self, kind: str, event):
+        # kind is one of "chat", "subs" or "cheers"
+        if kind == "chat":
+            buffer = self._get_chat_buffer(event.channel)
+            if buffer is None:
+                self.chat_overflow += 1
+                return
+            buffer.append(event)
+        else:
+            self._buffers[kind].append(event)
+        if self._event_log is not None:
+            self._event_log.append(kind, event)
+        if self._stats is not None:
+            self._stats.add(kind, event)
+        self._notify(kind)
+
+    def _notify(self, kind: str):
+        if self.on_event is not None:
+            self.on_event(kind)
+    
+    def _get_chat_buffer(self, channel: str | None) -> CircularBuffer | None:
+        # Messages without a channel (old event logs) belong to the broadcaster's channel.
+        # None once max_channels buffers exist and none of them belongs to a parted channel.
+        channel = channel or self.user_name.lower()
+        buffer = self._chat_buffers.get(channel)
+        if buffer is None:
+            if len(self._chat_buffers) >= self._config.server_config.twitch_chat_max_channels:
+                parted = next((name for name in self._parted if name in self._chat_buffers), None)
+                if parted is None:
+                    return None
+                self._logger.warning(f"Chat buffer limit reached, dropping the buffer of parted channel {parted}")
+                self._drop_chat_buffer(parted)
+            sizes = self._config.server_config.twitch_chat_channel_buffer_sizes
+            buffer = CircularBuffer(sizes.get(channel, self._config.server_config.twitch_chat_buffer_size))
+            self._chat_buffers[channel] = buffer
+            self._buffers[chat_buffer_key(channel)] = buffer
+        return buffer
+
+    def _drop_chat_buffer(self, channel: str):
+        self._parted.pop(channel, None)
+        self._chat_buffers.pop(channel, None)
+        self._buffers.pop(chat_buffer_key(channel), None)
+
+    def _track_parted(self, changes: dict):
+        for channel in changes.get("part", ()):
+            if channel in self._chat_buffers:
+                self._parted[channel] = None
+        for channel in changes.get("join", ()):
+            self._parted.pop(channel, None)
+
+    def prune_chat_buffers(self, cursors: list[dict]):
+        # Drops the buffers of parted channels that every cursor of this session has read to the end.
+        # Their keys leave the cursors with the next read_since.
+        for channel in list(self._parted):
+            buffer = self._chat_buffers.get(channel)
+            if buffer is None:
+                del self._parted[channel]
+                continue
+            key = chat_buffer_key(channel)
+            if all(cursor.get(key, 0) >= buffer.next_seq for cursor in cursors if cursor.get("session") == self.session_id):
+                self._drop_chat_buffer(channel)
+
+    def get_chat_messages(self, since: int = 0, channel: str = None) -> tuple[list[ChatMessage], int]:
+        buffer = self._chat_buffers.get(channel or self.user_name.lower())
+        if buffer is None:
+            return [], since
+        return buffer.get_since(since)
     
-    def get_bits(self, clear=True) -> list[CheerMessage]:
-        return self._cheer_buffer.get_all(clear=clear)
+    def get_bits(self, since: int = 0) -> tuple[list[CheerMessage], int]:
+        return self._cheer_buffer.get_since(since)
     
-    def get_subs(self, clear=True) -> list[SubMessage]:
-        return self._sub_buffer.get_all(clear=clear) 
+    def get_subs(self, since: int = 0) -> tuple[list[SubMessage], int]:
+        return self._sub_buffer.get_since(since)
+
+    def set_event_log(self, event_log: EventLog | None):
+        self._event_log = event_log
+
+    def get_event_log(self) -> EventLog | None:
+        return self._event_log
+
+    async def set_pipeline(self, pipeline: ChatPipeline | None):
+        self._pipeline = pipeline
+
+    def get_pipeline(self) -> ChatPipeline | None:
+        return self._pipeline
+
+    def set_helix(self, helix: "HelixClient | None"):
+        self._helix = helix
+
+    def set_metadata(self, metadata: "StreamMetadata | None"):
+        self._metadata = metadata
 
-    async def set_channels(self, channels):
+    def get_metadata(self) -> "StreamMetadata | None":
+        return self._metadata
+
+    def get_stats(self) -> dict | None:
+        return None if self._stats is None else self._stats.to_dict()
+
+    async def fetch_stats(self) -> dict | None:
+        # Overridden where the stats are kept elsewhere
+        return self.get_stats()
+
+    def get_buffer_stats(self) -> dict:
+        return {
+            key: {"size": len(buffer), "capacity": buffer.capacity, "dropped": buffer.dropped}
+            for key, buffer in self._buffers.items()
+        }
+
+    def new_cursor(self, from_start=False) -> dict:
+        cursor = {"session": self.session_id}
+        for key, buffer in self._buffers.items():
+            cursor[key] = buffer.first_seq if from_start else buffer.next_seq
+        return cursor
+
+    def read_since(self, cursor: dict, kinds=None, channels=None) -> tuple[dict, dict, int]:
+        # Returns the events after cursor by kind, the cursor to continue from and how many events were lost.
+        # Only the buffers in kinds are read, positions of the other kinds stay where they were. When chat
+        # is read with channels set, every other channel is skipped to its newest position, so widening
+        # the channels later does not send their old backlog or count it as missed.
+        if cursor.get("session") != self.session_id:
+            cursor = self.new_cursor(from_start=True)
+        if kinds is None:
+            kinds = ("chat", "cheers", "subs")
+
+        # Rebuilt from the buffers so positions of buffers that are gone do not pile up
+        next_cursor = {"session": self.session_id}
+        for key in self._buffers:
+            if key in cursor:
+                next_cursor[key] = cursor[key]
+
+        events = {}
+        missed = 0
+        for kind in kinds:
+            if kind == "chat":
+                buffers = []
+                for channel, buffer in self._chat_buffers.items():
+                    if channels is None or channel in channels:
+                        buffers.append((chat_buffer_key(channel), buffer))
+                    else:
+                        next_cursor[chat_buffer_key(channel)] = buffer.next_seq
+            else:
+                buffers = [(kind, self._buffers[kind])]
+
+            items = []
+            read = 0
+            for key, buffer in buffers:
+                # A channel that got its first message after the cursor was made is read from the start,
+                # so is one whose buffer was dropped and created again since
+                seq = cursor.get(key, 0)
+                if seq > buffer.next_seq:
+                    seq = 0
+                missed += max(0, buffer.first_seq - seq)
+                new, next_cursor[key] = buffer.get_since(seq)
+                if new:
+                    items.extend(new)
+                    read += 1
+            if read > 1:
+                # Event ids are ordered, this interleaves the channels in arrival order
+                items.sort(key=attrgetter("uuid"))
+            events[kind] = items
+        return events, next_cursor, missed
+
+    async def set_channels(self, channels) -> dict:
+        # Returns the channels that are joined and parted, joins finish in the background
+        changes = await self._channels.set_desired(channels)
+        self._track_parted(changes)
+        return changes
+
+    async def _join_channels(self, channels: list[str]):
         await self._twitch_client.join_channels(channels)
+
+    async def _part_channels(self, channels: list[str]):
+        await self._twitch_client.part_channels(channels)
     
-    async def update_stream(self, title: str, tags:list[str], ccl:CCL = CCL(), game_id:int=509658):
+    async def update_stream(self, title: str, tags:list[str], ccl:CCL = CCL(), game_id:int=509658) -> list[str] | None:
+        # With a metadata manager only the changed fields are sent and they are returned
+        if self._metadata is not None:
+            return await self._metadata.update(title=title, tags=tags, ccl=ccl, game_id=game_id)
         await self._user.modify_stream(
             self._config.user_token,
             game_id=game_id,
@@ -90,15 +440,46 @@ class API():
         )
     
     async def start_raid(self, channel_id: int):
-        self._user.start_raid(self._config.user_token, channel_id)
+        if self._helix is not None:
+            await self._helix.request(
+                "POST",
+                "/raids",
+                params={"from_broadcaster_id": str(self.user_id), "to_broadcaster_id": str(channel_id)},
+                user_token=self.user_token,
+                priority=PRIORITY_HIGH,
+                tenant=self.user_name.lower()
+            )
+        else:
+            await self._user.start_raid(self._config.user_token, channel_id)
+        self.started_raid = True
     
     async def stop_raid(self):
-        self._user.cancel_raid(self._config.user_token)
+        if self._helix is not None:
+            await self._helix.request(
+                "DELETE",
+                "/raids",
+                params={"broadcaster_id": str(self.user_id)},
+                user_token=self.user_token,
+                priority=PRIORITY_HIGH,
+                tenant=self.user_name.lower()
+            )
+        else:
+            await self._user.cancel_raid(self._config.user_token)
+        self.started_raid = False
     
     def get_conncted_channels(self):
-        return self._twitch_client.connected_channels
+        return self._channels.joined_channels()
 
     def get_info(self):
         return {
-            "connected_channels": self._twitch_client.connected_channels
-        }
\ No newline at end of file
+            "connected_channels": self.get_conncted_channels(),
+            "channels": self._channels.get_info(),
+            "filter": None if self._pipeline is None else self._pipeline.get_stats(),
+            "metadata": None if self._metadata is None else self._metadata.get_stats(),
+            "gaps": list(self.gaps),
+            "chat_overflow": self.chat_overflow
+        }
+
+    async def fetch_info(self) -> dict:
+        # Overridden where the info has to be fetched from elsewhere
+        return self.get_info()
\ No newline at end of file
@@ -0,0 +1,194 @@
+import time
+import asyncio
+import logging
+from collections import deque
+
+from .utils import setup_logger
+from .metrics import REGISTRY
+
+PENDING = "pending"
+JOINING = "joining"
+JOINED = "joined"
+FAILED = "failed"
+
+def normalize(channel: str) -> str:
+    return channel.lower().lstrip("#")
+
+class ChannelState():
+    __slots__ = ("status", "attempts", "requested_at", "sent_at", "joined_at", "error")
+
+    def __init__(self, requested_at: float) -> None:
+        self.status = PENDING
+        self.attempts = 0
+        self.requested_at = requested_at
+        self.sent_at = None
+        self.joined_at = None
+        self.error = None
+
+    def to_dict(self) -> dict:
+        return {
+            "status": self.status,
+            "attempts": self.attempts,
+            # Seconds spent in the join queue and between sending JOIN and Twitch confirming it
+            "wait": None if self.sent_at is None else self.sent_at - self.requested_at,
+            "latency": None if self.joined_at is None or self.sent_at is None else self.joined_at - self.sent_at,
+            "error": self.error
+        }
+
+class ChannelSync():
+    # Keeps the joined channels equal to the desired set. set_desired only works out the
+    # difference: dropped channels are parted right away, new ones go through a join queue
+    # that sends at most rate JOINs per period seconds, Twitch's limit per account.
+    # joined() and failed() are fed from the IRC events, failed joins are retried.
+    def __init__(self, join, part, rate: int = 20, period: float = 10, max_attempts: int = 3, log_level=logging.DEBUG) -> None:
+        # Coroutine functions called with a list of channel names
+        self._join = join
+        self._part = part
+        self._rate = rate
+        self._period = period
+        self._max_attempts = max_attempts
+
+        self._logger, _ = setup_logger("Channels", log_level)
+
+        self._states = {}
+        self._queue = deque()
+        # Send times of the JOINs in the current window
+        self._sent = deque()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+        self._join_seconds = REGISTRY.histogram("channel_join_seconds", "Time between sending JOIN and Twitch confirming it").labels()
+
+    @property
+    def desired(self) -> list[str]:
+        return list(self._states.keys())
+
+    def joined_channels(self) -> list[str]:
+        return [name for name, state in self._states.items() if state.status == JOINED]
+
+    async def set_desired(self, channels) -> dict:
+        channels = {normalize(channel): None for channel in channels}
+        removed = [name for name in self._states if name not in channels]
+        added = [name for name in channels if name not in self._states]
+
+        parts = []
+        for name in removed:
+            state = self._states.pop(name)
+            if state.status in (JOINING, JOINED):
+                parts.append(name)
+        now = time.time()
+        for name in added:
+            self._states[name] = ChannelState(now)
+            self._queue.append(name)
+
+        if added:
+            self._start()
+        if parts:
+            await self._part(parts)
+        if added or removed:
+            self._logger.info(f"Joining {len(added)} and parting {len(removed)} channels")
+        return {"join": added, "part": removed}
+
+    def reset(self):
+        # The connection is new, every desired channel has to be joined again
+        now = time.time()
+        self._queue.clear()
+        for name in self._states:
+            self._states[name] = ChannelState(now)
+            self._queue.append(name)
+        if self._queue:
+            self._start()
+
+    def joined(self, channel: str):
+        state = self._states.get(normalize(channel))
+        if state is None or state.status == JOINED:
+            return
+        state.status = JOINED
+        state.joined_at = time.time()
+        state.error = None
+        if state.sent_at is not None:
+            self._join_seconds.observe(state.joined_at - state.sent_at)
+
+    def failed(self, channel: str, error: str = "join timed out"):
+        name = normalize(channel)
+        state = self._states.get(name)
+        if state is None or state.status != JOINING:
+            return
+        state.error = error
+        if state.attempts < self._max_attempts:
+            state.status = PENDING
+            self._queue.append(name)
+            self._start()
+        else:
+            state.status = FAILED
+            self._logger.warning(f"Could not join {name} after {state.attempts} attempts: {error}")
+
+    def _start(self):
+        self._wakeup.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def _free_slots(self, now: float) -> int:
+        while self._sent and now - self._sent[0] >= self._period:
+            self._sent.popleft()
+        return self._rate - len(self._sent)
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            slots = self._free_slots(now)
+            if slots <= 0:
+                await asyncio.sleep(self._sent[0] + self._period - now)
+                continue
+
+            batch = []
+            while self._queue and len(batch) < slots:
+                name = self._queue.popleft()
+                state = self._states.get(name)
+                # Channels that were dropped or already handled while queued
+                if state is None or state.status != PENDING or name in batch:
+                    continue
+                batch.append(name)
+            if not batch:
+                continue
+
+            sent_at = time.time()
+            for name in batch:
+                self._sent.append(now)
+                state = self._states[name]
+                state.status = JOINING
+                state.attempts += 1
+                state.sent_at = sent_at
+            try:
+                await self._join(batch)
+            except Exception as e:
+                self._logger.error(f"Sending JOIN failed: {e}")
+                for name in batch:
+                    self.failed(name, str(e))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def get_info(self) -> dict:
+        counts = {PENDING: 0, JOINING: 0, JOINED: 0, FAILED: 0}
+        latencies = []
+        for state in self._states.values():
+            counts[state.status] += 1
+            if state.status == JOINED and state.sent_at is not None:
+                latencies.append(state.joined_at - state.sent_at)
+        return {
+            **counts,
+            "queued": len(self._queue),
+            "join_latency": {
+                "avg": sum(latencies) / len(latencies) if latencies else None,
+                "max": max(latencies, default=None)
+            },
+            "channels": {name: state.to_dict() for name, state in self._states.items()}
+        }
@@ -1,4 +1,6 @@
+import time
 import asyncio
+from collections import deque
 from typing import List, Dict
 import logging
 from fastsocket import Client, Message, TIMEOUT
@@ -6,40 +8,327 @@ import uuid
 
 from .constants import *
 from .utils import CircularBuffer, setup_logger
-from .models import CCL
+from .models import CCL, ChatMessage, SubMessage, CheerMessage
+from .codec import JSON, decode_events
+from .supervisor import Backoff
+
+EVENT_TYPES = ("chat", "cheers", "subs")
+EVENT_MODELS = {"chat": ChatMessage, "subs": SubMessage, "cheers": CheerMessage}
+
+class StreamEvent():
+    # One received event. data is the dict from the server, model builds the
+    # ChatMessage, SubMessage or CheerMessage the first time it is used.
+    # "gap" events mark a window whose events were lost, they go to every stream.
+    __slots__ = ("type", "data", "_model")
+
+    def __init__(self, type: str, data: Dict) -> None:
+        self.type = type
+        self.data = data
+        self._model = None
+
+    @property
+    def model(self):
+        if self._model is None:
+            model = EVENT_MODELS.get(self.type)
+            self._model = self.data if model is None else model.from_dict(self.data)
+        return self._model
+
+    def __getitem__(self, key: str):
+        return self.data[key]
+
+    def __repr__(self) -> str:
+        return f"StreamEvent({self.type}, {self.data})"
+
+class EventStream():
+    # Async iterator over events as they arrive. The queue holds at most queue_size events,
+    # when a consumer falls behind the oldest are dropped and counted in dropped.
+    def __init__(self, types, queue_size: int = 1000, on_close=None) -> None:
+        self.types = frozenset(types)
+        self.received = 0
+        self.dropped = 0
+        self.closed = False
+
+        self._queue = deque()
+        self._queue_size = queue_size
+        self._ready = asyncio.Event()
+        self._on_close = on_close
+
+    def push(self, event: StreamEvent):
+        if len(self._queue) >= self._queue_size:
+            self._queue.popleft()
+            self.dropped += 1
+        self._queue.append(event)
+        self.received += 1
+        self._ready.set()
+
+    async def get(self) -> StreamEvent:
+        # Waits for the next event, raises StopAsyncIteration once closed and drained
+        while not self._queue:
+            if self.closed:
+                raise StopAsyncIteration
+            self._ready.clear()
+            await self._ready.wait()
+        return self._queue.popleft()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._ready.set()
+        if self._on_close is not None:
+            self._on_close(self)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> StreamEvent:
+        return await self.get()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+class BatchStream(EventStream):
+    # Yields lists of up to max_size events. A batch is handed out once it is full
+    # or max_wait seconds after its first event arrived.
+    def __init__(self, types, max_size: int = 100, max_wait: float = 0.05, queue_size: int = 1000, on_close=None) -> None:
+        super().__init__(types, queue_size, on_close)
+        self.max_size = max_size
+        self.max_wait = max_wait
+
+    async def __anext__(self) -> List[StreamEvent]:
+        batch = [await self.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_size:
+            while self._queue and len(batch) < self.max_size:
+                batch.append(self._queue.popleft())
+            remaining = deadline - time.monotonic()
+            if len(batch) >= self.max_size or remaining <= 0 or self.closed:
+                break
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        while self._queue and len(batch) < self.max_size:
+            batch.append(self._queue.popleft())
+        return batch
+
+# Replies the server sends for requests, they are matched to the waiting call by uuid
+RESPONSE_CODES = (
+    START_TWITCH_API, STOP_TWITCH_API, GET_STATUS, GET_STATS, GET_ID_FROM_USER, GET_METRICS,
+    SET_CHANNELS, UPDATE_STREAM, SET_FILTER, SUBSCRIBE, REPLAY_LOG, BATCH,
+    ERROR_TWITCH, ERROR_TWITCH_API_NOT_CONNECTED
+)
 
 class TwitchClient:
-    def __init__(self, url: str, buffer_size: int = 100, log_level=logging.INFO):
-        self.ws = Client(url, log_level)
+    def __init__(self, url: str, buffer_size: int = 100, log_level=logging.INFO, encoding: str = JSON, lanes: List[str] = ("chat", "priority"),
+                 max_in_flight: int = 64, timeout: float = 10, reconnect: bool = True, health_interval: float = 5,
+                 backoff_base: float = 0.5, backoff_cap: float = 30, client_factory=Client, chat_channels: List[str] | None = None):
+        self.url = url
+        self._log_level = log_level
+        # Called with (url, log_level) for every connection, lets tests use a fake websocket
+        self._client_factory = client_factory
+        self.ws = client_factory(url, log_level)
+        self._logger, _ = setup_logger("Twitch Client", log_level)
         self.token = None
         self.user_name = None
         self.connected = False
         self.chat_messages = CircularBuffer(buffer_size)
         self.cheers = CircularBuffer(buffer_size)
         self.subs = CircularBuffer(buffer_size)
+        # Last cursor the server sent, used to resume without losing messages
+        self.cursor = None
+        self.missed = 0
+        self.last_missed = 0
+        # Batch encoding asked from the server, "json" or "columnar"
+        self.encoding = encoding
+        # "chat" gets chat messages in batches, "priority" gets subs and cheers right away
+        self.lanes = list(lanes)
+        # Channels to get chat from, None for all joined channels. Subs and cheers always come
+        self.chat_channels = None if chat_channels is None else list(chat_channels)
 
-    async def connect(self, user_name: str, token: str, channels: List[str]):
-        self._logger, _ = setup_logger("Twitch Client")
+        # Requests are pipelined, every call waits on its own future until the reply with its uuid arrives
+        self._pending = {}
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self.timeout = timeout
 
-        await self.ws.connect()
-        
-        await self.start_twitch_api(token, user_name)
-        await self.set_channels(channels)
+        # Open events() and batches() iterators
+        self._streams = set()
+
+        # Session state sent again when the server lost the session
+        self.channels = []
+        self._filter = None
+        self._stream_info = None
+        # Whether the last subscribe continued the server session of the cursor
+        self.resumed = False
+
+        # The connection is checked every health_interval seconds and opened again when it fails
+        self.reconnect = reconnect
+        self.health_interval = health_interval
+        self._backoff_base = backoff_base
+        self._backoff_cap = backoff_cap
+        self._supervisor = None
+        self._link_lost = asyncio.Event()
+        self.reconnects = 0
+        # Windows whose events were lost, from a reconnect here or a Twitch outage on the server
+        self.gaps = deque(maxlen=100)
+
+    async def connect(self, user_name: str, token: str, channels: List[str]):
+        self.token = token
+        self.channels = list(channels)
+        await self._open(user_name)
 
         self.connected = True
+        if self.reconnect and self._supervisor is None:
+            self._supervisor = asyncio.create_task(self._supervise())
+
+    async def _open(self, user_name: str) -> bool:
+        # Returns False when the session could not be set up on the server
+        await self.ws.connect()
 
         self.ws.on_message(NEW_MESSAGES, self.handle_new_messages)
-        self.ws.on_message(ERROR_TWITCH, self.handle_error)
+        self.ws.on_message(STREAM_GAP, self.handle_gap)
+        for code in RESPONSE_CODES:
+            self.ws.on_message(code, self.handle_response)
+
+        if not await self.start_twitch_api(self.token, user_name) or not await self.subscribe(self.cursor):
+            return False
+        if self.resumed:
+            return True
+
+        # New session on the server, it has none of the state set through this client
+        if not await self.set_channels(self.channels):
+            return False
+        if self._filter is not None:
+            await self.set_filter(**self._filter)
+        if self._stream_info is not None:
+            await self.update_stream(*self._stream_info)
+        return True
+
+    async def _supervise(self):
+        while self.connected:
+            try:
+                await asyncio.wait_for(self._link_lost.wait(), self.health_interval)
+            except asyncio.TimeoutError:
+                res = await self.request(GET_STATUS, {"user_name": self.user_name}, timeout=self.health_interval)
+                if res.code not in (TIMEOUT, ERROR_TWITCH_API_NOT_CONNECTED):
+                    continue
+            if self.connected:
+                await self._reconnect()
+
+    async def _reconnect(self):
+        since = time.time()
+        self._logger.warning("Lost the connection to the server, reconnecting")
+        # Calls waiting on the old connection never get a reply
+        for request_uuid, future in self._pending.items():
+            if not future.done():
+                future.set_result(Message(uuid=request_uuid, code=TIMEOUT, data={}))
+
+        backoff = Backoff(self._backoff_base, self._backoff_cap)
+        while self.connected:
+            try:
+                await self.ws.disconnect()
+            except Exception:
+                pass
+            self.ws = self._client_factory(self.url, self._log_level)
+            try:
+                if await self._open(self.user_name):
+                    break
+            except Exception as e:
+                self._logger.error(f"Reconnecting failed: {e}")
+            delay = backoff.next()
+            self._logger.warning(f"Reconnecting again in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        else:
+            return
+
+        self._link_lost.clear()
+        self.reconnects += 1
+        if self.resumed and not self.last_missed:
+            self._logger.info("Reconnected without losing events")
+            return
+        self._add_gap({
+            "since": since,
+            "until": time.time(),
+            "reason": "server_reconnect",
+            "resumed": self.resumed,
+            "missed": self.last_missed
+        })
 
     async def disconnect(self):
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            self._supervisor = None
         if self.connected:
             await self.stop_twitch_api()
             await self.ws.disconnect()
             self.connected = False
+        for future in self._pending.values():
+            if not future.done():
+                future.cancel()
+        self._pending.clear()
+        for stream in list(self._streams):
+            stream.close()
+
+    def events(self, types: List[str] = EVENT_TYPES, queue_size: int = 1000) -> EventStream:
+        # async for event in client.events(["chat"]): ...
+        # Only events received after this call are delivered, close the stream or leave
+        # its async with block to stop receiving.
+        stream = EventStream(types, queue_size, on_close=self._streams.discard)
+        self._streams.add(stream)
+        return stream
+
+    def batches(self, types: List[str] = EVENT_TYPES, max_size: int = 100, max_wait: float = 0.05, queue_size: int = 1000) -> BatchStream:
+        # async for batch in client.batches(max_size=50, max_wait=0.1): ...
+        stream = BatchStream(types, max_size, max_wait, queue_size, on_close=self._streams.discard)
+        self._streams.add(stream)
+        return stream
+
+    async def request(self, code: str, data: Dict, timeout: float = None) -> Message:
+        # Sends without waiting for earlier calls, at most max_in_flight are outstanding.
+        # Returns the reply, or a Message with the TIMEOUT code when none came in time.
+        async with self._in_flight:
+            msg = Message(uuid=int(uuid.uuid4()), code=code, data=data)
+            future = asyncio.get_running_loop().create_future()
+            self._pending[msg.uuid] = future
+            try:
+                try:
+                    await self.ws.send_msg(msg)
+                except Exception as e:
+                    # Dead connection, the supervisor opens a new one
+                    self._logger.error(f"Could not send {code}: {e}")
+                    self._link_lost.set()
+                    return Message(uuid=msg.uuid, code=TIMEOUT, data={})
+                return await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+            except asyncio.TimeoutError:
+                self._logger.error(f"{code} timed out")
+                return Message(uuid=msg.uuid, code=TIMEOUT, data={})
+            finally:
+                self._pending.pop(msg.uuid, None)
+
+    async def batch(self, requests: List[tuple], parallel: bool = False, timeout: float = None) -> List[Message]:
+        # Sends (code, data) pairs in one frame and returns their replies in the same order.
+        # The server runs them one after another unless parallel is set.
+        items = [{"uuid": int(uuid.uuid4()), "code": code, "data": data} for code, data in requests]
+        res = await self.request(BATCH, {"requests": items, "parallel": parallel}, timeout)
+        if self.is_error(res):
+            self._logger.error(f"An error occured: {res.code}")
+            return [Message(uuid=item["uuid"], code=res.code, data=res.data) for item in items]
+        return [Message(uuid=reply["uuid"], code=reply["code"], data=reply["data"]) for reply in res.data["responses"]]
+
+    async def handle_response(self, msg: Message):
+        future = self._pending.get(msg.uuid)
+        if future is not None and not future.done():
+            future.set_result(msg)
+        elif msg.code in (ERROR_TWITCH, ERROR_TWITCH_API_NOT_CONNECTED):
+            await self.handle_error(msg)
 
     async def start_twitch_api(self, token, user_name) -> bool:
-        msg = Message(uuid=int(uuid.uuid4()), code=START_TWITCH_API, data={"token": token, "user_name": user_name})
-        res = await self.ws.send_msg(msg, blocking=True)
+        self.user_name = user_name
+        res = await self.request(START_TWITCH_API, {"token": token, "user_name": user_name})
         if self.is_error(res):
             self._logger.error(f"An error occured: {res.code}")
             return False
@@ -47,8 +336,7 @@ class TwitchClient:
             return True
 
     async def stop_twitch_api(self) -> bool:
-        msg = Message(uuid=int(uuid.uuid4()),  code=STOP_TWITCH_API, data={})
-        res = await self.ws.send_msg(msg, blocking=True)
+        res = await self.request(STOP_TWITCH_API, {"user_name": self.user_name})
         if self.is_error(res):
             self._logger.error(f"An error occured: {res.code}")
             return False
@@ -56,35 +344,81 @@ class TwitchClient:
             return True
 
     async def get_status(self) -> bool:
-        msg = Message(code=GET_STATUS)
-        res = await self.ws.send_msg(msg, blocking=True)
+        res = await self.request(GET_STATUS, {"user_name": self.user_name})
         if self.is_error(res):
             self._logger.error(f"An error occured: {res.code}")
             return False
         else:
             return True
 
+    async def get_stats(self) -> Dict | None:
+        # Chat velocity, unique and top chatters, bits and subs over the server's stats window
+        res = await self.request(GET_STATS, {"user_name": self.user_name})
+        if self.is_error(res):
+            self._logger.error(f"An error occured: {res.code}")
+            return None
+        else:
+            return res.data
+
     async def set_channels(self, channels: List[str]) -> bool:
-        msg = Message(code=SET_CHANNELS, data={"channels": channels})
-        res = await self.ws.send_msg(msg, blocking=True)
+        res = await self.request(SET_CHANNELS, {"user_name": self.user_name, "channels": channels})
         if self.is_error(res):
             self._logger.error(f"An error occured: {res.code}")
             return False
         else:
+            self.channels = list(channels)
             return True
 
     async def update_stream(self, title: str, tags: List[str], ccl: CCL, game_id: str) -> bool:
-        msg = Message(code=UPDATE_STREAM, data={
+        # Only the fields that changed are sent to Twitch, updates close together are merged
+        res = await self.request(UPDATE_STREAM, {
+            "user_name": self.user_name,
             "title": title,
             "tags": tags,
             "ccl": ccl.to_dict(),
             "game_id": game_id
         })
-        res = await self.ws.send_msg(msg, blocking=True)
         if self.is_error(res):
             self._logger.error(f"An error occured: {res.code}")
             return False
         else:
+            self._stream_info = (title, tags, ccl, game_id)
+            return True
+
+    async def subscribe(self, cursor: Dict | None = None) -> bool:
+        res = await self.request(SUBSCRIBE, {
+            "user_name": self.user_name,
+            "cursor": cursor,
+            "encoding": self.encoding,
+            "lanes": self.lanes,
+            "channels": self.chat_channels
+        })
+        if self.is_error(res):
+            self._logger.error(f"An error occured: {res.code}")
+            return False
+        else:
+            self.resumed = res.data.get("resumed", False)
+            missed = res.data.get("missed", 0)
+            self.last_missed = missed
+            if missed:
+                self.missed += missed
+                self._logger.warning(f"Missed {missed} messages while disconnected")
+            return True
+
+    async def set_chat_channels(self, channels: List[str] | None) -> bool:
+        # Subscribes again without a cursor, the server continues from where this connection is.
+        # Channels that were out of scope start at their newest message.
+        self.chat_channels = None if channels is None else list(channels)
+        return await self.subscribe()
+
+    async def set_filter(self, **options) -> bool:
+        # No options turns the filter off, see ChatPipeline for what can be set
+        res = await self.request(SET_FILTER, {"user_name": self.user_name, "filter": options})
+        if self.is_error(res):
+            self._logger.error(f"An error occured: {res.code}")
+            return False
+        else:
+            self._filter = options
             return True
 
     @staticmethod
@@ -95,9 +429,10 @@ class TwitchClient:
             return False
 
     async def handle_new_messages(self, msg: Message):
-        chat_messages = msg.data.get("chat", [])
-        cheers = msg.data.get("cheers", [])
-        subs = msg.data.get("subs", [])
+        chat_messages = decode_events(msg.data.get("chat", []))
+        cheers = decode_events(msg.data.get("cheers", []))
+        subs = decode_events(msg.data.get("subs", []))
+        self.cursor = msg.data.get("cursor", self.cursor)
 
         for chat_msg in chat_messages:
             self.chat_messages.append(chat_msg)
@@ -107,7 +442,29 @@ class TwitchClient:
 
         for sub in subs:
             self.subs.append(sub)
+
+        if self._streams:
+            for kind, items in (("chat", chat_messages), ("cheers", cheers), ("subs", subs)):
+                streams = [stream for stream in self._streams if kind in stream.types]
+                for data in items:
+                    event = StreamEvent(kind, data)
+                    for stream in streams:
+                        stream.push(event)
     
+    async def handle_gap(self, msg: Message):
+        # Frames the server dropped because this client was too slow come with a count
+        missed = msg.data.get("missed", 0)
+        if missed:
+            self.missed += missed
+        self._add_gap(msg.data)
+
+    def _add_gap(self, gap: Dict):
+        self.gaps.append(gap)
+        self._logger.warning(f"Events of {gap.get('until', 0) - gap.get('since', 0):.1f}s were lost ({gap.get('reason')})")
+        event = StreamEvent("gap", gap)
+        for stream in list(self._streams):
+            stream.push(event)
+
     def get_newest_messages(self):
         return {
             "chat": self.chat_messages.get_all(clear=True),
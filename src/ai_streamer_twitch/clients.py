@@ -0,0 +1,207 @@
+import time
+import json
+import asyncio
+import logging
+from collections import deque
+
+from websockets.exceptions import ConnectionClosed
+
+from .codec import JSON
+from .metrics import REGISTRY
+from .utils import setup_logger
+
+EVENT_KINDS = ("chat", "cheers", "subs")
+
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+
+OVERFLOW_POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+class BatchConnection():
+    # Stands in for a connection while the requests of one Batch run. Replies to those
+    # requests are collected instead of sent, everything else goes straight through.
+    # It hashes and compares like the connection, so a handler that registers it
+    # (subscribe, start) registers the real connection.
+    def __init__(self, ws, uuids) -> None:
+        self.ws = ws
+        self._uuids = set(uuids)
+        self.replies = {}
+
+    def __hash__(self) -> int:
+        return hash(self.ws)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, BatchConnection):
+            return other.ws == self.ws
+        return other == self.ws
+
+    def __getattr__(self, name):
+        return getattr(self.ws, name)
+
+    async def send(self, frame: str):
+        if self._uuids:
+            reply = json.loads(frame)
+            if reply.get("uuid") in self._uuids:
+                self._uuids.discard(reply["uuid"])
+                self.replies[reply["uuid"]] = reply
+                return
+        await self.ws.send(frame)
+
+class ClientState():
+    # Everything the service keeps for one connection that receives NewMessages.
+    # Frames go through a bounded queue with its own writer task, so a slow
+    # connection only delays itself.
+    def __init__(self, ws, encoding: str = JSON, queue_size: int = 64, overflow: str = DROP_OLDEST,
+                 on_close=None, rebuild=None, gap_frame=None, log_level=logging.DEBUG) -> None:
+        self.ws = ws
+        self.encoding = encoding
+        # Subscribed sessions (user name of the API) mapped to the cursor into that API's buffers
+        self.cursors = {}
+        # Event kinds this connection wants, set through the lanes it subscribed to
+        self.kinds = EVENT_KINDS
+        # Channels it wants chat from, None for every channel of the session
+        self.channels = None
+
+        self._queue = deque()
+        self._queue_size = queue_size
+        self._overflow = overflow
+        self._wakeup = asyncio.Event()
+        self._writer = None
+        self.closed = False
+        # Events of dropped frames per session, (count, time of the first drop). The client is told
+        # with a gap frame before the next frame of that session.
+        self._lost = {}
+
+        self._logger, _ = setup_logger("Clients", log_level)
+
+        # Called with the ws when the connection is gone
+        self._on_close = on_close
+        # Called with (session, cursor, encoding, kinds, channels) to build one frame from cursor for the coalesce policy
+        self._rebuild = rebuild
+        # Called with (session, gap) to build the frame that tells about a gap
+        self._gap_frame = gap_frame
+
+        self.sent_frames = 0
+        self.dropped_frames = 0
+        self.missed_events = 0
+        self.coalesced_frames = 0
+        self.last_send_latency = 0.0
+        self.max_send_latency = 0.0
+        self.last_lag = 0.0
+
+        self._send_seconds = REGISTRY.histogram("client_send_seconds", "Time to write one frame to a client").labels()
+        self._lag_seconds = REGISTRY.histogram("client_lag_seconds", "Time between queueing a frame and writing it").labels()
+
+    def enqueue(self, key: str, frame: str, start_cursor: dict, next_cursor: dict, events: int = 0):
+        # The cursor moves when the frame is queued, the queue holds what is in flight.
+        # events is the number of events in the frame, counted as missed if it is dropped.
+        if self.closed:
+            return
+        if key in self.cursors:
+            self.cursors[key] = next_cursor
+
+        if len(self._queue) >= self._queue_size:
+            if self._overflow == DISCONNECT:
+                self._close()
+                return
+            if self._overflow == COALESCE and self._rebuild is not None:
+                self._coalesce(key, start_cursor)
+                self._start_writer()
+                return
+            self._drop_oldest()
+
+        self._queue.append((key, frame, start_cursor, time.perf_counter(), events))
+        self._start_writer()
+
+    def _drop_oldest(self):
+        key, _, _, _, events = self._queue.popleft()
+        self.dropped_frames += 1
+        self.missed_events += events
+        if events and self._gap_frame is not None:
+            count, since = self._lost.get(key, (0, time.time()))
+            self._lost[key] = (count + events, since)
+
+    def _coalesce(self, key: str, start_cursor: dict):
+        # The new frame and every queued frame of the same session become one frame,
+        # read again from the oldest cursor that was not delivered yet
+        queued = [item for item in self._queue if item[0] == key]
+        if queued:
+            start_cursor = queued[0][2]
+            self._queue = deque(item for item in self._queue if item[0] != key)
+            self.coalesced_frames += len(queued)
+        else:
+            self._drop_oldest()
+
+        frame, next_cursor, _, events = self._rebuild(key, start_cursor, self.encoding, self.kinds, self.channels)
+        if key in self.cursors:
+            self.cursors[key] = next_cursor
+        if frame is not None:
+            self._queue.append((key, frame, start_cursor, time.perf_counter(), events))
+
+    def _start_writer(self):
+        self._wakeup.set()
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write_loop())
+
+    async def _write_loop(self):
+        while not self.closed:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            key, frame, _, queued_at, _ = self._queue.popleft()
+            start = time.perf_counter()
+            try:
+                if key in self._lost:
+                    await self.ws.send(self._overflow_gap(key))
+                await self.ws.send(frame)
+            except ConnectionClosed:
+                self._close()
+                return
+            except Exception as e:
+                # A writer that died would leave the client subscribed without anything being sent
+                self._logger.error(f"Writing to a client failed, closing it: {e}")
+                self._close()
+                return
+            end = time.perf_counter()
+
+            self.sent_frames += 1
+            self.last_send_latency = end - start
+            self.max_send_latency = max(self.max_send_latency, self.last_send_latency)
+            self.last_lag = end - queued_at
+            self._send_seconds.observe(self.last_send_latency)
+            self._lag_seconds.observe(self.last_lag)
+
+    def _overflow_gap(self, key: str) -> str:
+        count, since = self._lost.pop(key)
+        return self._gap_frame(key, {"since": since, "until": time.time(), "reason": "client_overflow", "missed": count})
+
+    def _close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        asyncio.create_task(self.ws.close())
+        if self._on_close is not None:
+            self._on_close(self.ws)
+
+    async def close(self):
+        self.closed = True
+        if self._writer is not None:
+            self._writer.cancel()
+
+    def get_stats(self) -> dict:
+        return {
+            "queued_frames": len(self._queue),
+            "sent_frames": self.sent_frames,
+            "dropped_frames": self.dropped_frames,
+            "missed_events": self.missed_events,
+            "coalesced_frames": self.coalesced_frames,
+            "last_send_latency": self.last_send_latency,
+            "max_send_latency": self.max_send_latency,
+            "lag": self.last_lag
+        }
@@ -0,0 +1,38 @@
+import json
+from operator import attrgetter
+
+from .models import serialize_events
+
+JSON = "json"
+COLUMNAR = "columnar"
+
+ENCODINGS = (JSON, COLUMNAR)
+
+def encode_events(events: list, encoding: str = JSON):
+    # Columnar sends the field names once per batch followed by one array per field
+    if encoding == COLUMNAR and events:
+        fields = type(events[0]).FIELDS
+        rows = map(attrgetter(*fields), events)
+        return {"fields": list(fields), "columns": [list(column) for column in zip(*rows)]}
+    return serialize_events(events)
+
+def encode_events_json(events: list) -> str:
+    # Same as serialize_events, but joins the cached encoding of every event
+    return "[" + ",".join([event.to_json() for event in events]) + "]"
+
+def placeholder(kind: str) -> str:
+    # Stands in for an encoded batch until the frame is serialized. The NUL makes it
+    # something no user name or cursor value can be, json always escapes it to \u0000.
+    return f"\x00{kind}"
+
+def splice_fragments(frame: str, fragments: dict) -> str:
+    # Replaces the quoted placeholder of every kind with its pre-encoded batch
+    for kind, fragment in fragments.items():
+        frame = frame.replace(json.dumps(placeholder(kind)), fragment, 1)
+    return frame
+
+def decode_events(data) -> list[dict]:
+    if isinstance(data, dict):
+        fields = data["fields"]
+        return [dict(zip(fields, row)) for row in zip(*data["columns"])]
+    return data
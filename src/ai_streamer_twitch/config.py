@@ -2,6 +2,7 @@ import toml
 
 class ServerConfig():
     def __init__(self, config_path: str) -> None:
+        self.path = config_path
         self._config = toml.load(config_path)
 
         self.ws_port = self._config["ws"]["port"]
@@ -10,10 +11,77 @@ class ServerConfig():
         self.twitch_secret = self._config["twitch"]["secret"]
         self.twitch_id = self._config["twitch"]["id"]
         self.twitch_update_delay = self._config["twitch"]["update_delay"]
+        # "interval" sends a frame every update_delay, "push" sends as soon as events arrive
+        self.twitch_delivery = self._config["twitch"].get("delivery", "interval")
+        self.twitch_max_latency = self._config["twitch"].get("max_latency", 0.02)
+        self.twitch_max_batch = self._config["twitch"].get("max_batch", 500)
+        # Subs and cheers use their own lane, by default they are sent on the next loop iteration
+        self.twitch_priority_max_latency = self._config["twitch"].get("priority_max_latency", 0)
 
+        # Chat buffers are per channel, this is the size of each unless it is set for the channel
         self.twitch_chat_buffer_size = self._config["buffers"]["chat"]
+        self.twitch_chat_channel_buffer_sizes = {
+            channel.lower(): size for channel, size in self._config["buffers"].get("channels", {}).items()
+        }
+        # At most this many channels get a chat buffer, chat of further channels is dropped
+        self.twitch_chat_max_channels = self._config["buffers"].get("max_channels", 500)
         self.twitch_sub_buffer_size = self._config["buffers"]["sub"]
         self.twitch_cheer_buffer_size = self._config["buffers"]["cheer"]
+
+        # Default chat filter for new sessions, see ChatPipeline for the options
+        self.chat_filter = self._config.get("filter")
+
+        log = self._config.get("log", {})
+        self.log_enabled = log.get("enabled", False)
+        self.log_directory = log.get("directory", "logs")
+        self.log_segment_size = log.get("segment_size", 64 * 1024 * 1024)
+        self.log_flush_interval = log.get("flush_interval", 0.5)
+
+        clients = self._config.get("clients", {})
+        self.client_queue_size = clients.get("queue_size", 64)
+        self.client_overflow = clients.get("overflow", "drop_oldest")
+
+        metrics = self._config.get("metrics", {})
+        self.metrics_prometheus = metrics.get("prometheus", False)
+        self.metrics_host = metrics.get("host", "127.0.0.1")
+        self.metrics_port = metrics.get("port", 9100)
+
+        helix = self._config.get("helix", {})
+        self.helix_cache_size = helix.get("cache_size", 10000)
+        self.helix_cache_ttl = helix.get("cache_ttl", 3600)
+
+        metadata = self._config.get("metadata", {})
+        # Stream updates within this many seconds are merged into one Helix request
+        self.metadata_debounce = metadata.get("debounce", 0.5)
+        # Seconds the channel info Helix accepted is trusted before it is fetched again
+        self.metadata_max_age = metadata.get("max_age", 60)
+
+        stats = self._config.get("stats", {})
+        # Sliding window aggregates per session, served by GetStats
+        self.stats_enabled = stats.get("enabled", True)
+        self.stats_window = stats.get("window", 60)
+        self.stats_top = stats.get("top", 10)
+
+        shards = self._config.get("shards", {})
+        # 0 runs every session in this process, otherwise sessions are spread over this many workers
+        self.shard_workers = shards.get("workers", 0)
+        self.shard_batch_latency = shards.get("batch_latency", 0.005)
+
+        channels = self._config.get("channels", {})
+        # Twitch allows 20 JOINs per 10 seconds per account, verified bots more
+        self.channel_join_rate = channels.get("join_rate", 20)
+        self.channel_join_period = channels.get("join_period", 10)
+        self.channel_join_attempts = channels.get("join_attempts", 3)
+
+        sessions = self._config.get("sessions", {})
+        # Seconds a session keeps running after its last client disconnected, negative keeps it forever
+        self.session_idle_timeout = sessions.get("idle_timeout", 300)
+
+        health = self._config.get("health", {})
+        # Twitch connections are checked every interval seconds and restarted after this many failed checks
+        self.health_interval = health.get("interval", 5)
+        self.health_unhealthy_checks = health.get("unhealthy_checks", 2)
+        self.health_backoff_cap = health.get("backoff_cap", 30)
         
 class APIConfig():
     def __init__(self, user_token: str, user_id: int, user_name: str, server_config: ServerConfig) -> None:
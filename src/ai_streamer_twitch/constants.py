@@ -3,11 +3,18 @@ STOP_TWITCH_API = "StopTwitchAPI"
 
 GET_STATUS = "GetStatus"
 GET_ID_FROM_USER = "GetIdFromUser"
+GET_METRICS = "GetMetrics"
+GET_STATS = "GetStats"
 
 SET_CHANNELS = "SetChannels"
 UPDATE_STREAM = "UpdateStream"
+SET_FILTER = "SetFilter"
 
 NEW_MESSAGES = "NewMessages"
+SUBSCRIBE = "Subscribe"
+REPLAY_LOG = "ReplayLog"
+BATCH = "Batch"
+STREAM_GAP = "StreamGap"
 
 ERROR_TWITCH_API_NOT_CONNECTED = "ErrorTwitchAPINotConnected"
 
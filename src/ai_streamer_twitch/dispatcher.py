@@ -0,0 +1,59 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from .utils import setup_logger
+
+class EventDispatcher():
+    # Wakes up on new events and coalesces them into one flush.
+    # A flush happens at most max_latency seconds after the first pending event,
+    # or right away once max_batch events are pending.
+    def __init__(self, flush: Callable[[], Awaitable[None]], max_latency: float = 0.02, max_batch: int = 500,
+                 name: str = "Dispatcher", log_level=logging.DEBUG) -> None:
+        self._flush = flush
+        self._max_latency = max_latency
+        self._max_batch = max_batch
+
+        self._pending = 0
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task = None
+
+        self._logger, _ = setup_logger(name, log_level)
+
+    def notify(self, count: int = 1):
+        self._pending += count
+        self._wakeup.set()
+        if self._pending >= self._max_batch:
+            self._full.set()
+
+    async def run(self):
+        while True:
+            await self._wakeup.wait()
+            if self._pending < self._max_batch:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self._max_latency)
+                except asyncio.TimeoutError:
+                    pass
+
+            self._wakeup.clear()
+            self._full.clear()
+            self._pending = 0
+            # A failed flush must not stop delivery, the events stay buffered for the next one
+            try:
+                await self._flush()
+            except Exception as e:
+                self._logger.error(f"Flush failed: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,201 @@
+import os
+import json
+import mmap
+import time
+import struct
+import asyncio
+from bisect import bisect_right
+from pathlib import Path
+
+from .models import ChatMessage, SubMessage, CheerMessage
+
+# Record layout: payload length, log sequence number, event timestamp, event kind, then the JSON payload
+HEADER = struct.Struct("<IqdB")
+
+KINDS = ("chat", "subs", "cheers")
+KIND_IDS = {kind: i for i, kind in enumerate(KINDS)}
+MODELS = {"chat": ChatMessage, "subs": SubMessage, "cheers": CheerMessage}
+
+# Every this many records the segment index gets an entry
+INDEX_INTERVAL = 64
+
+class Segment():
+    def __init__(self, path: Path, first_seq: int) -> None:
+        self.path = path
+        self.first_seq = first_seq
+        self.size = 0
+        self.count = 0
+        # Sparse index, parallel lists of (seq, timestamp, offset)
+        self.index_seq = []
+        self.index_ts = []
+        self.index_offset = []
+
+    def add_to_index(self, seq: int, timestamp: float, offset: int):
+        if self.count % INDEX_INTERVAL == 0:
+            self.index_seq.append(seq)
+            self.index_ts.append(timestamp)
+            self.index_offset.append(offset)
+        self.count += 1
+
+    def scan(self, repair: bool = True):
+        # Rebuilds size and index of an existing segment, a torn last record is cut off.
+        # Without repair the file is only read and the torn record is just skipped.
+        with open(self.path, "r+b" if repair else "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offset = 0
+                while offset + HEADER.size <= size:
+                    length, seq, timestamp, _ = HEADER.unpack_from(data, offset)
+                    if offset + HEADER.size + length > size:
+                        break
+                    self.add_to_index(seq, timestamp, offset)
+                    offset += HEADER.size + length
+            if offset != size and repair:
+                f.truncate(offset)
+            self.size = offset
+
+    def start_offset(self, seq: int = None, timestamp: float = None) -> int:
+        if seq is not None:
+            i = bisect_right(self.index_seq, seq) - 1
+        elif timestamp is not None:
+            i = bisect_right(self.index_ts, timestamp) - 1
+        else:
+            i = 0
+        return self.index_offset[max(i, 0)] if self.index_offset else 0
+
+    def read(self, seq: int = None, timestamp: float = None, end: int = None):
+        # Yields (seq, timestamp, kind, data) from the memory mapped segment
+        end = self.size if end is None else end
+        if end == 0:
+            return
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = self.start_offset(seq, timestamp)
+            while offset < end:
+                length, record_seq, record_ts, kind = HEADER.unpack_from(data, offset)
+                start = offset + HEADER.size
+                offset = start + length
+                if seq is not None and record_seq < seq:
+                    continue
+                if timestamp is not None and record_ts < timestamp:
+                    continue
+                yield record_seq, record_ts, KINDS[kind], json.loads(data[start:offset])
+
+class EventLog():
+    # Append only log of serialized events split into segments of about segment_size bytes.
+    # append() only buffers, flush() writes the pending records in one write without fsync.
+    # A read_only log never creates, repairs or writes a file, replays open logs that way.
+    def __init__(self, directory: str, segment_size: int = 64 * 1024 * 1024, read_only: bool = False) -> None:
+        self._directory = Path(directory)
+        self._read_only = read_only
+        if not read_only:
+            self._directory.mkdir(parents=True, exist_ok=True)
+        self._segment_size = segment_size
+
+        self._segments = []
+        for path in sorted(self._directory.glob("*.log")):
+            # Segments are named after their first sequence number, anything else is not ours
+            if not path.stem.isdigit():
+                continue
+            segment = Segment(path, int(path.stem))
+            segment.scan(repair=not read_only)
+            self._segments.append(segment)
+
+        self._next_seq = 0
+        if self._segments:
+            last = self._segments[-1]
+            self._next_seq = last.first_seq + last.count
+
+        self._pending = []
+        self._file = None
+
+    @property
+    def next_seq(self) -> int:
+        return self._next_seq
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def append(self, kind: str, event) -> int:
+        if self._read_only:
+            raise ValueError(f"Event log {self._directory} is read only")
+        seq = self._next_seq
+        self._next_seq += 1
+        # The cached encoding, frames reuse it and so do records
+        self._pending.append((seq, event.timestamp, KIND_IDS[kind], event.to_json()))
+        return seq
+
+    def _new_segment(self, first_seq: int) -> Segment:
+        if self._file is not None:
+            self._file.close()
+        segment = Segment(self._directory / f"{first_seq:020d}.log", first_seq)
+        self._segments.append(segment)
+        self._file = open(segment.path, "ab")
+        return segment
+
+    def flush(self):
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = []
+
+        segment = self._segments[-1] if self._segments else None
+        if segment is None or segment.size >= self._segment_size:
+            segment = self._new_segment(pending[0][0])
+        elif self._file is None:
+            self._file = open(segment.path, "ab")
+
+        chunks = []
+        for seq, timestamp, kind, text in pending:
+            payload = text.encode()
+            segment.add_to_index(seq, timestamp, segment.size)
+            chunks.append(HEADER.pack(len(payload), seq, timestamp, kind))
+            chunks.append(payload)
+            segment.size += HEADER.size + len(payload)
+
+            if segment.size >= self._segment_size:
+                self._file.write(b"".join(chunks))
+                chunks = []
+                segment = self._new_segment(seq + 1)
+        if chunks:
+            self._file.write(b"".join(chunks))
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        # Drop a segment that rotation opened but never wrote to
+        if not self._read_only and self._segments and self._segments[-1].size == 0:
+            self._segments.pop().path.unlink(missing_ok=True)
+
+    def read(self, seq: int = None, timestamp: float = None):
+        # Flushed records from seq or timestamp onward, in log order
+        self.flush()
+        for i, segment in enumerate(self._segments):
+            following = self._segments[i + 1] if i + 1 < len(self._segments) else None
+            if following is not None and following.count:
+                if seq is not None and following.first_seq <= seq:
+                    continue
+                if timestamp is not None and following.index_ts[0] <= timestamp:
+                    continue
+            yield from segment.read(seq, timestamp, end=segment.size)
+
+async def replay(log: EventLog, api, speed: float = 1.0, seq: int = None, timestamp: float = None):
+    # Feeds logged events back into an API so they go through the normal broadcast path.
+    # speed 1 keeps the original timing, 0 replays as fast as possible.
+    first_ts = None
+    started = time.monotonic()
+    for count, (_, record_ts, kind, data) in enumerate(log.read(seq, timestamp)):
+        if speed > 0:
+            if first_ts is None:
+                first_ts = record_ts
+            delay = (record_ts - first_ts) / speed - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif count % 1000 == 0:
+            await asyncio.sleep(0)
+        api.add_event(kind, MODELS[kind].from_dict(data))
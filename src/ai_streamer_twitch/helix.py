@@ -0,0 +1,218 @@
+import time
+import asyncio
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+from .metrics import REGISTRY
+from .scheduler import RequestScheduler, RetryableError, RateLimitBucket, PRIORITY_NORMAL
+
+# aiohttp is the slowest import of the service, it is loaded with the first request
+if TYPE_CHECKING:
+    import aiohttp
+
+TOKEN_URL = 'https://id.twitch.tv/oauth2/token'
+HELIX_URL = 'https://api.twitch.tv/helix'
+GRANT_TYPE = 'client_credentials'
+
+# Helix accepts at most this many login or id parameters on /users
+MAX_USERS_PER_REQUEST = 100
+# Refresh the app token this many seconds before it really expires
+TOKEN_REFRESH_MARGIN = 60
+
+class HelixError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(f"Helix request failed ({status}): {message}")
+        self.status = status
+        self.message = message
+
+async def _read_json(response: "aiohttp.ClientResponse") -> dict | None:
+    # Error pages of proxies and load balancers are not always JSON, or not an object
+    try:
+        data = await response.json(content_type=None)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+def _error_message(data: dict | None, default: str) -> str:
+    return default if data is None else str(data.get("message", default))
+
+class TTLCache():
+    # LRU cache where entries also expire after ttl seconds
+    def __init__(self, max_size: int = 10000, ttl: float = 3600) -> None:
+        self._data = OrderedDict()
+        self._max_size = max_size
+        self._ttl = ttl
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self._ttl)
+        self._data.move_to_end(key)
+        if len(self._data) > self._max_size:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+class HelixClient():
+    # Long lived Helix client, one pooled session and one cached app access token
+    def __init__(self, client_id: str, client_secret: str, cache_size: int = 10000, cache_ttl: float = 3600,
+                 helix_url: str = HELIX_URL, token_url: str = TOKEN_URL, scheduler: RequestScheduler = None) -> None:
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._helix_url = helix_url
+        self._token_url = token_url
+
+        self._session = None
+        self._token = None
+        self._token_expires = 0
+        self._token_lock = asyncio.Lock()
+
+        # Users are cached by login and by id, both hold {"id", "login", "display_name"}
+        self._users_by_login = TTLCache(cache_size, cache_ttl)
+        self._users_by_id = TTLCache(cache_size, cache_ttl)
+
+        # Queues every request behind the rate limit bucket of its token
+        self._scheduler = scheduler if scheduler is not None else RequestScheduler()
+
+        self._request_seconds = REGISTRY.histogram("helix_request_seconds", "Latency of Helix requests", ("method", "path"))
+
+    def _get_session(self) -> "aiohttp.ClientSession":
+        if self._session is None or self._session.closed:
+            import aiohttp
+
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def close(self):
+        await self._scheduler.close()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _app_token(self, force_refresh=False) -> str:
+        async with self._token_lock:
+            if not force_refresh and self._token is not None and time.monotonic() < self._token_expires:
+                return self._token
+
+            payload = {
+                'client_id': self._client_id,
+                'client_secret': self._client_secret,
+                'grant_type': GRANT_TYPE,
+            }
+            async with self._get_session().post(self._token_url, data=payload) as response:
+                data = await _read_json(response)
+                if response.status != 200 or data is None or "access_token" not in data:
+                    raise HelixError(response.status, _error_message(data, "could not get app access token"))
+
+            self._token = data['access_token']
+            self._token_expires = time.monotonic() + data.get("expires_in", 3600) - TOKEN_REFRESH_MARGIN
+            return self._token
+
+    @staticmethod
+    def _bucket_key(user_token: str = None) -> str:
+        return "app" if user_token is None else f"user:{user_token}"
+
+    def get_bucket(self, user_token: str = None) -> RateLimitBucket:
+        return self._scheduler.get_bucket(self._bucket_key(user_token))
+
+    def get_scheduler(self) -> RequestScheduler:
+        return self._scheduler
+
+    def close_bucket(self, user_token: str):
+        # Drops the lane of a user token that is not used anymore, its queued requests are cancelled
+        self._scheduler.remove_lane(self._bucket_key(user_token))
+
+    async def request(self, method: str, path: str, params=None, json=None, user_token: str = None,
+                      priority: int = PRIORITY_NORMAL, tenant: str = "service") -> dict:
+        # Uses the app token unless a user token is given. The request waits in the scheduler
+        # for its token's rate limit bucket, tenant is the session it is sent for.
+        bucket = self._bucket_key(user_token)
+        return await self._scheduler.submit(
+            lambda: self._send(method, path, params, json, user_token, bucket),
+            bucket=bucket,
+            tenant=tenant,
+            priority=priority
+        )
+
+    async def _send(self, method: str, path: str, params, json, user_token: str, bucket: str) -> dict:
+        # One attempt, an expired app token is refreshed once. Rate limits, server errors
+        # and connection problems raise RetryableError so the scheduler backs off and retries.
+        import aiohttp
+        for refresh in (False, True):
+            token = user_token if user_token is not None else await self._app_token(force_refresh=refresh)
+            headers = {
+                'Authorization': f'Bearer {token}',
+                'Client-Id': self._client_id,
+            }
+            start = time.perf_counter()
+            try:
+                async with self._get_session().request(method, self._helix_url + path, params=params, json=json, headers=headers) as response:
+                    self._scheduler.get_bucket(bucket).update(response.headers)
+                    if response.status == 401 and user_token is None and not refresh:
+                        continue
+                    if response.status == 429:
+                        reset = response.headers.get("Ratelimit-Reset")
+                        raise RetryableError(f"Rate limited on {method} {path}", after=None if reset is None else max(0, int(reset) - time.time()))
+                    if response.status >= 500:
+                        raise RetryableError(f"Helix returned {response.status} on {method} {path}")
+                    if response.status == 204:
+                        self._request_seconds.labels(method, path).observe(time.perf_counter() - start)
+                        return {}
+                    data = await _read_json(response)
+                    self._request_seconds.labels(method, path).observe(time.perf_counter() - start)
+                    if response.status >= 400:
+                        raise HelixError(response.status, _error_message(data, ""))
+                    if data is None:
+                        raise HelixError(response.status, "response is not a JSON object")
+                    return data
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                raise RetryableError(f"{method} {path} failed: {e}")
+
+    def _cache_user(self, user: dict) -> dict:
+        user = {"id": int(user["id"]), "login": user["login"], "display_name": user["display_name"]}
+        self._users_by_login.set(user["login"], user)
+        self._users_by_id.set(user["id"], user)
+        return user
+
+    async def _fetch_users(self, key: str, values: list, tenant: str) -> None:
+        for i in range(0, len(values), MAX_USERS_PER_REQUEST):
+            chunk = values[i:i + MAX_USERS_PER_REQUEST]
+            data = await self.request("GET", "/users", params=[(key, str(v)) for v in chunk], tenant=tenant)
+            for user in data.get("data", []):
+                self._cache_user(user)
+
+    # tenant is the session a lookup is made for, "service" for lookups of no session
+    async def get_users_by_login(self, logins: list[str], tenant: str = "service") -> dict[str, dict]:
+        logins = [login.lower() for login in logins]
+        missing = list(dict.fromkeys(login for login in logins if self._users_by_login.get(login) is None))
+        if missing:
+            await self._fetch_users("login", missing, tenant)
+        return {login: user for login in logins if (user := self._users_by_login.get(login)) is not None}
+
+    async def get_users_by_id(self, ids: list[int], tenant: str = "service") -> dict[int, dict]:
+        ids = [int(user_id) for user_id in ids]
+        missing = list(dict.fromkeys(user_id for user_id in ids if self._users_by_id.get(user_id) is None))
+        if missing:
+            await self._fetch_users("id", missing, tenant)
+        return {user_id: user for user_id in ids if (user := self._users_by_id.get(user_id)) is not None}
+
+    async def get_user_ids(self, logins: list[str], tenant: str = "service") -> dict[str, int]:
+        users = await self.get_users_by_login(logins, tenant=tenant)
+        return {login: user["id"] for login, user in users.items()}
+
+    async def get_user_id(self, login: str, tenant: str = "service") -> int | None:
+        return (await self.get_user_ids([login], tenant=tenant)).get(login.lower())
+
+    async def get_channel_name(self, user_id: int, tenant: str = "service") -> str | None:
+        user = (await self.get_users_by_id([user_id], tenant=tenant)).get(int(user_id))
+        return None if user is None else user["display_name"]
@@ -0,0 +1,160 @@
+import time
+import asyncio
+import logging
+from typing import TYPE_CHECKING
+
+from .scheduler import PRIORITY_HIGH
+from .models import CCL
+from .utils import setup_logger
+
+if TYPE_CHECKING:
+    from .helix import HelixClient
+
+class StreamMetadata():
+    # Channel info of one broadcaster. Remembers what Helix last accepted and only sends
+    # fields that differ from it. Updates that arrive within debounce seconds of each other
+    # are merged into one PATCH, every caller gets the result of the request it ended up in.
+    # The channel can also be edited on Twitch, so the state is fetched again after max_age seconds.
+    # tenant is the session key the requests are scheduled under.
+    def __init__(self, helix: "HelixClient", broadcaster_id: int, user_token: str, tenant: str, debounce: float = 0.5,
+                 max_age: float = 60, log_level=logging.DEBUG) -> None:
+        self._helix = helix
+        self._broadcaster_id = broadcaster_id
+        self._user_token = user_token
+        self._tenant = tenant
+        self._debounce = debounce
+        self._max_age = max_age
+
+        self._logger, _ = setup_logger("Stream Metadata", log_level)
+
+        # Last state Helix accepted and when it was fetched, None until it was fetched once
+        self._applied = None
+        self._fetched_at = 0
+        self._pending = {}
+        self._waiters = []
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+
+        self.requests_sent = 0
+        self.updates_merged = 0
+
+    @staticmethod
+    def _to_state(title: str = None, tags: list[str] = None, ccl: CCL = None, game_id=None) -> dict:
+        state = {}
+        if title is not None:
+            state["title"] = title
+        if tags is not None:
+            state["tags"] = list(tags)
+        if game_id is not None:
+            state["game_id"] = str(game_id)
+        if ccl is not None:
+            for label in ccl.get_ccls():
+                state[f"ccl:{label['id']}"] = label["is_enabled"]
+        return state
+
+    async def _fetch(self) -> dict:
+        data = await self._helix.request(
+            "GET",
+            "/channels",
+            params={"broadcaster_id": str(self._broadcaster_id)},
+            user_token=self._user_token,
+            priority=PRIORITY_HIGH,
+            tenant=self._tenant
+        )
+        channels = data.get("data", [])
+        if not channels:
+            return {}
+        channel = channels[0]
+        state = {
+            "title": channel.get("title", ""),
+            "tags": list(channel.get("tags", [])),
+            "game_id": str(channel.get("game_id", ""))
+        }
+        # Only the enabled labels are listed
+        enabled = set(channel.get("content_classification_labels", []))
+        for label in CCL().get_ccls():
+            state[f"ccl:{label['id']}"] = label["id"] in enabled
+        return state
+
+    def _diff(self, desired: dict) -> dict:
+        return {field: value for field, value in desired.items() if self._applied.get(field) != value}
+
+    @staticmethod
+    def _to_body(changes: dict) -> dict:
+        body = {}
+        labels = []
+        for field, value in changes.items():
+            if field.startswith("ccl:"):
+                labels.append({"id": field[4:], "is_enabled": value})
+            else:
+                body[field] = value
+        if labels:
+            body["content_classification_labels"] = labels
+        return body
+
+    async def update(self, title: str = None, tags: list[str] = None, ccl: CCL = None, game_id=None) -> list[str]:
+        # Returns the fields that were sent, empty if nothing changed
+        self._pending.update(self._to_state(title, tags, ccl, game_id))
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+        else:
+            self.updates_merged += 1
+        return await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self._debounce)
+        desired, waiters = self._pending, self._waiters
+        self._pending, self._waiters = {}, []
+        self._flush_task = None
+
+        try:
+            # Only one request at a time so updates are applied in order
+            async with self._lock:
+                if self._applied is None or time.monotonic() - self._fetched_at >= self._max_age:
+                    try:
+                        self._applied = await self._fetch()
+                        self._fetched_at = time.monotonic()
+                    except Exception as e:
+                        # Not stamped, the next update tries to fetch again
+                        self._logger.warning(f"Could not fetch channel info, sending every field: {e}")
+                        self._applied = {}
+
+                changes = self._diff(desired)
+                if changes:
+                    await self._helix.request(
+                        "PATCH",
+                        "/channels",
+                        params={"broadcaster_id": str(self._broadcaster_id)},
+                        json=self._to_body(changes),
+                        user_token=self._user_token,
+                        priority=PRIORITY_HIGH,
+                        tenant=self._tenant
+                    )
+                    self.requests_sent += 1
+                    self._applied.update(changes)
+                    self._logger.debug(f"Updated channel info: {list(changes)}")
+
+            fields = sorted({field.split(":")[0] for field in changes})
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(fields)
+        except Exception as e:
+            # A failed PATCH may have been applied in part, the state is fetched again next time
+            self._applied = None
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.cancel()
+        self._waiters = []
+
+    def get_stats(self) -> dict:
+        return {"requests_sent": self.requests_sent, "updates_merged": self.updates_merged, "pending": len(self._waiters)}
@@ -0,0 +1,188 @@
+import math
+from bisect import bisect_left
+from typing import TYPE_CHECKING
+
+# aiohttp is only imported once the Prometheus endpoint is started
+if TYPE_CHECKING:
+    from aiohttp import web
+
+# Seconds
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+class _Value():
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+class _Histogram():
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple) -> None:
+        self.buckets = buckets
+        # Last slot is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metric():
+    # A metric with optional labels, labels() returns a child that should be kept around
+    # by the caller so the hot path only does an attribute update
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._new_child()
+            self._children[values] = child
+        return child
+
+    def remove(self, *values):
+        self._children.pop(values, None)
+
+    def _new_child(self):
+        return _Value()
+
+    def _label_dict(self, values: tuple) -> dict:
+        return dict(zip(self.labelnames, values))
+
+    def to_dict(self) -> list[dict]:
+        return [{"labels": self._label_dict(values), "value": child.value} for values, child in self._children.items()]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value):
+        self.labels().set(value)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _Histogram(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def to_dict(self) -> list[dict]:
+        return [{
+            "labels": self._label_dict(values),
+            "count": child.count,
+            "sum": child.sum,
+            "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], child.counts))
+        } for values, child in self._children.items()]
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    inner = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+    return "{" + inner + "}"
+
+def _format_value(value) -> str:
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Registry():
+    def __init__(self) -> None:
+        self._metrics = {}
+        # Called right before export, used to fill gauges that are cheaper to read than to track
+        self._collectors = []
+
+    def _get_or_create(self, cls, name: str, help: str, labelnames: tuple, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = cls(name, help, labelnames, **kwargs)
+            self._metrics[name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()) -> Counter:
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def gauge(self, name: str, help: str, labelnames: tuple = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labelnames, buckets=buckets)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def remove_collector(self, collector):
+        if collector in self._collectors:
+            self._collectors.remove(collector)
+
+    def collect(self):
+        for collector in self._collectors:
+            collector()
+
+    def to_dict(self) -> dict:
+        self.collect()
+        return {name: {"type": metric.kind, "help": metric.help, "samples": metric.to_dict()} for name, metric in self._metrics.items()}
+
+    def to_prometheus(self) -> str:
+        self.collect()
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for values, child in metric._children.items():
+                labels = metric._label_dict(values)
+                if isinstance(metric, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(list(metric.buckets) + [math.inf], child.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels({**labels, 'le': _format_value(float(bound))})} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(child.sum)}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {child.count}")
+                else:
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(child.value)}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+async def start_prometheus_server(host: str, port: int, registry: Registry = REGISTRY) -> "web.AppRunner":
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=registry.to_prometheus(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner
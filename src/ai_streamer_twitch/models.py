@@ -1,7 +1,32 @@
 import time
-import uuid
-import twitchio
-from twitchio.ext import pubsub
+import json
+import itertools
+from typing import TYPE_CHECKING
+
+# Only needed for type hints, clients that never see a twitchio object should not pay for importing it
+if TYPE_CHECKING:
+    import twitchio
+    from twitchio.ext import pubsub
+
+# Event ids only have to be unique and ordered within a session, a counter seeded with the
+# start time is a lot cheaper than uuid4. The low 8 bits hold the process id, so worker
+# processes that start in the same millisecond still hand out different ids. A restart
+# only keeps ids apart while it sees fewer than one event per millisecond on average.
+# Ids stay below 2 ** 53 so clients that parse json numbers as doubles get them exactly.
+PROCESS_ID_BITS = 8
+MAX_EVENT_ID = 2 ** 53
+_event_ids = itertools.count(time.time_ns() // 1000000)
+_process_id = 0
+
+def set_process_id(process_id: int):
+    # 0 is the front-end, shard workers use their index + 1
+    global _process_id
+    if not 0 <= process_id < 1 << PROCESS_ID_BITS:
+        raise ValueError(f"Process id {process_id} does not fit in {PROCESS_ID_BITS} bits")
+    _process_id = process_id
+
+def next_event_id() -> int:
+    return next(_event_ids) << PROCESS_ID_BITS | _process_id
 
 class CCL():
     def __init__(self, drugs=False,gambling=False,profanity=False,sexual=False,violent=False) -> None:
@@ -38,13 +63,46 @@ class CCL():
             "violent": self._violent
         }
 
-class ChatMessage():
-    def __init__(self, user_name: str, user_id: int, content: str) -> None:
+class Event():
+    # Base of the event models. Events that arrive already encoded, from shard workers, only get
+    # the ROUTING fields and their encoding. The other fields are decoded from it the first time
+    # one is read, which only columnar clients do.
+    ROUTING = ("uuid", "timestamp")
+    __slots__ = ()
+
+    @classmethod
+    def from_encoded(cls, text: str, *routing):
+        obj = cls.__new__(cls)
+        obj._json = text
+        for name, value in zip(cls.ROUTING, routing):
+            setattr(obj, name, value)
+        return obj
+
+    def routing(self) -> list:
+        return [getattr(self, name) for name in self.ROUTING]
+
+    def __getattr__(self, name):
+        # Only reached for fields that were never set
+        if name not in type(self).FIELDS or self._json is None:
+            raise AttributeError(name)
+        for field, value in json.loads(self._json).items():
+            setattr(self, field, value)
+        return object.__getattribute__(self, name)
+
+class ChatMessage(Event):
+    FIELDS = ("user_name", "user_id", "content", "timestamp", "uuid", "channel")
+    ROUTING = ("uuid", "timestamp", "channel")
+    __slots__ = FIELDS + ("_json",)
+
+    def __init__(self, user_name: str, user_id: int, content: str, channel: str = None) -> None:
         self.user_name = user_name
         self.user_id = user_id
         self.content = content
+        # Lower case name of the channel it was sent in
+        self.channel = channel
         self.timestamp = time.time()
-        self.uuid = str(uuid.uuid4())
+        self.uuid = next_event_id()
+        self._json = None
 
     def to_dict(self) -> dict:
         return {
@@ -53,29 +111,45 @@ class ChatMessage():
                 "content": self.content,
                 "timestamp": self.timestamp,
                 "uuid": self.uuid,
+                "channel": self.channel,
         }
 
+    def __repr__(self) -> str:
+        return f"ChatMessage({self.to_dict()})"
+
+    def to_json(self) -> str:
+        # Encoded once, every frame the event is sent in reuses it
+        if self._json is None:
+            self._json = json.dumps(self.to_dict(), separators=(",", ":"))
+        return self._json
+
     @classmethod
     def from_dict(cls, data: dict):
         obj = cls(
             user_name=data["user_name"],
             user_id=data["user_id"],
-            content=data["content"]
+            content=data["content"],
+            # Logs written before messages had a channel
+            channel=data.get("channel")
         )
         obj.timestamp = data["timestamp"]
         obj.uuid = data["uuid"]
         return obj
 
     @classmethod
-    def from_twitch_msg(cls, msg: twitchio.Message):
+    def from_twitch_msg(cls, msg: "twitchio.Message"):
         obj = cls(
             user_name=msg.author.display_name,
             user_id=msg.author.id,
-            content=msg.content
+            content=msg.content,
+            channel=None if msg.channel is None else msg.channel.name.lower()
         )
         return obj
     
-class SubMessage():
+class SubMessage(Event):
+    FIELDS = ("user_name", "user_id", "content", "timestamp", "uuid", "is_anon", "months", "is_gift", "gift_amount")
+    __slots__ = FIELDS + ("_json",)
+
     def __init__(self, user_name: str, user_id: int, content: str, months: int, is_gift: bool, is_anon: bool, gift_amount:int = 0) -> None:
         self.is_anon = is_anon
         self.user_name = user_name
@@ -85,7 +159,8 @@ class SubMessage():
         self.is_gift = is_gift
         self.gift_amount = gift_amount
         self.timestamp = time.time()
-        self.uuid = str(uuid.uuid4())
+        self.uuid = next_event_id()
+        self._json = None
     
     def to_dict(self) -> dict:
         return {
@@ -99,6 +174,15 @@ class SubMessage():
                 "is_gift": self.is_gift,
                 "gift_amount": self.gift_amount
         }
+
+    def __repr__(self) -> str:
+        return f"SubMessage({self.to_dict()})"
+
+    def to_json(self) -> str:
+        # Encoded once, every frame the event is sent in reuses it
+        if self._json is None:
+            self._json = json.dumps(self.to_dict(), separators=(",", ":"))
+        return self._json
     
     @classmethod
     def from_dict(cls, data: dict):
@@ -116,7 +200,7 @@ class SubMessage():
         return obj
     
     @classmethod
-    def from_event(cls, event: pubsub.PubSubChannelSubscribe):
+    def from_event(cls, event: "pubsub.PubSubChannelSubscribe"):
         obj = cls(
             is_anon=True if event.user is None else False,
             user_name="Anon" if event.user is None else event.user.name,
@@ -128,7 +212,10 @@ class SubMessage():
         )
         return obj
 
-class CheerMessage():
+class CheerMessage(Event):
+    FIELDS = ("is_anon", "user_name", "user_id", "content", "amount", "timestamp", "uuid")
+    __slots__ = FIELDS + ("_json",)
+
     def __init__(self, is_anon: bool, user_name: str, user_id: int, content: str, amount: int) -> None:
         self.is_anon = is_anon
         self.user_name = user_name
@@ -136,7 +223,8 @@ class CheerMessage():
         self.content = content
         self.amount = amount
         self.timestamp = time.time()
-        self.uuid = int(uuid.uuid4())
+        self.uuid = next_event_id()
+        self._json = None
     
     def to_dict(self) -> dict:
         return {
@@ -149,6 +237,15 @@ class CheerMessage():
             "uuid": self.uuid
         }
 
+    def __repr__(self) -> str:
+        return f"CheerMessage({self.to_dict()})"
+
+    def to_json(self) -> str:
+        # Encoded once, every frame the event is sent in reuses it
+        if self._json is None:
+            self._json = json.dumps(self.to_dict(), separators=(",", ":"))
+        return self._json
+
     @classmethod
     def from_dict(cls, data: dict):
         obj = cls(
@@ -163,7 +260,7 @@ class CheerMessage():
         return obj
     
     @classmethod
-    def from_event(cls, event: pubsub.PubSubBitsMessage):
+    def from_event(cls, event: "pubsub.PubSubBitsMessage"):
         obj = cls(
             is_anon=True if event.user is None else False,
             user_name="Anon" if event.user is None else event.user.name,
@@ -171,4 +268,7 @@ class CheerMessage():
             content=event.message,
             amount=event.bits_used
         )
-        return obj
\ No newline at end of file
+        return obj
+
+def serialize_events(events: list) -> list[dict]:
+    return [e.to_dict() for e in events]
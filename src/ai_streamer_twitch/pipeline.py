@@ -0,0 +1,206 @@
+import re
+import time
+import random
+from re import _parser
+from collections import deque
+
+# Patterns come from clients and run on every chat message
+MAX_PATTERN_LENGTH = 256
+_REPEATS = (_parser.MAX_REPEAT, _parser.MIN_REPEAT, _parser.POSSESSIVE_REPEAT)
+
+_NON_WORD = re.compile(r"[^\w\s]")
+_REPEATED_CHARS = re.compile(r"(.)\1{2,}")
+
+def normalize(content: str) -> str:
+    # Folds the usual spam variations together: case, punctuation,
+    # stretched words ("LOOOOL") and repeated emotes ("KEKW KEKW KEKW")
+    content = _NON_WORD.sub("", content.lower())
+    content = _REPEATED_CHARS.sub(r"\1\1", content)
+    words = []
+    for word in content.split():
+        if word not in words:
+            words.append(word)
+    return " ".join(words)
+
+def _children(av):
+    # Sub patterns of a parsed node, whatever shape its arguments have
+    for item in av if isinstance(av, (tuple, list)) else ():
+        if isinstance(item, _parser.SubPattern):
+            yield item
+        elif isinstance(item, (tuple, list)):
+            yield from _children(item)
+
+def _can_backtrack(pattern) -> bool:
+    # Whether the pattern holds a quantifier or an alternation
+    for op, av in pattern:
+        if op in _REPEATS and av[1] > 1 or op is _parser.BRANCH:
+            return True
+        if any(_can_backtrack(child) for child in _children(av)):
+            return True
+    return False
+
+def _has_nested_quantifier(pattern) -> bool:
+    # A quantifier over something that can match in several ways, like (a+)+ or (a|aa)*,
+    # can take exponential time on a message that almost matches
+    for op, av in pattern:
+        if op in _REPEATS and av[1] > 1 and _can_backtrack(av[2]):
+            return True
+        if any(_has_nested_quantifier(child) for child in _children(av)):
+            return True
+    return False
+
+def _check_pattern(pattern: str):
+    if not isinstance(pattern, str):
+        raise ValueError(f"Patterns must be strings, got {pattern!r}")
+    if len(pattern) > MAX_PATTERN_LENGTH:
+        raise ValueError(f"Pattern longer than {MAX_PATTERN_LENGTH} characters")
+    if _has_nested_quantifier(_parser.parse(pattern)):
+        raise ValueError(f"Pattern {pattern!r} repeats a group that holds a quantifier or an alternation")
+
+def _compile(keywords: list[str], patterns: list[str]):
+    # Keywords always match literally, patterns are regular expressions
+    for pattern in patterns:
+        _check_pattern(pattern)
+    parts = [re.escape(str(keyword)) for keyword in keywords] + list(patterns)
+    if not parts:
+        return None
+    return re.compile("|".join(f"(?:{part})" for part in parts), re.IGNORECASE)
+
+class ChatPipeline():
+    # Decides per chat message whether it is stored for clients. Stages run in order:
+    # block filter, duplicate suppression, per user rate limit and sampling to a target rate.
+    # Messages that match the priority filter skip the rate limit and sampling.
+    def __init__(self, block_keywords: list[str] = (), block_patterns: list[str] = (),
+                 priority_keywords: list[str] = (), priority_patterns: list[str] = (),
+                 dedup_window: float = 0, near_duplicates: bool = True,
+                 user_rate: float = 0, user_burst: int = 3,
+                 target_rate: float = 0, seed: int = None) -> None:
+        self._options = {
+            "block_keywords": list(block_keywords),
+            "block_patterns": list(block_patterns),
+            "priority_keywords": list(priority_keywords),
+            "priority_patterns": list(priority_patterns),
+            "dedup_window": dedup_window,
+            "near_duplicates": near_duplicates,
+            "user_rate": user_rate,
+            "user_burst": user_burst,
+            "target_rate": target_rate,
+        }
+
+        self._block = _compile(block_keywords, block_patterns)
+        self._priority = _compile(priority_keywords, priority_patterns)
+
+        # Rolling index of content hashes seen in the last dedup_window seconds
+        self._dedup_window = dedup_window
+        self._near_duplicates = near_duplicates
+        self._seen = {}
+        self._seen_order = deque()
+
+        # Token bucket per user id, (tokens, last update)
+        self._user_rate = user_rate
+        self._user_burst = user_burst
+        self._buckets = {}
+
+        # Messages that passed the other stages in the current and last second
+        self._target_rate = target_rate
+        self._window_start = 0.0
+        self._window_count = 0
+        self._last_rate = 0.0
+        self._rng = random.Random(seed)
+
+        self.accepted = 0
+        self.blocked = 0
+        self.duplicates = 0
+        self.rate_limited = 0
+        self.sampled_out = 0
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(**data)
+
+    def to_dict(self) -> dict:
+        return dict(self._options)
+
+    def get_stats(self) -> dict:
+        return {
+            "accepted": self.accepted,
+            "blocked": self.blocked,
+            "duplicates": self.duplicates,
+            "rate_limited": self.rate_limited,
+            "sampled_out": self.sampled_out
+        }
+
+    def accept(self, msg, now: float = None) -> bool:
+        if now is None:
+            now = time.monotonic()
+        content = msg.content
+
+        if self._block is not None and self._block.search(content):
+            self.blocked += 1
+            return False
+
+        # Only messages that make it through every stage count as seen, so one dropped
+        # by the rate limit or sampling does not suppress the next copy
+        key = None
+        if self._dedup_window > 0:
+            key = self._dedup_key(content)
+            if self._is_duplicate(key, now):
+                self.duplicates += 1
+                return False
+
+        priority = self._priority is not None and self._priority.search(content) is not None
+        if not priority:
+            if self._user_rate > 0 and not self._take_token(msg.user_id, now):
+                self.rate_limited += 1
+                return False
+            if self._target_rate > 0 and not self._sample(now):
+                self.sampled_out += 1
+                return False
+
+        if key is not None:
+            self._remember(key, now)
+        self.accepted += 1
+        return True
+
+    def _dedup_key(self, content: str) -> int:
+        return hash(normalize(content) if self._near_duplicates else content)
+
+    def _is_duplicate(self, key: int, now: float) -> bool:
+        while self._seen_order and self._seen_order[0][0] < now - self._dedup_window:
+            _, old = self._seen_order.popleft()
+            if self._seen.get(old, 0) < now - self._dedup_window:
+                self._seen.pop(old, None)
+        return key in self._seen
+
+    def _remember(self, key: int, now: float):
+        self._seen[key] = now
+        self._seen_order.append((now, key))
+
+    def _take_token(self, user_id, now: float) -> bool:
+        tokens, last = self._buckets.get(user_id, (self._user_burst, now))
+        tokens = min(self._user_burst, tokens + (now - last) * self._user_rate)
+        if tokens < 1:
+            self._buckets[user_id] = (tokens, now)
+            return False
+        self._buckets[user_id] = (tokens - 1, now)
+
+        # Forget users with a full bucket once there are many of them
+        if len(self._buckets) > 100000:
+            full = now - self._user_burst / self._user_rate
+            self._buckets = {user: state for user, state in self._buckets.items() if state[1] > full}
+        return True
+
+    def _sample(self, now: float) -> bool:
+        # Keeps each message with probability target / rate of the last full second,
+        # which averages out at the target rate without holding messages back
+        if now - self._window_start >= 1:
+            elapsed = now - self._window_start
+            self._last_rate = self._window_count / elapsed if elapsed < 2 else 0.0
+            self._window_start = now
+            self._window_count = 0
+        self._window_count += 1
+
+        rate = max(self._last_rate, self._window_count)
+        if rate <= self._target_rate:
+            return True
+        return self._rng.random() < self._target_rate / rate
@@ -0,0 +1,237 @@
+import time
+import random
+import asyncio
+from collections import deque
+
+from .metrics import REGISTRY
+
+# Helix gives every token a bucket of points that refills over a minute
+RATE_LIMIT_POINTS = 800
+RATE_LIMIT_WINDOW = 60
+
+# Lower runs first. Raids and stream updates are what a streamer waits on,
+# lookups can wait behind them and background work behind everything.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+PRIORITIES = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
+class RetryableError(Exception):
+    # Raised by a job when it is worth trying again, after is the delay Helix asked for
+    def __init__(self, message: str, after: float = None) -> None:
+        super().__init__(message)
+        self.after = after
+
+class RateLimitBucket():
+    # Local token bucket kept in sync with the Ratelimit-* headers of every response,
+    # so requests wait here instead of being rejected with 429
+    def __init__(self, capacity: int = RATE_LIMIT_POINTS, window: float = RATE_LIMIT_WINDOW) -> None:
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self._window = window
+        self._rate = capacity / window
+        self._updated = time.monotonic()
+        self._blocked_until = 0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def delay(self) -> float:
+        # Seconds until a token is available, 0 if one is available now
+        now = time.monotonic()
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self._rate
+
+    async def acquire(self):
+        while (delay := self.delay()) > 0:
+            await asyncio.sleep(delay)
+        self.tokens -= 1
+
+    def update(self, headers):
+        limit = headers.get("Ratelimit-Limit")
+        remaining = headers.get("Ratelimit-Remaining")
+        reset = headers.get("Ratelimit-Reset")
+        if limit is not None:
+            self.capacity = int(limit)
+            self._rate = self.capacity / self._window
+        if remaining is not None:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, float(remaining))
+            if int(remaining) == 0 and reset is not None:
+                # Reset is a unix timestamp, the bucket is full again by then
+                self._blocked_until = time.monotonic() + max(0, int(reset) - time.time())
+
+class _Job():
+    __slots__ = ("run", "tenant", "priority", "future", "enqueued", "attempt")
+
+    def __init__(self, run, tenant: str, priority: int, future: asyncio.Future) -> None:
+        self.run = run
+        self.tenant = tenant
+        self.priority = priority
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.attempt = 0
+
+class _Lane():
+    # Jobs of one rate limit bucket. Within a priority tenants take turns,
+    # so one session sending a burst only delays its own requests.
+    def __init__(self, bucket: RateLimitBucket) -> None:
+        self.bucket = bucket
+        self.tenants = {priority: {} for priority in PRIORITIES}
+        self.turns = {priority: deque() for priority in PRIORITIES}
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.depth = 0
+
+    def push(self, job: _Job):
+        jobs = self.tenants[job.priority].get(job.tenant)
+        if jobs is None:
+            jobs = self.tenants[job.priority][job.tenant] = deque()
+            self.turns[job.priority].append(job.tenant)
+        jobs.append(job)
+        self.depth += 1
+        self.wakeup.set()
+
+    def pop(self) -> _Job | None:
+        for priority in PRIORITIES:
+            turns = self.turns[priority]
+            if not turns:
+                continue
+            tenant = turns.popleft()
+            jobs = self.tenants[priority][tenant]
+            job = jobs.popleft()
+            if jobs:
+                turns.append(tenant)
+            else:
+                del self.tenants[priority][tenant]
+            self.depth -= 1
+            return job
+        return None
+
+class RequestScheduler():
+    # Every outbound Twitch request goes through here. Each rate limit bucket has its own
+    # lane, a lane only starts a job when its bucket has a token. Failed jobs that raise
+    # RetryableError are queued again after a jittered exponential backoff.
+    def __init__(self, max_concurrency: int = 16, max_attempts: int = 4,
+                 backoff_base: float = 0.5, backoff_cap: float = 30) -> None:
+        self._max_attempts = max_attempts
+        self._backoff_base = backoff_base
+        self._backoff_cap = backoff_cap
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+        self._lanes = {}
+        self._tasks = set()
+
+        self._queue_depth = REGISTRY.gauge("helix_queue_depth", "Twitch requests waiting for the scheduler", ("priority",))
+        self._queue_seconds = REGISTRY.histogram("helix_queue_seconds", "Time a Twitch request waited in the scheduler", ("priority",))
+        self._retries = REGISTRY.counter("helix_retries_total", "Twitch requests retried after an error").labels()
+        REGISTRY.add_collector(self._collect_metrics)
+
+    def get_bucket(self, key: str) -> RateLimitBucket:
+        return self._get_lane(key).bucket
+
+    def _get_lane(self, key: str) -> _Lane:
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = _Lane(RateLimitBucket())
+        if lane.task is None:
+            lane.task = asyncio.create_task(self._run_lane(lane))
+        return lane
+
+    async def submit(self, run, bucket: str = "app", tenant: str = "service", priority: int = PRIORITY_NORMAL):
+        # run is called without arguments and returns an awaitable, it is called again on a retry
+        job = _Job(run, tenant, priority, asyncio.get_running_loop().create_future())
+        self._get_lane(bucket).push(job)
+        return await job.future
+
+    async def _run_lane(self, lane: _Lane):
+        while True:
+            if not lane.depth:
+                lane.wakeup.clear()
+                await lane.wakeup.wait()
+                continue
+            await lane.bucket.acquire()
+            await self._semaphore.acquire()
+            job = lane.pop()
+            if job is None:
+                self._semaphore.release()
+                continue
+            task = asyncio.create_task(self._execute(lane, job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, lane: _Lane, job: _Job):
+        self._queue_seconds.labels(str(job.priority)).observe(time.monotonic() - job.enqueued)
+        try:
+            if job.future.cancelled():
+                return
+            result = await job.run()
+        except RetryableError as e:
+            job.attempt += 1
+            if job.attempt >= self._max_attempts:
+                if not job.future.done():
+                    job.future.set_exception(e)
+                return
+            self._retries.inc()
+            # Full jitter so clients that failed together do not retry together
+            delay = random.uniform(0, min(self._backoff_cap, self._backoff_base * 2 ** job.attempt))
+            if e.after is not None:
+                delay = max(delay, e.after)
+            self._schedule_retry(lane, job, delay)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._semaphore.release()
+
+    def _schedule_retry(self, lane: _Lane, job: _Job, delay: float):
+        def requeue():
+            # The lane was removed while the job waited
+            if lane.task is None:
+                job.future.cancel()
+                return
+            job.enqueued = time.monotonic()
+            lane.push(job)
+        asyncio.get_running_loop().call_later(delay, requeue)
+
+    def _collect_metrics(self):
+        depth = {priority: 0 for priority in PRIORITIES}
+        for lane in self._lanes.values():
+            for priority in PRIORITIES:
+                depth[priority] += sum(len(jobs) for jobs in lane.tenants[priority].values())
+        for priority, count in depth.items():
+            self._queue_depth.labels(str(priority)).set(count)
+
+    def get_stats(self) -> dict:
+        return {
+            "queued": sum(lane.depth for lane in self._lanes.values()),
+            "running": len(self._tasks),
+            "lanes": len(self._lanes)
+        }
+
+    def remove_lane(self, key: str):
+        # Queued jobs of the lane are cancelled, running ones finish
+        lane = self._lanes.pop(key, None)
+        if lane is not None:
+            self._stop_lane(lane)
+
+    @staticmethod
+    def _stop_lane(lane: _Lane):
+        if lane.task is not None:
+            lane.task.cancel()
+            lane.task = None
+        while (job := lane.pop()) is not None:
+            job.future.cancel()
+
+    async def close(self):
+        REGISTRY.remove_collector(self._collect_metrics)
+        for lane in self._lanes.values():
+            self._stop_lane(lane)
+        for task in list(self._tasks):
+            task.cancel()
@@ -1,18 +1,40 @@
+import hmac
+import time
 import logging
 import uuid
 import asyncio
+from pathlib import Path
 
 from fastsocket import Server, Message
 
 from .constants import *
 from .api import API
 from .config import ServerConfig, APIConfig
-from .utils import setup_logger, get_channel_id_from_name
+from .utils import setup_logger, is_login_name, is_non_negative
+from .helix import HelixClient
+from .dispatcher import EventDispatcher
 from .models import CCL
+from .pipeline import ChatPipeline
+from .eventlog import EventLog, replay
+from .synthetic import SyntheticAPI
+from .metadata import StreamMetadata
+from .supervisor import APISupervisor
+from .codec import ENCODINGS, JSON, encode_events, encode_events_json, placeholder, splice_fragments
+from .clients import ClientState, BatchConnection, EVENT_KINDS
+from .metrics import REGISTRY, SIZE_BUCKETS, start_prometheus_server
+
+# Delivery lanes and the event kinds they carry. Every lane has its own dispatcher
+# so subs and cheers never wait behind a batch of chat.
+LANES = {
+    "chat": ("chat",),
+    "priority": ("cheers", "subs")
+}
+KIND_LANES = {kind: lane for lane, kinds in LANES.items() for kind in kinds}
 
 class Service():
-    def __init__(self, config: ServerConfig, log_level=logging.DEBUG) -> None:
+    def __init__(self, config: ServerConfig, log_level=logging.DEBUG, log_json=False) -> None:
         self._config = config
+        self._log_level = log_level
 
         self._logger, _ = setup_logger("Twitch WS", level=log_level)
 
@@ -22,72 +44,327 @@ class Service():
             log_level=log_level
         )
 
-        self._ws.on_message(START_TWITCH_API, self.start_twitch_api)
-        self._ws.on_message(STOP_TWITCH_API, self.stop_twitch_api)
-        self._ws.on_message(GET_STATUS, self.get_status)
-        self._ws.on_message(GET_ID_FROM_USER, self.get_id_from_user)
-        self._ws.on_message(SET_CHANNELS, self.set_channels)
-        self._ws.on_message(UPDATE_STREAM, self.update_stream)
+        self._requests = REGISTRY.counter("requests_total", "Websocket requests handled", ("code",))
+        self._request_seconds = REGISTRY.histogram("request_seconds", "Time spent handling a websocket request", ("code",))
+        self._broadcast_seconds = REGISTRY.histogram("broadcast_seconds", "Duration of one broadcast tick").labels()
+        self._frame_bytes = REGISTRY.histogram("frame_bytes", "Size of NewMessages frames", buckets=SIZE_BUCKETS).labels()
+        self._buffer_size = REGISTRY.gauge("buffer_size", "Events held in a session buffer", ("session", "buffer"))
+        self._buffer_dropped = REGISTRY.gauge("buffer_dropped", "Events overwritten before they were read", ("session", "buffer"))
+        self._client_queue = REGISTRY.gauge("client_queue_frames", "Frames queued for all clients")
+        self._client_count = REGISTRY.gauge("clients", "Connections receiving NewMessages")
+        self._gaps = REGISTRY.counter("stream_gaps_total", "Twitch outages during which events were lost", ("session",))
+        # Buffer names with a buffer_size and buffer_dropped sample per session, to remove the ones that are gone
+        self._buffer_labels = {}
+        REGISTRY.add_collector(self._collect_metrics)
+        self._prometheus = None
+
+        # Request handlers by code, Batch looks them up here
+        self._handlers = {}
+        self._on_message(START_TWITCH_API, self.start_twitch_api)
+        self._on_message(STOP_TWITCH_API, self.stop_twitch_api)
+        self._on_message(GET_STATUS, self.get_status)
+        self._on_message(GET_ID_FROM_USER, self.get_id_from_user)
+        self._on_message(SET_CHANNELS, self.set_channels)
+        self._on_message(UPDATE_STREAM, self.update_stream)
+        self._on_message(SUBSCRIBE, self.subscribe)
+        self._on_message(GET_METRICS, self.get_metrics)
+        self._on_message(GET_STATS, self.get_stats)
+        self._on_message(SET_FILTER, self.set_filter)
+        self._on_message(REPLAY_LOG, self.replay_log)
+        self._on_message(BATCH, self.batch)
+
+        self._helix = HelixClient(
+            self._config.twitch_id,
+            self._config.twitch_secret,
+            cache_size=self._config.helix_cache_size,
+            cache_ttl=self._config.helix_cache_ttl
+        )
+
+        # Running Twitch APIs keyed by lower case user name
+        self._apis = {}
+        # Connections that started or attached to each API, an API closes when its last one leaves
+        self._api_clients = {}
+        # Every connection that receives NewMessages, mapped to its ClientState
+        self._clients = {}
+        # Sessions with new events since the last push, per lane
+        self._dirty = {lane: set() for lane in LANES}
+        self._replays = {}
+        # Sessions ReplayLog created, the only ones it replays into
+        self._replay_sessions = set()
+        self._log_flusher = None
+        # Sessions whose StartTwitchAPI is still running, mapped to a future set when it is done
+        self._starting = {}
+        # Sessions without connections, mapped to the task that closes them after the idle timeout
+        self._idle = {}
+
+        # Restarts Twitch connections that dropped and did not come back on their own
+        self._supervisor = APISupervisor(
+            self._apis,
+            interval=self._config.health_interval,
+            unhealthy_checks=self._config.health_unhealthy_checks,
+            backoff_cap=self._config.health_backoff_cap,
+            log_level=log_level
+        )
+
+        # Worker processes that run the Twitch sessions, None runs them on this loop
+        self._shards = None
+        if self._config.shard_workers > 0:
+            from .shard import ShardPool
+            self._shards = ShardPool(self._config, self._config.shard_workers, log_level=log_level, log_json=log_json)
+
+        self._dispatchers = {}
+        if self._config.twitch_delivery == "push":
+            self._dispatchers["chat"] = EventDispatcher(
+                lambda: self.push_new_messages("chat"),
+                max_latency=self._config.twitch_max_latency,
+                max_batch=self._config.twitch_max_batch,
+                name="Dispatcher chat",
+                log_level=log_level
+            )
+            self._dispatchers["priority"] = EventDispatcher(
+                lambda: self.push_new_messages("priority"),
+                max_latency=self._config.twitch_priority_max_latency,
+                max_batch=self._config.twitch_max_batch,
+                name="Dispatcher priority",
+                log_level=log_level
+            )
+
+    def _on_message(self, code: str, handler):
+        requests = self._requests.labels(code)
+        request_seconds = self._request_seconds.labels(code)
+
+        async def timed_handler(msg: Message, ws):
+            start = time.perf_counter()
+            try:
+                await handler(msg, ws)
+            finally:
+                requests.inc()
+                request_seconds.observe(time.perf_counter() - start)
+
+        self._handlers[code] = timed_handler
+        self._ws.on_message(code, timed_handler)
+
+    def _collect_metrics(self):
+        for key, api in self._apis.items():
+            buffers = api.get_buffer_stats()
+            self._remove_buffer_labels(key, self._buffer_labels.get(key, set()) - buffers.keys())
+            self._buffer_labels[key] = set(buffers)
+            for buffer, stats in buffers.items():
+                self._buffer_size.labels(key, buffer).set(stats["size"])
+                self._buffer_dropped.labels(key, buffer).set(stats["dropped"])
+        self._client_queue.set(sum(client.get_stats()["queued_frames"] for client in self._clients.values()))
+        self._client_count.set(len(self._clients))
+
+    def _remove_buffer_labels(self, key: str, buffers):
+        for buffer in buffers:
+            self._buffer_size.remove(key, buffer)
+            self._buffer_dropped.remove(key, buffer)
+
+    def _prune_buffers(self, key: str):
+        # Only readers of chat hold chat positions
+        cursors = [client.cursors[key] for client in self._clients.values() if key in client.cursors and "chat" in client.kinds]
+        self._apis[key].prune_chat_buffers(cursors)
+
+    async def get_metrics(self, msg: Message, ws):
+        self._logger.debug("Requested metrics")
+        msg = Message(uuid=msg.uuid, code=GET_METRICS, data=REGISTRY.to_dict())
+        await ws.send(msg.to_json())
+
+    def _get_session(self, msg: Message, ws) -> str | None:
+        # Requests name their session with user_name, connections attached to one session may leave it out.
+        # Only sessions the connection started or attached to are returned, others are refused.
+        user_name = msg.data.get("user_name")
+        if user_name is not None:
+            if not isinstance(user_name, str):
+                return None
+            key = user_name.lower()
+            return key if ws in self._api_clients.get(key, ()) else None
+
+        attached = [key for key, clients in self._api_clients.items() if ws in clients]
+        if len(attached) == 1:
+            return attached[0]
+        return None
 
-        self._api = None
+    def _get_client(self, ws) -> ClientState:
+        client = self._clients.get(ws)
+        if client is None:
+            client = ClientState(
+                ws,
+                queue_size=self._config.client_queue_size,
+                overflow=self._config.client_overflow,
+                on_close=self._drop_client,
+                rebuild=self._build_frame,
+                gap_frame=self._gap_frame,
+                log_level=self._log_level
+            )
+            self._clients[ws] = client
+        return client
+
+    def _on_api_event(self, key: str, kind: str):
+        lane = KIND_LANES[kind]
+        self._dirty[lane].add(key)
+        self._dispatchers[lane].notify()
+
+    def _on_api_gap(self, key: str, gap: dict):
+        # Every subscriber of the session is told which window it will never get events for
+        self._gaps.labels(key).inc()
+        frame = self._gap_frame(key, gap)
+        for client in list(self._clients.values()):
+            cursor = client.cursors.get(key)
+            if cursor is not None:
+                client.enqueue(key, frame, cursor, cursor)
+
+    @staticmethod
+    def _gap_frame(key: str, gap: dict) -> str:
+        return Message(uuid=int(uuid.uuid4()), code=STREAM_GAP, data={"user_name": key, **gap}).to_json()
+
+    def _create_api(self, config: APIConfig) -> API:
+        if self._shards is not None:
+            return self._shards.create_api(config, log_level=self._log_level)
+        return API(config, log_level=self._log_level)
+
+    def add_api(self, api: API):
+        key = api.user_name.lower()
+        if self._dispatchers:
+            api.on_event = lambda kind: self._on_api_event(key, kind)
+        api.on_gap = lambda gap: self._on_api_gap(key, gap)
+        if not isinstance(api, SyntheticAPI):
+            api.set_helix(self._helix)
+        if not isinstance(api, SyntheticAPI) and api.get_metadata() is None:
+            api.set_metadata(StreamMetadata(
+                self._helix,
+                api.user_id,
+                api.user_token,
+                key,
+                debounce=self._config.metadata_debounce,
+                max_age=self._config.metadata_max_age,
+                log_level=self._log_level
+            ))
+        if self._config.log_enabled and api.get_event_log() is None:
+            api.set_event_log(EventLog(
+                self._log_path(key),
+                segment_size=self._config.log_segment_size
+            ))
+        self._apis[key] = api
+        self._api_clients[key] = set()
+        return key
+
+    @staticmethod
+    def _token_matches(api: API, token) -> bool:
+        # Replay sessions have no token and can only be joined through ReplayLog
+        if not isinstance(token, str) or not api.user_token:
+            return False
+        return hmac.compare_digest(api.user_token.encode(), token.encode())
+
+    def _log_path(self, key: str) -> Path:
+        # Directory of a session's event log, which has to stay inside the log directory
+        root = Path(self._config.log_directory).resolve()
+        path = (root / key).resolve()
+        if path == root or not path.is_relative_to(root):
+            raise ValueError(f"{key} is not a valid event log name")
+        return path
+
+    def attach(self, key: str, ws):
+        # Lets the connection send requests for the session and receive its events
+        idle = self._idle.pop(key, None)
+        if idle is not None:
+            idle.cancel()
+        self._api_clients[key].add(ws)
+        client = self._get_client(ws)
+        if key not in client.cursors:
+            client.cursors[key] = self._apis[key].new_cursor()
 
     async def start_twitch_api(self, msg: Message, ws):
         self._logger.debug("Got Request to start twitch API")
         
-        if self._api is not None:
-            self._logger.error("Twitch API Already started!")
-            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "Twitch API Already started!"})
-            await ws.send(msg.to_json())
-            return
-
         if "token" not in msg.data.keys() or "user_name" not in msg.data.keys():
             self._logger.error("token or user_name not in data!")
             msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "token or user_name not in data!"})
             await ws.send(msg.to_json())
             return
 
+        user_name = msg.data["user_name"]
+        if not isinstance(user_name, str) or not is_login_name(user_name.lower()):
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "user_name is not a Twitch login name"})
+            await ws.send(msg.to_json())
+            return
+
+        key = user_name.lower()
+        # A start of the same user that is still running is waited for, this one then attaches to it
+        while key in self._starting:
+            await asyncio.shield(self._starting[key])
+
+        if key in self._apis:
+            # Another consumer of the same stream, share the running API. Only with the token
+            # the session was started with, the name alone would hand out someone else's stream.
+            if not self._token_matches(self._apis[key], msg.data["token"]):
+                self._logger.warning(f"Refused attaching to {key}, the token does not match")
+                msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "token does not match the running session"})
+                await ws.send(msg.to_json())
+                return
+            self._logger.debug(f"Attaching client to running twitch API {key}")
+            self.attach(key, ws)
+            msg = Message(uuid=msg.uuid, code=START_TWITCH_API, data={})
+            await ws.send(msg.to_json())
+            return
+
+        # Registered before the first await, so concurrent starts of this user wait instead of starting a second API
+        starting = asyncio.get_running_loop().create_future()
+        self._starting[key] = starting
         try:
-            user_id = await get_channel_id_from_name(
-                self._config.twitch_id,
-                self._config.twitch_secret,
-                msg.data["user_name"]
-            )
+            await self._start_api(key, msg, ws)
+        finally:
+            del self._starting[key]
+            starting.set_result(None)
+
+    async def _start_api(self, key: str, msg: Message, ws):
+        try:
+            user_id = await self._helix.get_user_id(msg.data["user_name"], tenant=key)
+            if user_id is None:
+                raise ValueError(f"Unknown user {msg.data['user_name']}")
         except Exception as e:
             self._logger.error(e)
             msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "Could not get user id from username", "error": str(e)})
-            ws.send(msg.to_json())
+            await ws.send(msg.to_json())
             return
 
+        api = None
         try:
-            api = API(APIConfig(
+            api = self._create_api(APIConfig(
                 msg.data["token"],
                 user_id,
                 msg.data["user_name"],
                 self._config
             ))
             await api.start()
-            self._api = api
-
-            msg = Message(uuid=msg.uuid, code=START_TWITCH_API, data={})
-            await ws.send(msg.to_json())
-
+            self.add_api(api)
         except Exception as e:
             self._logger.error(e)
+            if api is not None and self._apis.get(key) is not api:
+                await api.close()
             msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "Could not start twitch API", "error": str(e)})
             await ws.send(msg.to_json())
             return
 
+        self.attach(key, ws)
+        msg = Message(uuid=msg.uuid, code=START_TWITCH_API, data={})
+        await ws.send(msg.to_json())
+
     async def stop_twitch_api(self, msg: Message, ws):
         self._logger.debug("Requested stop twitch api")
 
-        if self._api is None:
+        key = self._get_session(msg, ws)
+        if key is None:
             self._logger.error("twitch API Not Connected")
             msg = Message(uuid=msg.uuid, code=ERROR_TWITCH_API_NOT_CONNECTED, data={})
             await ws.send(msg.to_json())
             return
         
-        await self._api.close()
-        self._api = None
+        self._api_clients[key].discard(ws)
+        if ws in self._clients:
+            self._clients[ws].cursors.pop(key, None)
+        if not self._api_clients[key]:
+            await self._close_api(key)
 
         msg = Message(uuid=msg.uuid, code=STOP_TWITCH_API, data={})
         await ws.send(msg.to_json())
@@ -95,16 +372,52 @@ class Service():
     async def get_status(self, msg: Message, ws):
         self._logger.debug("Requested status")
 
-        if self._api is None:
+        key = self._get_session(msg, ws)
+        if key is None:
             self._logger.error("twitch API Not Connected")
             msg = Message(uuid=msg.uuid, code=ERROR_TWITCH_API_NOT_CONNECTED, data={})
             await ws.send(msg.to_json())
             return
 
-        info = self._api.get_info()
+        try:
+            info = await self._apis[key].fetch_info()
+        except Exception as e:
+            self._logger.error(e)
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "error fetching status", "error": str(e)})
+            await ws.send(msg.to_json())
+            return
+
+        info["clients"] = [client.get_stats() for client in self._clients.values() if key in client.cursors]
+        info["helix"] = self._helix.get_scheduler().get_stats()
+        info["supervisor"] = self._supervisor.get_stats()
         msg = Message(uuid=msg.uuid, code=GET_STATUS, data=info)
         await ws.send(msg.to_json())
 
+    async def get_stats(self, msg: Message, ws):
+        self._logger.debug("Requested stats")
+
+        key = self._get_session(msg, ws)
+        if key is None:
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH_API_NOT_CONNECTED, data={})
+            await ws.send(msg.to_json())
+            return
+
+        try:
+            stats = await self._apis[key].fetch_stats()
+        except Exception as e:
+            self._logger.error(e)
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "error fetching stats", "error": str(e)})
+            await ws.send(msg.to_json())
+            return
+        if stats is None:
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "stats are disabled"})
+            await ws.send(msg.to_json())
+            return
+
+        stats["user_name"] = key
+        msg = Message(uuid=msg.uuid, code=GET_STATS, data=stats)
+        await ws.send(msg.to_json())
+
     async def get_id_from_user(self, msg: Message, ws):
         self._logger.debug("Requested id from user")
 
@@ -112,22 +425,25 @@ class Service():
             self._logger.error("twitch API Not Connected")
             msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "user_name not in data"})
             await ws.send(msg.to_json())
+            return
+        # Scheduled under the session of the client, if it has one
+        tenant = next((key for key, clients in self._api_clients.items() if ws in clients), "service")
         try:
-            user_id = await get_channel_id_from_name(
-                self._config.twitch_id,
-                self._config.twitch_secret,
-                msg.data["user_name"]
-            )
+            user_id = await self._helix.get_user_id(msg.data["user_name"], tenant=tenant)
+            if user_id is None:
+                raise ValueError(f"Unknown user {msg.data['user_name']}")
             msg = Message(uuid=msg.uuid, code=GET_ID_FROM_USER, data={"user_id": user_id, "user_name": msg.data["user_name"]})
             await ws.send(msg.to_json())
 
         except Exception as e:
             self._logger.error(e)
             msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "Could not get user id from username", "error": str(e)})
+            await ws.send(msg.to_json())
 
     async def set_channels(self, msg: Message, ws):
         self._logger.debug("Requested set new channels")
-        if self._api is None:
+        key = self._get_session(msg, ws)
+        if key is None:
             msg = Message(uuid=msg.uuid, code=ERROR_TWITCH_API_NOT_CONNECTED, data={})
             await ws.send(msg.to_json())
             return
@@ -137,13 +453,23 @@ class Service():
             await ws.send(msg.to_json())
             return
         
-        await self._api.set_channels(msg.data["channels"])
-        msg = Message(uuid=msg.uuid, code=SET_CHANNELS, data={})
+        try:
+            # Only the difference is sent to Twitch, joins finish in the background, see GetStatus
+            changes = await self._apis[key].set_channels(msg.data["channels"])
+            self._prune_buffers(key)
+        except Exception as e:
+            self._logger.error(e)
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "could not set channels", "error": str(e)})
+            await ws.send(msg.to_json())
+            return
+
+        msg = Message(uuid=msg.uuid, code=SET_CHANNELS, data=changes or {})
         await ws.send(msg.to_json())
 
     async def update_stream(self, msg: Message, ws):
         self._logger.debug("Requested update stream")
-        if self._api is None:
+        key = self._get_session(msg, ws)
+        if key is None:
             msg = Message(uuid=msg.uuid, code=ERROR_TWITCH_API_NOT_CONNECTED, data={})
             await ws.send(msg.to_json())
             return
@@ -153,7 +479,7 @@ class Service():
             await ws.send(msg.to_json())
             return
         try:
-            self._api.update_stream(
+            changed = await self._apis[key].update_stream(
                 msg.data["title"],
                 msg.data["tags"],
                 ccl=CCL.from_dict(msg.data["ccl"]),
@@ -163,33 +489,397 @@ class Service():
             self._logger.error(e)
             msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "could not update stream", "error": str(e)})
             await ws.send(msg.to_json())
-        
-        msg = Message(uuid=msg.uuid, code=UPDATE_STREAM, data={})
+            return
+
+        msg = Message(uuid=msg.uuid, code=UPDATE_STREAM, data={"changed": changed})
         await ws.send(msg.to_json())
 
+    async def set_filter(self, msg: Message, ws):
+        self._logger.debug("Requested set filter")
+        key = self._get_session(msg, ws)
+        if key is None:
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH_API_NOT_CONNECTED, data={})
+            await ws.send(msg.to_json())
+            return
+
+        options = msg.data.get("filter")
+        try:
+            pipeline = None if not options else ChatPipeline.from_dict(options)
+        except Exception as e:
+            self._logger.error(e)
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "invalid filter", "error": str(e)})
+            await ws.send(msg.to_json())
+            return
+
+        try:
+            await self._apis[key].set_pipeline(pipeline)
+        except Exception as e:
+            self._logger.error(e)
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "error setting filter", "error": str(e)})
+            await ws.send(msg.to_json())
+            return
+
+        msg = Message(uuid=msg.uuid, code=SET_FILTER, data={"filter": None if pipeline is None else pipeline.to_dict()})
+        await ws.send(msg.to_json())
+
+    async def replay_log(self, msg: Message, ws):
+        # Replays the event log of "source" into the session "user_name", which is created if needed
+        self._logger.debug("Requested replay log")
+        if "source" not in msg.data.keys():
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "source not in data!"})
+            await ws.send(msg.to_json())
+            return
+
+        # Both end up in paths of the log directory, only plain login names are accepted
+        source = str(msg.data["source"]).lower()
+        target = str(msg.data.get("user_name", f"replay_{source}")).lower()
+        if not is_login_name(source) or not (is_login_name(target) or is_login_name(target.removeprefix("replay_"))):
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "source and user_name must be Twitch login names"})
+            await ws.send(msg.to_json())
+            return
+
+        # Replayed events are added to the target's buffers and event log. A live session would get fake
+        # events, its own log would be fed back into itself, and another client's replay is not ours.
+        if target == source or target in self._starting or (
+            target in self._apis and (target not in self._replay_sessions or ws not in self._api_clients[target])
+        ):
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": f"Can not replay into {target}, use a new user_name"})
+            await ws.send(msg.to_json())
+            return
+
+        # speed 0 replays as fast as possible, from_seq and from_ts pick where the replay starts
+        speed = msg.data.get("speed", 1.0)
+        from_seq = msg.data.get("from_seq")
+        from_ts = msg.data.get("from_ts")
+        if not is_non_negative(speed) or not (from_seq is None or is_non_negative(from_seq, integer=True)) or not (
+            from_ts is None or is_non_negative(from_ts)
+        ):
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "speed and from_ts must be numbers >= 0, from_seq an integer >= 0"})
+            await ws.send(msg.to_json())
+            return
+
+        if source in self._apis and self._apis[source].get_event_log() is not None:
+            log = self._apis[source].get_event_log()
+        elif self._log_path(source).is_dir():
+            log = EventLog(self._log_path(source), read_only=True)
+        else:
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": f"No event log for {source}"})
+            await ws.send(msg.to_json())
+            return
+
+        if target not in self._apis:
+            api = SyntheticAPI(APIConfig("", -1, target, self._config), log_level=self._log_level)
+            await api.start()
+            self.add_api(api)
+            self._replay_sessions.add(target)
+        self.attach(target, ws)
+
+        if target in self._replays:
+            self._replays[target].cancel()
+        self._replays[target] = asyncio.create_task(replay(
+            log,
+            self._apis[target],
+            speed=speed,
+            seq=from_seq,
+            timestamp=from_ts
+        ))
+
+        msg = Message(uuid=msg.uuid, code=REPLAY_LOG, data={"user_name": target})
+        await ws.send(msg.to_json())
+
+    async def batch(self, msg: Message, ws):
+        # Runs several requests from one frame and answers with one frame holding every reply,
+        # in request order. They run one after another unless "parallel" is set.
+        self._logger.debug("Requested batch")
+        requests = msg.data.get("requests")
+        if not isinstance(requests, list) or not all(self._is_batch_request(request) for request in requests):
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "requests must be a list of {uuid, code, data}"})
+            await ws.send(msg.to_json())
+            return
+
+        connection = BatchConnection(ws, [request["uuid"] for request in requests])
+        errors = {}
+
+        async def run(request: dict):
+            handler = self._handlers.get(request["code"])
+            if handler is None or request["code"] == BATCH:
+                errors[request["uuid"]] = {"uuid": request["uuid"], "code": ERROR_TWITCH, "data": {"info": f"Can not batch {request['code']}"}}
+                return
+            try:
+                await handler(Message(uuid=request["uuid"], code=request["code"], data=request.get("data", {})), connection)
+            except Exception as e:
+                # One failing request must not take the replies of the others with it
+                self._logger.error(f"Batched {request['code']} failed: {e}")
+                errors[request["uuid"]] = {"uuid": request["uuid"], "code": ERROR_TWITCH, "data": {"info": f"{request['code']} failed", "error": str(e)}}
+
+        if msg.data.get("parallel", False):
+            await asyncio.gather(*(run(request) for request in requests))
+        else:
+            for request in requests:
+                await run(request)
+
+        responses = []
+        for request in requests:
+            reply = connection.replies.get(request["uuid"], errors.get(request["uuid"]))
+            if reply is None:
+                reply = {"uuid": request["uuid"], "code": ERROR_TWITCH, "data": {"info": "no reply"}}
+            responses.append(reply)
+        msg = Message(uuid=msg.uuid, code=BATCH, data={"responses": responses})
+        await ws.send(msg.to_json())
+
+    @staticmethod
+    def _is_batch_request(request) -> bool:
+        return (
+            isinstance(request, dict)
+            and isinstance(request.get("uuid"), (str, int))
+            and isinstance(request.get("code"), str)
+            and isinstance(request.get("data", {}), dict)
+        )
+
+    @staticmethod
+    def _is_cursor(cursor) -> bool:
+        # A session id and a non-negative position per buffer
+        return (
+            isinstance(cursor, dict)
+            and isinstance(cursor.get("session"), str)
+            and all(
+                key == "session" or type(seq) is int and seq >= 0
+                for key, seq in cursor.items()
+            )
+        )
+
+    async def subscribe(self, msg: Message, ws):
+        self._logger.debug("Requested subscribe")
+        key = self._get_session(msg, ws)
+        if key is None:
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH_API_NOT_CONNECTED, data={})
+            await ws.send(msg.to_json())
+            return
+
+        encoding = msg.data.get("encoding", JSON)
+        if encoding not in ENCODINGS:
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": f"Unknown encoding {encoding}, use one of {list(ENCODINGS)}"})
+            await ws.send(msg.to_json())
+            return
+
+        lanes = msg.data.get("lanes", list(LANES.keys()))
+        if not lanes or any(lane not in LANES for lane in lanes):
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": f"Unknown lanes {lanes}, use any of {list(LANES.keys())}"})
+            await ws.send(msg.to_json())
+            return
+
+        # Only chat from these channels is read and sent, subs and cheers are not per channel
+        channels = msg.data.get("channels")
+        if channels is not None and (not isinstance(channels, list) or not all(isinstance(channel, str) for channel in channels)):
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "channels must be a list of channel names"})
+            await ws.send(msg.to_json())
+            return
+        if channels is not None:
+            channels = frozenset(channel.lower().lstrip("#") for channel in channels)
+
+        cursor = msg.data.get("cursor")
+        if cursor is not None and not self._is_cursor(cursor):
+            msg = Message(uuid=msg.uuid, code=ERROR_TWITCH, data={"info": "cursor must be a cursor from a NewMessages or Subscribe reply"})
+            await ws.send(msg.to_json())
+            return
+
+        api = self._apis[key]
+        client = self._get_client(ws)
+        # A cursor from another session means the API was restarted and its buffers are gone
+        resumed = cursor is not None and cursor.get("session") == api.session_id
+        if cursor is None:
+            # Without a cursor the connection continues from its own, so subscribing again to change
+            # lanes or channels neither repeats nor skips events
+            held = client.cursors.get(key)
+            cursor = held if held is not None and held.get("session") == api.session_id else api.new_cursor()
+        client.encoding = encoding
+        client.kinds = tuple(kind for kind in EVENT_KINDS if KIND_LANES[kind] in lanes)
+        client.channels = channels
+        client.cursors[key] = cursor
+
+        # Replay whatever the client missed before it gets live messages again
+        frame, next_cursor, missed, events = self._build_frame(key, cursor, encoding, client.kinds, client.channels)
+        msg = Message(uuid=msg.uuid, code=SUBSCRIBE, data={
+            "user_name": key,
+            "missed": missed,
+            "resumed": resumed,
+            "encoding": encoding,
+            "lanes": lanes,
+            "channels": None if channels is None else sorted(channels)
+        })
+        await ws.send(msg.to_json())
+        if frame is not None:
+            client.enqueue(key, frame, cursor, next_cursor, events)
+
+    async def _close_api(self, key: str):
+        api = self._apis.pop(key)
+        self._supervisor.forget(key)
+        # Before any await, so a session started again under this key does not count into removed samples
+        api.remove_metrics()
+        self._gaps.remove(key)
+        self._api_clients.pop(key, None)
+        idle = self._idle.pop(key, None)
+        if idle is not None:
+            idle.cancel()
+        replay_task = self._replays.pop(key, None)
+        if replay_task is not None:
+            replay_task.cancel()
+        self._replay_sessions.discard(key)
+        if api.get_event_log() is not None:
+            api.get_event_log().close()
+        self._remove_buffer_labels(key, self._buffer_labels.pop(key, set()) | api.get_buffer_stats().keys())
+        for dirty in self._dirty.values():
+            dirty.discard(key)
+        for client in self._clients.values():
+            client.cursors.pop(key, None)
+        await api.close()
+        # The user token's rate limit lane goes with the last session using it
+        if api.user_token and all(other.user_token != api.user_token for other in self._apis.values()):
+            self._helix.close_bucket(api.user_token)
+
+    def _drop_client(self, ws):
+        # The APIs keep running so the client can reconnect and resume with its cursor
+        self._logger.debug("Dropping disconnected client")
+        client = self._clients.pop(ws, None)
+        if client is not None and not client.closed:
+            asyncio.create_task(client.close())
+        for key, clients in self._api_clients.items():
+            if ws in clients:
+                clients.discard(ws)
+                if not clients:
+                    self._expire_later(key)
+
+    def _expire_later(self, key: str):
+        # Gives the last client idle_timeout seconds to reconnect and resume before the session closes
+        timeout = self._config.session_idle_timeout
+        if timeout is None or timeout < 0 or key in self._idle:
+            return
+        self._idle[key] = asyncio.create_task(self._expire_api(key, self._apis[key], timeout))
+
+    async def _expire_api(self, key: str, api: API, timeout: float):
+        await asyncio.sleep(timeout)
+        self._idle.pop(key, None)
+        if self._apis.get(key) is api and not self._api_clients.get(key):
+            self._logger.info(f"Closing {key}, no client came back within {timeout}s")
+            await self._close_api(key)
+
+    def _build_frame(self, key: str, cursor: dict, encoding: str = JSON, kinds=EVENT_KINDS, channels=None, skip_empty=True) -> tuple[str | None, dict, int, int]:
+        # Returns the frame, the cursor after it, the events lost before it and the events in it
+        events, next_cursor, missed = self._apis[key].read_since(cursor, kinds, channels)
+        count = sum(len(items) for items in events.values())
+        if skip_empty and not count:
+            return None, next_cursor, missed, 0
+
+        # JSON batches are joined from the cached encoding of each event and spliced into
+        # the serialized frame, so an event is only encoded once however many frames carry it
+        data = {"user_name": key}
+        fragments = {}
+        for kind in kinds:
+            if encoding == JSON:
+                data[kind] = placeholder(kind)
+                fragments[kind] = encode_events_json(events[kind])
+            else:
+                data[kind] = encode_events(events[kind], encoding)
+        data["cursor"] = next_cursor
+        data["missed"] = missed
+        data["encoding"] = encoding
+
+        msg = Message(uuid=int(uuid.uuid4()), code=NEW_MESSAGES, data=data)
+        frame = splice_fragments(msg.to_json(), fragments)
+        self._frame_bytes.observe(len(frame))
+        return frame, next_cursor, missed, count
+
+    @staticmethod
+    def _cursor_key(cursor: dict) -> tuple:
+        # Cursors have a position per chat channel, so all of them are compared
+        return tuple(sorted(cursor.items()))
+
+    async def broadcast_new_messages(self, skip_empty=False, sessions=None, kinds=EVENT_KINDS):
+        start = time.perf_counter()
+        if sessions is None:
+            sessions = list(self._apis.keys())
+
+        for key in sessions:
+            if key not in self._apis:
+                continue
+
+            # Clients that are caught up share a cursor, so each distinct cursor is only serialized once.
+            # Frames only get queued here, every client has its own writer task.
+            frames = {}
+            for client in list(self._clients.values()):
+                cursor = client.cursors.get(key)
+                if cursor is None:
+                    continue
+                client_kinds = tuple(kind for kind in kinds if kind in client.kinds)
+                if not client_kinds:
+                    continue
+                try:
+                    frame_key = (self._cursor_key(cursor), client.encoding, client_kinds, client.channels)
+                    if frame_key not in frames:
+                        frames[frame_key] = self._build_frame(key, cursor, client.encoding, client_kinds, client.channels, skip_empty)
+                    frame, next_cursor, _, events = frames[frame_key]
+                    if frame is None:
+                        client.cursors[key] = next_cursor
+                        continue
+                    client.enqueue(key, frame, cursor, next_cursor, events)
+                except Exception as e:
+                    # One broken client must not stop delivery to the others
+                    self._logger.error(f"Dropping client of {key}, building its frame failed: {e}")
+                    self._drop_client(client.ws)
+                    asyncio.create_task(client.ws.close())
+            self._prune_buffers(key)
+        self._broadcast_seconds.observe(time.perf_counter() - start)
+
+    async def push_new_messages(self, lane: str):
+        sessions = self._dirty[lane]
+        self._dirty[lane] = set()
+        await self.broadcast_new_messages(skip_empty=True, sessions=sessions, kinds=LANES[lane])
+
     async def client_updater_loop(self):
         while True:
-            if self._api is None:
-                new_chats = {}
-                new_subs = {}
-                new_cheers = {}
-            else:
-                new_chats = [x.to_dict() for x in self._api.get_chat_messages()]
-                new_subs = [x.to_dict() for x in self._api.get_subs()]
-                new_cheers = [x.to_dict() for x in  self._api.get_bits()]
-
-            msg = Message(uuid=int(uuid.uuid4()), code=NEW_MESSAGES, data={
-                "chat": new_chats,
-                "cheers": new_cheers,
-                "subs": new_subs
-            })
-            await self._ws.send_msg(msg)
+            try:
+                await self.broadcast_new_messages()
+            except Exception as e:
+                self._logger.error(f"Broadcast failed: {e}")
             await asyncio.sleep(self._config.twitch_update_delay)
 
+    async def log_flush_loop(self):
+        while True:
+            await asyncio.sleep(self._config.log_flush_interval)
+            for api in self._apis.values():
+                if api.get_event_log() is not None:
+                    api.get_event_log().flush()
+
     async def start(self):
+        if self._shards is not None:
+            await self._shards.start()
         await self._ws.start()
-        asyncio.create_task(self.client_updater_loop())
+        if self._config.metrics_prometheus:
+            self._prometheus = await start_prometheus_server(self._config.metrics_host, self._config.metrics_port)
+        if self._config.log_enabled:
+            self._log_flusher = asyncio.create_task(self.log_flush_loop())
+        self._supervisor.start()
+        if self._dispatchers:
+            for dispatcher in self._dispatchers.values():
+                dispatcher.start()
+        else:
+            asyncio.create_task(self.client_updater_loop())
     
     async def stop(self):
+        await self._supervisor.stop()
+        for dispatcher in self._dispatchers.values():
+            await dispatcher.stop()
+        if self._log_flusher is not None:
+            self._log_flusher.cancel()
+        for client in list(self._clients.values()):
+            await client.close()
+        for key in list(self._apis.keys()):
+            await self._close_api(key)
+        if self._shards is not None:
+            await self._shards.stop()
+        await self._helix.close()
+        if self._prometheus is not None:
+            await self._prometheus.cleanup()
+        REGISTRY.remove_collector(self._collect_metrics)
         await self._ws.stop()
         asyncio.get_running_loop().stop()
\ No newline at end of file
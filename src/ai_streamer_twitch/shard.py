@@ -0,0 +1,477 @@
+import json
+import zlib
+import struct
+import asyncio
+import logging
+import multiprocessing
+
+from .api import API
+from .config import ServerConfig, APIConfig
+from .utils import setup_logger, setup_logging
+from .models import CCL, PROCESS_ID_BITS, set_process_id
+from .pipeline import ChatPipeline
+from .dispatcher import EventDispatcher
+from .eventlog import MODELS
+from .synthetic import SyntheticAPI, LoadGenerator, PROFILES
+from .supervisor import APISupervisor
+
+# Sessions can be spread over worker processes that each run their own event loop.
+# Workers own the Twitch connections, parse and filter events, and stream them as
+# serialized batches over a local socket to the front-end, which does the fan-out.
+#
+# Every frame on the socket is a 4 byte length followed by a JSON object:
+#   front -> worker  {"id": n, "op": "start", "args": {...}}
+#   worker -> front  {"id": n, "ok": true, "result": ...} or {"id": n, "ok": false, "error": "..."}
+#   worker -> front  {"op": "events", "session": key, "events": {"chat": [[json, uuid, timestamp, channel], ...], ...}, "missed": n}
+#   worker -> front  {"op": "gap", "session": key, "gap": {"since": t, "until": t, ...}}
+#
+# Events travel in the encoding the worker made for them, with the fields the front-end
+# routes and orders by next to it, so the front-end never decodes or encodes them again.
+# Only chat has a channel. Stats are kept by the workers, the front-end asks for them.
+
+FRAME = struct.Struct("<I")
+
+class ShardError(Exception):
+    pass
+
+async def read_frame(reader: asyncio.StreamReader) -> dict:
+    (length,) = FRAME.unpack(await reader.readexactly(FRAME.size))
+    return json.loads(await reader.readexactly(length))
+
+def write_frame(writer: asyncio.StreamWriter, data: dict):
+    payload = json.dumps(data, separators=(",", ":")).encode()
+    writer.write(FRAME.pack(len(payload)) + payload)
+
+def shard_for(key: str, count: int) -> int:
+    # Stable across processes and restarts, unlike hash()
+    return zlib.crc32(key.encode()) % count
+
+class ShardWorker():
+    # Runs inside a worker process
+    def __init__(self, config: ServerConfig, index: int, port: int, log_level=logging.DEBUG) -> None:
+        self._config = config
+        self._index = index
+        self._port = port
+        self._log_level = log_level
+
+        self._logger, _ = setup_logger(f"Shard {index}", log_level)
+
+        self._apis = {}
+        self._cursors = {}
+        self._loads = {}
+        self._dirty = set()
+        self._writer = None
+        self._dispatcher = EventDispatcher(
+            self.flush,
+            max_latency=self._config.shard_batch_latency,
+            max_batch=self._config.twitch_max_batch,
+            name=f"Dispatcher shard {index}",
+            log_level=log_level
+        )
+        # Each worker restarts its own Twitch connections
+        self._supervisor = APISupervisor(
+            self._apis,
+            interval=self._config.health_interval,
+            unhealthy_checks=self._config.health_unhealthy_checks,
+            backoff_cap=self._config.health_backoff_cap,
+            log_level=log_level
+        )
+
+    async def run(self):
+        reader, self._writer = await asyncio.open_connection("127.0.0.1", self._port)
+        write_frame(self._writer, {"op": "hello", "worker": self._index})
+        await self._writer.drain()
+        self._dispatcher.start()
+        self._supervisor.start()
+        self._logger.info(f"Shard {self._index} connected to front-end")
+
+        tasks = set()
+        try:
+            while True:
+                try:
+                    msg = await read_frame(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                task = asyncio.create_task(self.handle(msg))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            await self._supervisor.stop()
+            await self._dispatcher.stop()
+            for task in self._loads.values():
+                task.cancel()
+            for api in self._apis.values():
+                await api.close()
+            self._writer.close()
+            self._logger.info(f"Shard {self._index} stopped")
+
+    async def handle(self, msg: dict):
+        handler = getattr(self, f"op_{msg['op']}", None)
+        try:
+            if handler is None:
+                raise ShardError(f"Unknown op {msg['op']}")
+            reply = {"id": msg["id"], "ok": True, "result": await handler(**msg.get("args", {}))}
+        except Exception as e:
+            self._logger.error(e)
+            reply = {"id": msg["id"], "ok": False, "error": str(e)}
+        write_frame(self._writer, reply)
+        await self._writer.drain()
+
+    def _get_api(self, session: str) -> API:
+        if session not in self._apis:
+            raise ShardError(f"No session {session} on shard {self._index}")
+        return self._apis[session]
+
+    def _on_event(self, key: str):
+        self._dirty.add(key)
+        self._dispatcher.notify()
+
+    def _on_gap(self, key: str, gap: dict):
+        write_frame(self._writer, {"op": "gap", "session": key, "gap": gap})
+
+    async def flush(self):
+        dirty = self._dirty
+        self._dirty = set()
+        for key in dirty:
+            api = self._apis.get(key)
+            if api is None:
+                continue
+            events, self._cursors[key], missed = api.read_since(self._cursors[key])
+            api.prune_chat_buffers([self._cursors[key]])
+            write_frame(self._writer, {
+                "op": "events",
+                "session": key,
+                "events": {kind: [[event.to_json(), *event.routing()] for event in items] for kind, items in events.items() if items},
+                "missed": missed
+            })
+        await self._writer.drain()
+
+    async def op_start(self, token: str, user_id: int, user_name: str, synthetic=False):
+        key = user_name.lower()
+        api_class = SyntheticAPI if synthetic else API
+        api = api_class(APIConfig(token, user_id, user_name, self._config), log_level=self._log_level)
+        api.on_event = lambda kind: self._on_event(key)
+        api.on_gap = lambda gap: self._on_gap(key, gap)
+        await api.start()
+        self._apis[key] = api
+        self._cursors[key] = api.new_cursor()
+
+    async def op_stop(self, session: str):
+        api = self._get_api(session)
+        load = self._loads.pop(session, None)
+        if load is not None:
+            load.cancel()
+        del self._apis[session]
+        del self._cursors[session]
+        self._supervisor.forget(session)
+        api.remove_metrics()
+        self._dirty.discard(session)
+        await api.close()
+
+    async def op_set_channels(self, session: str, channels: list[str]):
+        return await self._get_api(session).set_channels(channels)
+
+    async def op_update_stream(self, session: str, title: str, tags: list[str], ccl: dict, game_id: int):
+        await self._get_api(session).update_stream(title, tags, ccl=CCL.from_dict(ccl), game_id=game_id)
+
+    async def op_set_pipeline(self, session: str, options: dict | None):
+        await self._get_api(session).set_pipeline(None if not options else ChatPipeline.from_dict(options))
+
+    async def op_get_info(self, session: str):
+        return self._get_api(session).get_info()
+
+    async def op_get_stats(self, session: str):
+        return self._get_api(session).get_stats()
+
+    async def op_load(self, session: str, profile: str, duration: float, options: dict | None = None, seed: int = 0):
+        # Runs the synthetic load generator against a session, used by the benchmarks
+        generator = LoadGenerator(self._get_api(session), PROFILES[profile](**(options or {})), channel=session, seed=seed)
+        self._loads[session] = asyncio.current_task()
+        try:
+            await generator.run(duration)
+        finally:
+            self._loads.pop(session, None)
+        return {"chat": generator.chat_sent, "subs": generator.subs_sent, "cheers": generator.cheers_sent}
+
+def run_worker(config_path: str, index: int, port: int, log_level: int, log_json: bool):
+    # Entry point of a worker process
+    setup_logging(json_format=log_json)
+    set_process_id(index + 1)
+    worker = ShardWorker(ServerConfig(config_path), index, port, log_level=log_level)
+    try:
+        asyncio.run(worker.run())
+    except KeyboardInterrupt:
+        pass
+
+class WorkerConnection():
+    # Front-end side of one worker process
+    def __init__(self, index: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, logger: logging.Logger, on_lost=None) -> None:
+        self.index = index
+        self._reader = reader
+        self._writer = writer
+        self._logger = logger
+        # Called with the index when the worker goes away without being closed
+        self._on_lost = on_lost
+
+        self._next_id = 0
+        self._pending = {}
+        self._closing = False
+        self.alive = True
+        self.sessions = {}
+        self._task = asyncio.create_task(self._read_loop())
+
+    async def request(self, op: str, **args):
+        # Nothing answers on a lost connection
+        if not self.alive:
+            raise ShardError(f"Shard {self.index} disconnected")
+        self._next_id += 1
+        request_id = self._next_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        write_frame(self._writer, {"id": request_id, "op": op, "args": args})
+        await self._writer.drain()
+        reply = await future
+        if not reply["ok"]:
+            raise ShardError(reply["error"])
+        return reply["result"]
+
+    async def _read_loop(self):
+        try:
+            while True:
+                msg = await read_frame(self._reader)
+                if "id" in msg:
+                    future = self._pending.pop(msg["id"], None)
+                    if future is not None and not future.done():
+                        future.set_result(msg)
+                elif msg.get("op") == "events":
+                    api = self.sessions.get(msg["session"])
+                    if api is not None:
+                        api.add_remote_events(msg["events"], msg["missed"])
+                elif msg.get("op") == "gap":
+                    api = self.sessions.get(msg["session"])
+                    if api is not None:
+                        api.add_gap(msg["gap"])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            if not self._closing:
+                self._logger.error(f"Lost connection to shard {self.index}")
+        finally:
+            self.alive = False
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ShardError(f"Shard {self.index} disconnected"))
+            self._pending.clear()
+            if not self._closing and self._on_lost is not None:
+                self._on_lost(self.index)
+
+    async def close(self):
+        self._closing = True
+        self._writer.close()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+class ShardPool():
+    def __init__(self, config: ServerConfig, workers: int, log_level=logging.DEBUG, log_json=False) -> None:
+        # Workers stamp their index + 1 into event ids
+        if workers >= 1 << PROCESS_ID_BITS:
+            raise ValueError(f"At most {(1 << PROCESS_ID_BITS) - 1} shard workers are supported")
+        self._config = config
+        self._count = workers
+        self._log_level = log_level
+        self._log_json = log_json
+
+        self._logger, _ = setup_logger("Shards", log_level)
+
+        self._server = None
+        self._port = None
+        self._processes = {}
+        self._workers = {}
+        self._ready = None
+        self._stopping = False
+
+    async def start(self, timeout: float = 30):
+        self._ready = asyncio.Event()
+        self._server = await asyncio.start_server(self._on_connect, "127.0.0.1", 0)
+        self._port = self._server.sockets[0].getsockname()[1]
+
+        for index in range(self._count):
+            self._spawn(index)
+
+        await asyncio.wait_for(self._ready.wait(), timeout)
+        self._logger.info(f"Started {self._count} shards")
+
+    def _spawn(self, index: int):
+        # spawn, forking a process with a running loop and the log listener thread is not safe
+        context = multiprocessing.get_context("spawn")
+        process = context.Process(
+            target=run_worker,
+            args=(str(self._config.path), index, self._port, self._log_level, self._log_json),
+            name=f"ai_streamer_twitch-shard-{index}",
+            daemon=True
+        )
+        process.start()
+        self._processes[index] = process
+
+    def _on_lost(self, index: int):
+        # The sessions of the worker look unhealthy from now on, the supervisor restarts
+        # them once the new worker took the index over
+        if self._stopping:
+            return
+        self._logger.warning(f"Shard {index} is gone, starting a new one")
+        old = self._processes.get(index)
+        if old is not None and old.is_alive():
+            old.terminate()
+        self._spawn(index)
+
+    async def _on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        hello = await read_frame(reader)
+        index = hello["worker"]
+        self._workers[index] = WorkerConnection(index, reader, writer, self._logger, on_lost=self._on_lost)
+        if len(self._workers) == self._count:
+            self._ready.set()
+
+    def worker_for(self, key: str) -> WorkerConnection:
+        return self._workers[shard_for(key, self._count)]
+
+    def create_api(self, config: APIConfig, log_level=logging.DEBUG, synthetic=False) -> "RemoteAPI":
+        return RemoteAPI(config, self, log_level=log_level, synthetic=synthetic)
+
+    async def stop(self, timeout: float = 5):
+        self._stopping = True
+        for worker in self._workers.values():
+            await worker.close()
+        self._workers.clear()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for process in self._processes.values():
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                process.terminate()
+        self._processes.clear()
+
+class RemoteAPI(API):
+    # Stands in for an API running in a worker process. The buffers, cursors and event log
+    # live here, events arrive as batches from the worker.
+    def __init__(self, config: APIConfig, pool: ShardPool, log_level=logging.DEBUG, synthetic=False) -> None:
+        super().__init__(config, log_level)
+        # Filtering and stats happen in the worker
+        self._pipeline = None
+        self._stats = None
+        self._filter = self._config.server_config.chat_filter
+        self._pool = pool
+        self._worker = pool.worker_for(self.user_name.lower())
+        self._synthetic = synthetic
+        # Joins happen in the worker, only the desired channels are known here
+        self._remote_channels = []
+        self.missed = 0
+
+    async def start(self):
+        key = self.user_name.lower()
+        self._worker.sessions[key] = self
+        try:
+            await self._worker.request(
+                "start",
+                token=self._config.user_token,
+                user_id=self._config.user_id,
+                user_name=self.user_name,
+                synthetic=self._synthetic
+            )
+        except Exception:
+            self._worker.sessions.pop(key, None)
+            raise
+        self._logger.info(f"Started Twitch API on shard {self._worker.index}")
+
+    async def close(self):
+        key = self.user_name.lower()
+        try:
+            await self._worker.request("stop", session=key)
+        except ShardError as e:
+            self._logger.error(e)
+        self._worker.sessions.pop(key, None)
+
+    def add_remote_events(self, events: dict, missed: int):
+        # Events lost in the worker never reach these buffers, they are only counted
+        self.missed += missed
+        for kind, rows in events.items():
+            from_encoded = MODELS[kind].from_encoded
+            for row in rows:
+                self.add_event(kind, from_encoded(*row))
+
+    async def set_channels(self, channels) -> dict:
+        changes = await self._worker.request("set_channels", session=self.user_name.lower(), channels=list(channels))
+        self._remote_channels = list(channels)
+        self._track_parted(changes)
+        return changes
+
+    async def update_stream(self, title: str, tags: list[str], ccl: CCL = CCL(), game_id: int = 509658):
+        # The front-end normally sends channel info itself, the worker is only used without a manager
+        if self._metadata is not None:
+            return await super().update_stream(title, tags, ccl=ccl, game_id=game_id)
+        await self._worker.request(
+            "update_stream",
+            session=self.user_name.lower(),
+            title=title,
+            tags=tags,
+            ccl=ccl.to_dict(),
+            game_id=game_id
+        )
+
+    async def start_raid(self, channel_id: int):
+        # Raids only need Helix, which the front-end has
+        if self._helix is None:
+            raise ShardError("Raids on sharded sessions need a Helix client")
+        await super().start_raid(channel_id)
+
+    async def stop_raid(self):
+        if self._helix is None:
+            raise ShardError("Raids on sharded sessions need a Helix client")
+        await super().stop_raid()
+
+    async def set_pipeline(self, pipeline: ChatPipeline | None):
+        # Kept only once the worker took it, so a failed filter is not sent again on restore
+        options = None if pipeline is None else pipeline.to_dict()
+        await self._worker.request("set_pipeline", session=self.user_name.lower(), options=options)
+        self._filter = options
+
+    def get_pipeline(self) -> ChatPipeline | None:
+        return None if not self._filter else ChatPipeline.from_dict(self._filter)
+
+    def get_conncted_channels(self):
+        return self._remote_channels
+
+    def is_healthy(self) -> bool:
+        # The worker supervises the Twitch connections and reports gaps itself,
+        # only a lost worker is left to the front-end
+        return self._worker.alive
+
+    async def restart(self):
+        # Moves the session to the worker that replaced a lost one, buffers and cursors stay
+        worker = self._pool.worker_for(self.user_name.lower())
+        if not worker.alive:
+            raise ShardError(f"Shard {worker.index} is not back yet")
+        self._logger.info(f"Restarting Twitch API on shard {worker.index}")
+        self._worker.sessions.pop(self.user_name.lower(), None)
+        self._worker = worker
+        await self.start()
+        await self.restore()
+
+    async def restore(self):
+        # The new worker only knows the session, not its channels and filter
+        key = self.user_name.lower()
+        if self._remote_channels:
+            await self._worker.request("set_channels", session=key, channels=self._remote_channels)
+        await self._worker.request("set_pipeline", session=key, options=self._filter)
+
+    async def fetch_stats(self) -> dict | None:
+        return await self._worker.request("get_stats", session=self.user_name.lower())
+
+    async def fetch_info(self) -> dict:
+        info = await self._worker.request("get_info", session=self.user_name.lower())
+        info["metadata"] = None if self._metadata is None else self._metadata.get_stats()
+        # Gaps of the worker arrive here too, along with the ones of lost workers
+        info["gaps"] = list(self.gaps)
+        info["shard"] = self._worker.index
+        info["worker_missed"] = self.missed
+        return info
@@ -0,0 +1,242 @@
+import math
+import time
+import hashlib
+
+# Sliding window aggregates over a session's events. Every update is O(1), windows are
+# split into buckets that are reset lazily when the ring comes back around to them.
+
+class WindowCounter():
+    # Count and sum of values over the last window seconds, in buckets of resolution seconds
+    def __init__(self, window: float = 60, resolution: float = 1) -> None:
+        self.window = window
+        self._resolution = resolution
+        size = max(1, math.ceil(window / resolution))
+        self._epochs = [-1] * size
+        self._counts = [0] * size
+        self._sums = [0] * size
+
+    def add(self, now: float, value: float = 1):
+        epoch = int(now / self._resolution)
+        i = epoch % len(self._epochs)
+        if self._epochs[i] != epoch:
+            self._epochs[i] = epoch
+            self._counts[i] = 0
+            self._sums[i] = 0
+        self._counts[i] += 1
+        self._sums[i] += value
+
+    def totals(self, now: float, window: float = None) -> tuple[int, float]:
+        # Count and sum over the last window seconds, at most the full window
+        epoch = int(now / self._resolution)
+        oldest = epoch - min(len(self._epochs), math.ceil((window or self.window) / self._resolution)) + 1
+        count = 0
+        total = 0
+        for i, bucket_epoch in enumerate(self._epochs):
+            if oldest <= bucket_epoch <= epoch:
+                count += self._counts[i]
+                total += self._sums[i]
+        return count, total
+
+    def rate(self, now: float, window: float = None) -> float:
+        count, _ = self.totals(now, window)
+        return count / min(window or self.window, self.window)
+
+class HyperLogLog():
+    # Cardinality estimate in 2^precision bytes, standard error about 1.04 / sqrt(2^precision)
+    def __init__(self, precision: int = 10) -> None:
+        self._precision = precision
+        self._size = 1 << precision
+        self._registers = bytearray(self._size)
+        self._alpha = 0.7213 / (1 + 1.079 / self._size)
+
+    @staticmethod
+    def _hash(item) -> int:
+        return int.from_bytes(hashlib.blake2b(str(item).encode(), digest_size=8).digest(), "little")
+
+    def add(self, item):
+        h = self._hash(item)
+        index = h & (self._size - 1)
+        rest = h >> self._precision
+        # Position of the lowest set bit in the remaining 64 - precision bits
+        rank = (rest & -rest).bit_length() if rest else 64 - self._precision + 1
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+    def clear(self):
+        self._registers = bytearray(self._size)
+
+    def merge(self, other: "HyperLogLog"):
+        self._registers = bytearray(map(max, self._registers, other._registers))
+
+    def count(self) -> int:
+        estimate = self._alpha * self._size * self._size / sum(2.0 ** -r for r in self._registers)
+        zeros = self._registers.count(0)
+        if estimate <= 2.5 * self._size and zeros:
+            # Linear counting is more accurate for small sets
+            estimate = self._size * math.log(self._size / zeros)
+        return round(estimate)
+
+class WindowHyperLogLog():
+    # Distinct items over roughly the last window seconds, one sketch per bucket merged on read
+    def __init__(self, window: float = 60, buckets: int = 6, precision: int = 10) -> None:
+        self._resolution = window / buckets
+        self._epochs = [-1] * buckets
+        self._sketches = [HyperLogLog(precision) for _ in range(buckets)]
+        self._precision = precision
+
+    def add(self, now: float, item):
+        epoch = int(now / self._resolution)
+        i = epoch % len(self._epochs)
+        if self._epochs[i] != epoch:
+            self._epochs[i] = epoch
+            self._sketches[i].clear()
+        self._sketches[i].add(item)
+
+    def count(self, now: float) -> int:
+        epoch = int(now / self._resolution)
+        merged = HyperLogLog(self._precision)
+        for bucket_epoch, sketch in zip(self._epochs, self._sketches):
+            if epoch - len(self._epochs) < bucket_epoch <= epoch:
+                merged.merge(sketch)
+        return merged.count()
+
+class SpaceSaving():
+    # Top k items by count with at most k counters (Metwally et al.). Counters with equal
+    # counts share a bucket, so increments and evictions are O(1).
+    # Every reported count overestimates the true one by at most its error.
+    def __init__(self, k: int = 50) -> None:
+        self._k = k
+        self._counts = {}
+        self._errors = {}
+        # count -> items with that count, dicts keep insertion order so the oldest is evicted first
+        self._buckets = {}
+        self._min = 0
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def _move(self, item, old: int, new: int):
+        bucket = self._buckets[old]
+        del bucket[item]
+        if not bucket:
+            del self._buckets[old]
+        self._buckets.setdefault(new, {})[item] = None
+
+    def add(self, item):
+        count = self._counts.get(item)
+        if count is not None:
+            self._counts[item] = count + 1
+            self._move(item, count, count + 1)
+            if count == self._min and self._min not in self._buckets:
+                self._min = count + 1
+            return
+
+        if len(self._counts) < self._k:
+            self._counts[item] = 1
+            self._errors[item] = 0
+            self._buckets.setdefault(1, {})[item] = None
+            self._min = 1
+            return
+
+        # Replace an item with the lowest count, the newcomer inherits that count as its error
+        bucket = self._buckets[self._min]
+        evicted = next(iter(bucket))
+        del bucket[evicted]
+        del self._counts[evicted]
+        del self._errors[evicted]
+        count = self._min + 1
+        self._counts[item] = count
+        self._errors[item] = self._min
+        self._buckets.setdefault(count, {})[item] = None
+        if not bucket:
+            del self._buckets[self._min]
+            self._min = count
+
+    def top(self, n: int = 10) -> list[tuple[str, int, int]]:
+        items = sorted(self._counts.items(), key=lambda item: item[1], reverse=True)[:n]
+        return [(item, count, self._errors[item]) for item, count in items]
+
+class WindowSpaceSaving():
+    # Heavy hitters over the last one to two half windows, the summaries rotate every half window
+    def __init__(self, window: float = 60, k: int = 50) -> None:
+        self._half = window / 2
+        self._k = k
+        self._epoch = None
+        self._current = SpaceSaving(k)
+        self._previous = SpaceSaving(k)
+
+    def _rotate(self, now: float):
+        epoch = int(now / self._half)
+        if epoch != self._epoch:
+            self._previous = self._current if self._epoch == epoch - 1 else SpaceSaving(self._k)
+            self._current = SpaceSaving(self._k)
+            self._epoch = epoch
+
+    def add(self, now: float, item):
+        self._rotate(now)
+        self._current.add(item)
+
+    def top(self, now: float, n: int = 10) -> list[dict]:
+        self._rotate(now)
+        merged = {}
+        for summary in (self._previous, self._current):
+            for item, count, error in summary.top(self._k):
+                total, total_error = merged.get(item, (0, 0))
+                merged[item] = (total + count, total_error + error)
+        items = sorted(merged.items(), key=lambda item: item[1][0], reverse=True)[:n]
+        return [{"user_name": item, "count": count, "error": error} for item, (count, error) in items]
+
+class SessionStats():
+    # Chat velocity, unique and top chatters, bits and subs over a sliding window
+    def __init__(self, window: float = 60, top: int = 10, precision: int = 10) -> None:
+        self.window = window
+        self._top = top
+        self._chat = WindowCounter(window)
+        self._chatters = WindowHyperLogLog(window, precision=precision)
+        self._top_chatters = WindowSpaceSaving(window, k=max(50, top * 5))
+        self._bits = WindowCounter(window)
+        self._subs = WindowCounter(window)
+        self._gifts = WindowCounter(window)
+
+        self.chat_total = 0
+        self.bits_total = 0
+        self.subs_total = 0
+
+    def add(self, kind: str, event, now: float = None):
+        if now is None:
+            now = time.monotonic()
+        if kind == "chat":
+            self._chat.add(now)
+            self._chatters.add(now, event.user_id)
+            self._top_chatters.add(now, event.user_name)
+            self.chat_total += 1
+        elif kind == "cheers":
+            self._bits.add(now, event.amount)
+            self.bits_total += event.amount
+        elif kind == "subs":
+            self._subs.add(now)
+            if event.is_gift:
+                self._gifts.add(now)
+            self.subs_total += 1
+
+    def to_dict(self, now: float = None) -> dict:
+        if now is None:
+            now = time.monotonic()
+        chat_count, _ = self._chat.totals(now)
+        cheer_count, bits = self._bits.totals(now)
+        sub_count, _ = self._subs.totals(now)
+        gift_count, _ = self._gifts.totals(now)
+        return {
+            "window": self.window,
+            "chat": {
+                "count": chat_count,
+                "per_second": self._chat.rate(now),
+                # Over the last few seconds, shows how hot chat is right now
+                "per_second_now": self._chat.rate(now, 5),
+                "unique_chatters": self._chatters.count(now),
+                "top_chatters": self._top_chatters.top(now, self._top),
+                "total": self.chat_total
+            },
+            "cheers": {"count": cheer_count, "bits": bits, "total_bits": self.bits_total},
+            "subs": {"count": sub_count, "gifts": gift_count, "total": self.subs_total}
+        }
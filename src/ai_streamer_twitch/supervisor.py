@@ -0,0 +1,131 @@
+import time
+import random
+import asyncio
+import logging
+
+from .utils import setup_logger
+
+class Backoff():
+    # Exponential backoff with full jitter, so connections that dropped together do not retry together
+    def __init__(self, base: float = 0.5, cap: float = 30) -> None:
+        self._base = base
+        self._cap = cap
+        self.attempt = 0
+
+    def next(self) -> float:
+        delay = random.uniform(0, min(self._cap, self._base * 2 ** self.attempt))
+        self.attempt += 1
+        return delay
+
+    def reset(self):
+        self.attempt = 0
+
+class APISupervisor():
+    # Checks the Twitch connections of every API in apis (the owner's live dict). twitchio
+    # reconnects on its own first, a session that comes back gets its channels joined again,
+    # one that stayed down for unhealthy_checks checks in a row is restarted with backoff.
+    # Either way the outage is recorded on the API as a gap.
+    def __init__(self, apis: dict, interval: float = 5, unhealthy_checks: int = 2,
+                 backoff_base: float = 0.5, backoff_cap: float = 30, log_level=logging.DEBUG) -> None:
+        self._apis = apis
+        self._interval = interval
+        self._unhealthy_checks = unhealthy_checks
+        self._backoff_base = backoff_base
+        self._backoff_cap = backoff_cap
+
+        self._logger, _ = setup_logger("Supervisor", log_level)
+
+        # key -> (failed checks in a row, time of the first one)
+        self._failures = {}
+        self._tasks = {}
+        self._task = None
+        self.restarts = 0
+        self.recoveries = 0
+
+    def check(self):
+        now = time.time()
+        for key, api in list(self._apis.items()):
+            if key in self._tasks:
+                continue
+            if api.is_healthy():
+                failure = self._failures.pop(key, None)
+                if failure is not None:
+                    self._run(key, self._recovered(key, api, failure[1]))
+                continue
+            count, since = self._failures.get(key, (0, now))
+            self._failures[key] = (count + 1, since)
+            if count + 1 >= self._unhealthy_checks:
+                self._run(key, self._restart(key, api, since))
+
+    def _run(self, key: str, coro):
+        task = asyncio.create_task(coro)
+        self._tasks[key] = task
+        task.add_done_callback(lambda task, key=key: self._tasks.get(key) is task and self._tasks.pop(key))
+
+    async def _recovered(self, key: str, api, since: float):
+        # twitchio only joins the channels it was created with again
+        try:
+            await api.restore()
+        except Exception as e:
+            self._logger.error(f"Restoring {key} after a reconnect failed: {e}")
+            self._failures[key] = (self._unhealthy_checks, since)
+            return
+        self.recoveries += 1
+        self._add_gap(key, api, since, restarted=False)
+
+    async def _restart(self, key: str, api, since: float):
+        self._logger.warning(f"Twitch connection of {key} is down, restarting it")
+        backoff = Backoff(self._backoff_base, self._backoff_cap)
+        while self._apis.get(key) is api:
+            try:
+                await api.restart()
+            except Exception as e:
+                delay = backoff.next()
+                self._logger.error(f"Restarting {key} failed, retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                continue
+            if self._apis.get(key) is not api:
+                # Closed while the restart was running, the new connections are not wanted
+                self._failures.pop(key, None)
+                await api.close()
+                return
+            break
+        else:
+            # Closed while it was down
+            self._failures.pop(key, None)
+            return
+
+        self._failures.pop(key, None)
+        self.restarts += 1
+        self._add_gap(key, api, since, restarted=True)
+
+    def _add_gap(self, key: str, api, since: float, restarted: bool):
+        gap = {"since": since, "until": time.time(), "reason": "twitch_reconnect", "restarted": restarted}
+        self._logger.warning(f"{key} is back, events of the last {gap['until'] - since:.1f}s were lost")
+        api.add_gap(gap)
+
+    def forget(self, key: str):
+        # Called by the owner when it closes a session, a running restart is not needed anymore
+        task = self._tasks.pop(key, None)
+        if task is not None:
+            task.cancel()
+        self._failures.pop(key, None)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            self.check()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in list(self._tasks.values()):
+            task.cancel()
+
+    def get_stats(self) -> dict:
+        return {"restarts": self.restarts, "recoveries": self.recoveries, "down": list(self._failures.keys())}
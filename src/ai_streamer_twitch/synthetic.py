@@ -0,0 +1,140 @@
+import time
+import random
+import asyncio
+from types import SimpleNamespace
+
+from .api import API
+
+# Synthetic stand-ins for Twitch, used to run the Service and benchmarks without a live connection.
+# The fake events only have the attributes the models read from twitchio objects.
+
+WORDS = ("pog", "lol", "KEKW", "hello", "chat", "gg", "what", "is", "this", "LUL", "nice", "play", "again", "wow", "omg")
+
+def fake_user(i: int) -> SimpleNamespace:
+    return SimpleNamespace(name=f"user_{i}", display_name=f"User_{i}", id=100000 + i)
+
+def fake_chat_message(i: int, channel: str = "synthetic", users: int = 5000, rng: random.Random = random) -> SimpleNamespace:
+    content = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 12)))
+    return SimpleNamespace(
+        author=fake_user(i % users),
+        content=content,
+        channel=SimpleNamespace(name=channel),
+        echo=False
+    )
+
+def fake_sub_event(i: int, users: int = 5000) -> SimpleNamespace:
+    return SimpleNamespace(
+        user=None if i % 10 == 0 else fake_user(i % users),
+        message="Thanks for the stream!",
+        cumulative_months=1 + i % 24,
+        is_gift=i % 5 == 0
+    )
+
+def fake_bits_event(i: int, users: int = 5000) -> SimpleNamespace:
+    return SimpleNamespace(
+        user=None if i % 10 == 0 else fake_user(i % users),
+        message="Cheer100 keep it up",
+        bits_used=100 * (1 + i % 10)
+    )
+
+class SyntheticAPI(API):
+    # An API that never connects to Twitch, events come from LoadGenerator instead.
+    # drop() fakes a lost Twitch connection until the next restart.
+    async def start(self):
+        self._logger.info("Starting synthetic Twitch API")
+        self.alive = True
+
+    def drop(self):
+        self.alive = False
+
+    def is_healthy(self) -> bool:
+        return getattr(self, "alive", False)
+
+    async def close(self):
+        await self._channels.close()
+        self._logger.info("Closed synthetic Twitch API")
+
+    async def _join_channels(self, channels: list[str]):
+        # Joins succeed right away, still one batch per free slot of the join limit
+        for channel in channels:
+            self._channels.joined(channel)
+
+    async def _part_channels(self, channels: list[str]):
+        pass
+
+    async def update_stream(self, *args, **kwargs):
+        pass
+
+class LoadProfile():
+    # Chat rate in messages per second over time, plus subs and cheers per 1000 chat messages
+    def __init__(self, name: str, rate, subs_per_1k: float = 2, cheers_per_1k: float = 2) -> None:
+        self.name = name
+        self._rate = rate
+        self.subs_per_1k = subs_per_1k
+        self.cheers_per_1k = cheers_per_1k
+
+    def rate(self, t: float) -> float:
+        return self._rate(t) if callable(self._rate) else self._rate
+
+def steady(rate: float = 100) -> LoadProfile:
+    return LoadProfile("steady", rate)
+
+def raid(base: float = 100, peak: float = 5000, every: float = 10, length: float = 2) -> LoadProfile:
+    # A burst of peak messages per second for length seconds, every few seconds
+    return LoadProfile("raid", lambda t: peak if t % every < length else base, subs_per_1k=5, cheers_per_1k=5)
+
+def spike(rate: float = 50000) -> LoadProfile:
+    return LoadProfile("spike", rate)
+
+PROFILES = {
+    "steady": steady,
+    "raid": raid,
+    "spike": spike,
+}
+
+class LoadGenerator():
+    def __init__(self, api: API, profile: LoadProfile, channel: str = "synthetic", seed: int = 0, tick: float = 0.001) -> None:
+        self._api = api
+        self._profile = profile
+        self._channel = channel
+        self._rng = random.Random(seed)
+        self._tick = tick
+
+        self.chat_sent = 0
+        self.subs_sent = 0
+        self.cheers_sent = 0
+
+    async def run(self, duration: float):
+        # Injects whatever is due every tick, so high rates are sent in small bursts
+        start = time.perf_counter()
+        last = start
+        due = 0.0
+        while True:
+            now = time.perf_counter()
+            elapsed = now - start
+            if elapsed >= duration:
+                break
+
+            due += self._profile.rate(elapsed) * (now - last)
+            last = now
+            count = int(due)
+            due -= count
+            for _ in range(count):
+                self.inject_chat()
+            await asyncio.sleep(self._tick)
+
+    def inject_chat(self):
+        self._api.handle_chat_message(fake_chat_message(self.chat_sent, self._channel, rng=self._rng))
+        self.chat_sent += 1
+        if self._rng.random() * 1000 < self._profile.subs_per_1k:
+            self.inject_sub()
+        if self._rng.random() * 1000 < self._profile.cheers_per_1k:
+            self.inject_cheer()
+
+    def inject_sub(self):
+        self._api.handle_sub(fake_sub_event(self.subs_sent))
+        self.subs_sent += 1
+
+    def inject_cheer(self):
+        self._api.handle_bits(fake_bits_event(self.cheers_sent))
+        self.cheers_sent += 1
@@ -1,88 +1,174 @@
-import logging
+import re
+import sys
 import json
-import aiohttp
+import math
+import queue
+import atexit
+import random
+import logging
+import warnings
+from logging.handlers import QueueHandler, QueueListener
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Pass as extra= on per event debug logs so they go through the debug sampling
+SAMPLED = {"sampled": True}
+
+# Twitch login names, session keys and log directories are named after them
+LOGIN_NAME = re.compile(r"^[a-z0-9_]{1,25}$")
+
+def is_login_name(name) -> bool:
+    return isinstance(name, str) and LOGIN_NAME.match(name) is not None
+
+def is_non_negative(value, integer=False) -> bool:
+    # For numbers that come from clients, json booleans are ints in Python
+    types = int if integer else (int, float)
+    return isinstance(value, types) and not isinstance(value, bool) and math.isfinite(value) and value >= 0
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": record.created,
+            "logger": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+class SamplingFilter(logging.Filter):
+    # Keeps only a fraction of the records logged with extra=SAMPLED
+    def __init__(self, rate: float = 1.0) -> None:
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate >= 1 or not getattr(record, "sampled", False):
+            return True
+        return random.random() < self.rate
+
+class _LazyQueueHandler(QueueHandler):
+    # The default prepare() formats the message on the calling thread,
+    # here that is left to the listener thread
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+_queue_handler = None
+_listener = None
+
+def setup_logging(json_format=False, sample_rate: float = 1.0, stream=None):
+    # Installs the one queue handler all loggers share, records are written by a background thread.
+    # Calling it again replaces the output settings.
+    global _queue_handler, _listener
+
+    if _listener is not None:
+        _listener.stop()
+
+    output = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    output.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    if _queue_handler is None:
+        _queue_handler = _LazyQueueHandler(log_queue)
+        atexit.register(_stop_logging)
+    else:
+        _queue_handler.queue = log_queue
+    _queue_handler.filters = [SamplingFilter(sample_rate)]
+
+    _listener = QueueListener(log_queue, output)
+    _listener.start()
+
+def _stop_logging():
+    if _listener is not None:
+        _listener.stop()
 
 def setup_logger(name, level=logging.INFO):
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(formatter)
-    
+    # Returns the logger and the handler it writes to, like before the queue handler.
+    # Records still propagate, so handlers an application puts on the root logger see them.
+    if _queue_handler is None:
+        setup_logging()
+
     logger = logging.getLogger(name)
     logger.setLevel(level)
-    logger.addHandler(stream_handler)
+    if _queue_handler not in logger.handlers:
+        logger.addHandler(_queue_handler)
     
-    return logger, stream_handler
+    return logger, _queue_handler
 
 class CircularBuffer():
+    # Fixed size ring buffer, every element gets a monotonic sequence number.
+    # Readers keep their own cursor and use get_since instead of draining the buffer.
     def __init__(self, max_elems: int) -> None:
-        self._array = []
+        self._array = [None] * max_elems
         self._max_elems = max_elems
+        self._next_seq = 0
+        self._first_seq = 0
+        self.dropped = 0
+
+    def append(self, elem) -> int:
+        seq = self._next_seq
+        self._array[seq % self._max_elems] = elem
+        self._next_seq = seq + 1
+        if self._next_seq - self._first_seq > self._max_elems:
+            self._first_seq += 1
+            self.dropped += 1
+        return seq
+
+    def get_since(self, seq: int) -> tuple[list, int]:
+        # Returns the elements with sequence >= seq and the sequence to continue from
+        start = max(seq, self._first_seq)
+        end = self._next_seq
+        return self._slice(start, end), end
 
-    def append(self, elem):
-        if len(self._array) == self._max_elems:
-            self._array.pop(0)
-        self._array.append(elem)
-    
     def get_all(self, clear=False):
-        out_arr = self._array
-        if clear: 
-            self._array = []
+        out_arr = self._slice(self._first_seq, self._next_seq)
+        if clear:
+            self._first_seq = self._next_seq
         return out_arr
-    
-    def __len__(self):
-        return len(self._array)
 
-GRANT_TYPE = 'client_credentials'
+    def _slice(self, start: int, end: int) -> list:
+        if start >= end:
+            return []
+        i = start % self._max_elems
+        j = i + (end - start)
+        if j <= self._max_elems:
+            return self._array[i:j]
+        return self._array[i:] + self._array[:j - self._max_elems]
 
-async def get_channel_id_from_name(client_id, client_secret, channel_name):
-    async with aiohttp.ClientSession() as session:
-        # Get access token using app authentication exchange
-        token_url = 'https://id.twitch.tv/oauth2/token'
-        payload = {
-            'client_id': client_id,
-            'client_secret': client_secret,
-            'grant_type': GRANT_TYPE,
-        }
-        async with session.post(token_url, data=payload) as response:
-            response_text = await response.text()
-            access_token = json.loads(response_text)['access_token']
+    @property
+    def first_seq(self) -> int:
+        return self._first_seq
 
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Client-Id': client_id,
-        }
+    @property
+    def next_seq(self) -> int:
+        return self._next_seq
 
-        # Get channel ID
-        user_url = f'https://api.twitch.tv/helix/users?login={channel_name}'
-        async with session.get(user_url, headers=headers) as response:
-            response_text = await response.text()
-            data = json.loads(response_text)
-            if response.status == 200:
-                return int(data["data"][0]["id"])
+    @property
+    def capacity(self) -> int:
+        return self._max_elems
 
-async def get_channel_name_from_id(client_id, client_secret, channel_id):
-    async with aiohttp.ClientSession() as session:
-        # Get access token using app authentication exchange
-        token_url = 'https://id.twitch.tv/oauth2/token'
-        payload = {
-            'client_id': client_id,
-            'client_secret': client_secret,
-            'grant_type': GRANT_TYPE,
-        }
-        async with session.post(token_url, data=payload) as response:
-            response_text = await response.text()
-            access_token = json.loads(response_text)['access_token']
+    def __len__(self):
+        return self._next_seq - self._first_seq
 
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Client-Id': client_id,
-        }
+async def get_channel_id_from_name(client_id, client_secret, channel_name):
+    # Deprecated, every call pays for a new session and app token. Use one HelixClient instead.
+    warnings.warn("get_channel_id_from_name is deprecated, use HelixClient.get_user_id", DeprecationWarning, stacklevel=2)
+    from .helix import HelixClient
+
+    helix = HelixClient(client_id, client_secret)
+    try:
+        return await helix.get_user_id(channel_name)
+    finally:
+        await helix.close()
+
+async def get_channel_name_from_id(client_id, client_secret, channel_id):
+    # Deprecated, every call pays for a new session and app token. Use one HelixClient instead.
+    warnings.warn("get_channel_name_from_id is deprecated, use HelixClient.get_channel_name", DeprecationWarning, stacklevel=2)
+    from .helix import HelixClient
 
-        # Get channel ID
-        url = f'https://api.twitch.tv/helix/channels?broadcaster_id={channel_id}'
-        async with session.get(url, headers=headers) as response:
-            response_text = await response.text()
-            data = json.loads(response_text)
-            if response.status == 200:
-                return data['data'][0]['broadcaster_name']
\ No newline at end of file
+    helix = HelixClient(client_id, client_secret)
+    try:
+        return await helix.get_channel_name(channel_id)
+    finally:
+        await helix.close()
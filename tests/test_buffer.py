@@ -0,0 +1,46 @@
+from ai_streamer_twitch.utils import CircularBuffer
+
+def test_sequences_are_monotonic_and_readers_keep_their_own_cursor():
+    buffer = CircularBuffer(4)
+    assert [buffer.append(c) for c in "abc"] == [0, 1, 2]
+
+    items, cursor = buffer.get_since(0)
+    assert items == ["a", "b", "c"]
+    assert cursor == 3
+    # Reading does not drain, a second reader still sees everything
+    assert buffer.get_since(0) == (["a", "b", "c"], 3)
+
+    buffer.append("d")
+    assert buffer.get_since(cursor) == (["d"], 4)
+    assert buffer.get_since(4) == ([], 4)
+
+def test_overwritten_elements_are_counted_as_dropped():
+    buffer = CircularBuffer(3)
+    for i in range(5):
+        buffer.append(i)
+
+    assert len(buffer) == 3
+    assert buffer.dropped == 2
+    assert buffer.first_seq == 2
+    assert buffer.next_seq == 5
+    # A cursor older than the buffer starts at the oldest element that is left
+    assert buffer.get_since(0) == ([2, 3, 4], 5)
+
+def test_reads_across_the_wrap_point_keep_their_order():
+    buffer = CircularBuffer(4)
+    for i in range(10):
+        buffer.append(i)
+
+    assert buffer.get_all() == [6, 7, 8, 9]
+    assert buffer.get_since(7) == ([7, 8, 9], 10)
+
+def test_get_all_with_clear_empties_the_buffer_but_keeps_sequences():
+    buffer = CircularBuffer(4)
+    buffer.append("a")
+    buffer.append("b")
+
+    assert buffer.get_all(clear=True) == ["a", "b"]
+    assert len(buffer) == 0
+    assert buffer.get_all() == []
+    assert buffer.append("c") == 2
+    assert buffer.get_since(0) == (["c"], 3)
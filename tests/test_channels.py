@@ -0,0 +1,110 @@
+import time
+import asyncio
+import logging
+
+from ai_streamer_twitch.channels import ChannelSync, JOINED, FAILED
+
+class FakeIRC():
+    # Records JOIN and PART calls, with the time every JOIN batch was sent
+    def __init__(self) -> None:
+        self.joins = []
+        self.parts = []
+        self.started = time.monotonic()
+
+    async def join(self, channels: list[str]):
+        self.joins.append((time.monotonic() - self.started, list(channels)))
+
+    async def part(self, channels: list[str]):
+        self.parts.append(list(channels))
+
+def make_sync(irc: FakeIRC, **kwargs) -> ChannelSync:
+    return ChannelSync(irc.join, irc.part, log_level=logging.WARNING, **kwargs)
+
+def test_joins_are_sent_at_most_rate_per_period():
+    async def run():
+        irc = FakeIRC()
+        sync = make_sync(irc, rate=3, period=0.3)
+        try:
+            changes = await sync.set_desired([f"#Channel_{i}" for i in range(7)])
+            assert changes["join"] == [f"channel_{i}" for i in range(7)]
+            await asyncio.sleep(0.75)
+        finally:
+            await sync.close()
+
+        assert [channels for _, channels in irc.joins] == [
+            ["channel_0", "channel_1", "channel_2"],
+            ["channel_3", "channel_4", "channel_5"],
+            ["channel_6"],
+        ]
+        times = [sent for sent, _ in irc.joins]
+        assert times[1] - times[0] >= 0.29
+        assert times[2] - times[1] >= 0.29
+
+    asyncio.run(run())
+
+def test_only_the_difference_is_joined_and_parted():
+    async def run():
+        irc = FakeIRC()
+        sync = make_sync(irc)
+        try:
+            await sync.set_desired(["one", "two"])
+            await asyncio.sleep(0.01)
+            sync.joined("#one")
+            sync.joined("two")
+
+            changes = await sync.set_desired(["two", "three"])
+            await asyncio.sleep(0.01)
+        finally:
+            await sync.close()
+
+        assert changes == {"join": ["three"], "part": ["one"]}
+        assert irc.parts == [["one"]]
+        assert [channels for _, channels in irc.joins] == [["one", "two"], ["three"]]
+        assert sync.joined_channels() == ["two"]
+
+    asyncio.run(run())
+
+def test_failed_joins_are_retried_until_max_attempts():
+    async def run():
+        irc = FakeIRC()
+        sync = make_sync(irc, max_attempts=2)
+        try:
+            await sync.set_desired(["flaky", "gone"])
+            await asyncio.sleep(0.01)
+            sync.failed("flaky")
+            sync.failed("gone")
+            await asyncio.sleep(0.01)
+            sync.joined("flaky")
+            sync.failed("gone", "banned")
+            await asyncio.sleep(0.01)
+        finally:
+            await sync.close()
+
+        assert [channels for _, channels in irc.joins] == [["flaky", "gone"], ["flaky", "gone"]]
+        info = sync.get_info()
+        assert info["channels"]["flaky"]["status"] == JOINED
+        assert info["channels"]["gone"]["status"] == FAILED
+        assert info["channels"]["gone"]["error"] == "banned"
+        assert info[JOINED] == 1 and info[FAILED] == 1
+
+    asyncio.run(run())
+
+def test_reset_joins_every_desired_channel_again():
+    async def run():
+        irc = FakeIRC()
+        sync = make_sync(irc)
+        try:
+            await sync.set_desired(["one", "two"])
+            await asyncio.sleep(0.01)
+            sync.joined("one")
+            sync.joined("two")
+
+            sync.reset()
+            assert sync.joined_channels() == []
+            await asyncio.sleep(0.01)
+        finally:
+            await sync.close()
+
+        assert [channels for _, channels in irc.joins] == [["one", "two"], ["one", "two"]]
+
+    asyncio.run(run())
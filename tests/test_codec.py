@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+from ai_streamer_twitch.codec import (
+    JSON, COLUMNAR, encode_events, encode_events_json, decode_events, placeholder, splice_fragments
+)
+from ai_streamer_twitch.models import ChatMessage, SubMessage, CheerMessage
+
+def events() -> dict:
+    return {
+        "chat": [ChatMessage(f"User_{i}", 100 + i, f"hello {i}", channel="test") for i in range(3)],
+        "subs": [SubMessage("User_1", 101, "thanks", 3, False, False), SubMessage(None, None, "", 1, True, True, 5)],
+        "cheers": [CheerMessage(False, "User_2", 102, "Cheer100", 100)],
+    }
+
+@pytest.mark.parametrize("encoding", [JSON, COLUMNAR])
+def test_every_encoding_decodes_to_the_same_dicts(encoding):
+    for batch in events().values():
+        # Through json like it goes over the wire
+        encoded = json.loads(json.dumps(encode_events(batch, encoding)))
+        assert decode_events(encoded) == [event.to_dict() for event in batch]
+
+def test_columnar_sends_the_field_names_once():
+    batch = events()["chat"]
+    encoded = encode_events(batch, COLUMNAR)
+
+    assert encoded["fields"] == list(ChatMessage.FIELDS)
+    assert encoded["columns"][encoded["fields"].index("content")] == ["hello 0", "hello 1", "hello 2"]
+
+def test_empty_batches_stay_empty():
+    assert encode_events([], COLUMNAR) == []
+    assert decode_events([]) == []
+    assert encode_events_json([]) == "[]"
+
+def test_cached_json_matches_serialize():
+    batch = events()["subs"]
+    assert json.loads(encode_events_json(batch)) == encode_events(batch, JSON)
+    # The second call reuses the cached encoding
+    assert encode_events_json(batch) == encode_events_json(batch)
+
+def test_fragments_are_spliced_in_place_of_their_placeholder():
+    batches = events()
+    data = {"user_name": "test", "cursor": {"chat": 3}}
+    for kind in batches:
+        data[kind] = placeholder(kind)
+    frame = json.dumps({"code": "NewMessages", "data": data})
+
+    frame = splice_fragments(frame, {kind: encode_events_json(batch) for kind, batch in batches.items()})
+    decoded = json.loads(frame)["data"]
+
+    for kind, batch in batches.items():
+        assert decoded[kind] == [event.to_dict() for event in batch]
+    assert decoded["user_name"] == "test"
+    assert decoded["cursor"] == {"chat": 3}
+
+@pytest.mark.parametrize("kind", ["chat", "subs", "cheers"])
+def test_events_made_from_their_encoding_are_only_decoded_when_a_field_is_read(kind):
+    for original in events()[kind]:
+        text = original.to_json()
+        event = type(original).from_encoded(text, *original.routing())
+
+        assert event.to_json() is text
+        assert event.uuid == original.uuid
+        with pytest.raises(AttributeError):
+            object.__getattribute__(event, "user_id")
+        # Columnar reads every field, which decodes the rest
+        assert decode_events(encode_events([event], COLUMNAR)) == [original.to_dict()]
+        assert event.to_dict() == original.to_dict()
@@ -0,0 +1,198 @@
+import json
+import asyncio
+import logging
+
+import pytest
+
+from ai_streamer_twitch.api import chat_buffer_key
+from ai_streamer_twitch.config import ServerConfig, APIConfig
+from ai_streamer_twitch.models import ChatMessage
+from ai_streamer_twitch.service import Service
+from ai_streamer_twitch.synthetic import SyntheticAPI
+from fastsocket import Message
+
+# Chat buffers per channel and the per-channel positions in client cursors
+
+CONFIG = """
+[ws]
+port = 8000
+host = "127.0.0.1"
+
+[twitch]
+secret = ""
+id = ""
+update_delay = 1
+
+[buffers]
+chat = 5
+sub = 10
+cheer = 10
+max_channels = 3
+
+[buffers.channels]
+busy = 20
+"""
+
+@pytest.fixture
+def api(tmp_path) -> SyntheticAPI:
+    path = tmp_path / "config.toml"
+    path.write_text(CONFIG)
+    return SyntheticAPI(APIConfig("token", 1, "test", ServerConfig(path)), log_level=logging.WARNING)
+
+def chat(api: SyntheticAPI, channel: str, count: int = 1):
+    for _ in range(count):
+        api.add_event("chat", ChatMessage("User", 100, f"hello {channel}", channel=channel))
+
+def contents(events: dict) -> list[str]:
+    return [msg.content for msg in events["chat"]]
+
+def test_a_busy_channel_does_not_push_out_a_quiet_one(api):
+    chat(api, "quiet", 2)
+    chat(api, "busy", 50)
+
+    stats = api.get_buffer_stats()
+    assert stats[chat_buffer_key("busy")] == {"size": 20, "capacity": 20, "dropped": 30}
+    assert stats[chat_buffer_key("quiet")] == {"size": 2, "capacity": 5, "dropped": 0}
+
+    events, _, missed = api.read_since(api.new_cursor(from_start=True), channels=["quiet"])
+    assert contents(events) == ["hello quiet"] * 2
+    assert missed == 0
+
+def test_channels_are_interleaved_in_arrival_order(api):
+    cursor = api.new_cursor()
+    chat(api, "one")
+    chat(api, "two")
+    chat(api, "one")
+
+    events, cursor, _ = api.read_since(cursor)
+    assert contents(events) == ["hello one", "hello two", "hello one"]
+    assert cursor[chat_buffer_key("one")] == 2
+    assert cursor[chat_buffer_key("two")] == 1
+
+def test_widening_the_channels_skips_the_backlog_of_the_new_ones(api):
+    cursor = api.new_cursor()
+    chat(api, "one", 2)
+    chat(api, "two", 4)
+
+    events, cursor, missed = api.read_since(cursor, channels=["one"])
+    assert contents(events) == ["hello one"] * 2
+    # Chat of the channels that were not asked for is skipped, not held back
+    assert cursor[chat_buffer_key("two")] == 4
+
+    chat(api, "two")
+    events, cursor, missed = api.read_since(cursor)
+    assert contents(events) == ["hello two"]
+    assert missed == 0
+
+def test_lost_events_are_counted_per_channel(api):
+    cursor = api.new_cursor()
+    chat(api, "one", 8)
+    chat(api, "two", 6)
+    assert api.read_since(cursor)[2] == 3 + 1
+
+def test_cursor_of_an_older_session_starts_from_the_oldest_event(api):
+    chat(api, "one", 2)
+    cursor = {"session": "old", chat_buffer_key("one"): 99}
+
+    events, cursor, missed = api.read_since(cursor)
+    assert contents(events) == ["hello one"] * 2
+    assert cursor["session"] == api.session_id
+
+def test_parted_buffer_goes_once_every_cursor_has_read_it(api):
+    async def run():
+        await api.set_channels(["one", "two"])
+        chat(api, "one", 3)
+        chat(api, "two")
+        behind = api.new_cursor(from_start=True)
+        _, ahead, _ = api.read_since(behind)
+
+        await api.set_channels(["two"])
+        api.prune_chat_buffers([behind, ahead])
+        assert chat_buffer_key("one") in api.get_buffer_stats()
+
+        _, behind, _ = api.read_since(behind)
+        api.prune_chat_buffers([behind, ahead])
+        assert chat_buffer_key("one") not in api.get_buffer_stats()
+        # Its key leaves the cursor with the next read
+        assert chat_buffer_key("one") not in api.read_since(ahead)[1]
+
+        # Joined again, the new buffer is read from its start even by a cursor that was further along
+        await api.set_channels(["one", "two"])
+        chat(api, "one")
+        events, _, missed = api.read_since(ahead)
+        assert contents(events) == ["hello one"]
+        assert missed == 0
+        await api.close()
+
+    asyncio.run(run())
+
+def test_chat_over_max_channels_is_dropped_unless_a_parted_buffer_can_go(api):
+    async def run():
+        await api.set_channels(["one", "two", "three"])
+        for channel in ("one", "two", "three", "four"):
+            chat(api, channel)
+        assert api.chat_overflow == 1
+        assert chat_buffer_key("four") not in api.get_buffer_stats()
+
+        await api.set_channels(["two", "three", "four"])
+        chat(api, "four")
+        assert api.chat_overflow == 1
+        assert chat_buffer_key("one") not in api.get_buffer_stats()
+        assert api.get_buffer_stats()[chat_buffer_key("four")]["size"] == 1
+        await api.close()
+
+    asyncio.run(run())
+
+class FakeWS():
+    def __init__(self) -> None:
+        self.frames = []
+        self.closed = False
+
+    async def send(self, frame: str):
+        self.frames.append(json.loads(frame))
+
+    async def close(self):
+        self.closed = True
+
+@pytest.mark.parametrize("cursor", [
+    "chat:test=3",
+    {"chat:test": 3},
+    {"session": "x", "cheers": "3"},
+    {"session": "x", "subs": -1},
+    {"session": "x", "subs": True},
+])
+def test_malformed_cursor_is_rejected_on_subscribe(api, cursor):
+    async def run():
+        service = Service(api._config.server_config, log_level=logging.ERROR)
+        key = service.add_api(api)
+        ws = FakeWS()
+        service.attach(key, ws)
+        held = dict(service._get_client(ws).cursors[key])
+
+        await service.subscribe(Message(uuid=1, code="Subscribe", data={"user_name": key, "cursor": cursor}), ws)
+        assert ws.frames[-1]["code"] == "ErrorTwitch"
+        assert service._get_client(ws).cursors[key] == held
+        await service._close_api(key)
+
+    asyncio.run(run())
+
+def test_client_whose_frame_fails_is_dropped_and_the_others_still_get_theirs(api):
+    async def run():
+        service = Service(api._config.server_config, log_level=logging.CRITICAL)
+        key = service.add_api(api)
+        good, broken = FakeWS(), FakeWS()
+        for ws in (broken, good):
+            service.attach(key, ws)
+            await service.subscribe(Message(uuid=1, code="Subscribe", data={"user_name": key}), ws)
+        service._clients[broken].cursors[key]["cheers"] = "x"
+
+        chat(api, "test")
+        await service.broadcast_new_messages()
+        await asyncio.sleep(0.05)
+
+        assert [frame["code"] for frame in good.frames] == ["Subscribe", "NewMessages"]
+        assert broken.closed
+        assert broken not in service._clients
+        await service._close_api(key)
+
+    asyncio.run(run())
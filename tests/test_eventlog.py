@@ -0,0 +1,127 @@
+import json
+import asyncio
+import logging
+
+import pytest
+
+from ai_streamer_twitch.config import ServerConfig
+from ai_streamer_twitch.eventlog import EventLog, HEADER
+from ai_streamer_twitch.models import ChatMessage, CheerMessage
+from ai_streamer_twitch.service import Service
+from fastsocket import Message
+
+CONFIG = """
+[ws]
+port = 8000
+host = "127.0.0.1"
+
+[twitch]
+secret = ""
+id = ""
+update_delay = 1
+
+[buffers]
+chat = 100
+sub = 100
+cheer = 100
+"""
+
+def chat(i: int, timestamp: float = None) -> ChatMessage:
+    msg = ChatMessage(f"User_{i}", 100 + i, f"hello {i}", channel="test")
+    if timestamp is not None:
+        msg.timestamp = timestamp
+    return msg
+
+def write_log(directory, count: int, segment_size: int = 1024) -> EventLog:
+    log = EventLog(directory, segment_size=segment_size)
+    for i in range(count):
+        log.append("chat", chat(i, timestamp=1000.0 + i))
+    log.close()
+    return log
+
+def test_records_are_read_back_in_order_across_segments(tmp_path):
+    write_log(tmp_path, 50)
+    assert len(list(tmp_path.glob("*.log"))) > 1
+
+    log = EventLog(tmp_path, segment_size=1024)
+    assert log.next_seq == 50
+    records = list(log.read())
+    assert [seq for seq, _, _, _ in records] == list(range(50))
+    assert [data["content"] for _, _, _, data in records] == [f"hello {i}" for i in range(50)]
+
+    assert [seq for seq, _, _, _ in log.read(seq=37)] == list(range(37, 50))
+    assert [seq for seq, _, _, _ in log.read(timestamp=1045.0)] == list(range(45, 50))
+
+def test_torn_last_record_is_cut_off_and_the_log_continues(tmp_path):
+    write_log(tmp_path, 10, segment_size=1024 * 1024)
+    path = next(tmp_path.glob("*.log"))
+    size = path.stat().st_size
+    # A crash in the middle of writing the next record
+    with open(path, "ab") as f:
+        f.write(HEADER.pack(200, 10, 1010.0, 0) + b'{"user_na')
+
+    log = EventLog(tmp_path)
+    assert path.stat().st_size == size
+    assert log.next_seq == 10
+
+    log.append("cheers", CheerMessage(False, "User_1", 101, "Cheer100", 100))
+    log.close()
+    records = list(EventLog(tmp_path).read())
+    assert [seq for seq, _, _, _ in records] == list(range(11))
+    assert records[-1][2] == "cheers"
+    assert records[-1][3]["amount"] == 100
+
+def test_read_only_log_skips_a_torn_record_without_touching_the_file(tmp_path):
+    write_log(tmp_path, 5, segment_size=1024 * 1024)
+    path = next(tmp_path.glob("*.log"))
+    with open(path, "ab") as f:
+        f.write(HEADER.pack(200, 5, 1005.0, 0))
+    size = path.stat().st_size
+
+    log = EventLog(tmp_path, read_only=True)
+    assert [seq for seq, _, _, _ in log.read()] == list(range(5))
+    with pytest.raises(ValueError):
+        log.append("chat", chat(5))
+    log.close()
+    assert path.stat().st_size == size
+
+def test_unrelated_files_and_empty_segments_are_ignored(tmp_path):
+    (tmp_path / "notes.log").write_text("not a segment")
+    write_log(tmp_path, 3)
+
+    log = EventLog(tmp_path)
+    assert log.next_seq == 3
+    log.close()
+    # Nothing was written since opening, so close leaves no empty segment behind
+    assert sorted(path.name for path in tmp_path.glob("*.log")) == [f"{0:020d}.log", "notes.log"]
+
+class FakeWS():
+    def __init__(self) -> None:
+        self.frames = []
+
+    async def send(self, frame: str):
+        self.frames.append(json.loads(frame))
+
+@pytest.mark.parametrize("options", [
+    {"speed": "fast"},
+    {"speed": -1},
+    {"speed": float("inf")},
+    {"from_seq": 1.5},
+    {"from_seq": -3},
+    {"from_seq": True},
+    {"from_ts": "yesterday"},
+])
+def test_replay_with_bad_options_is_refused_before_it_starts(tmp_path, options):
+    async def run():
+        path = tmp_path / "config.toml"
+        path.write_text(CONFIG)
+        service = Service(ServerConfig(path), log_level=logging.CRITICAL)
+        ws = FakeWS()
+
+        await service.replay_log(Message(uuid=1, code="ReplayLog", data={"source": "test", **options}), ws)
+        assert ws.frames[-1]["code"] == "ErrorTwitch"
+        assert "speed" in ws.frames[-1]["data"]["info"]
+        assert not service._replays
+        assert not service._apis
+
+    asyncio.run(run())
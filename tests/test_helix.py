@@ -0,0 +1,137 @@
+import time
+import asyncio
+
+import pytest
+from aiohttp import web
+
+from ai_streamer_twitch.helix import HelixClient, HelixError
+from ai_streamer_twitch.scheduler import RequestScheduler, RetryableError
+
+# HelixClient against a local stub of the token endpoint and /users
+
+USERS = {
+    "alice": {"id": "1", "login": "alice", "display_name": "Alice"},
+    "bob": {"id": "2", "login": "bob", "display_name": "Bob"},
+}
+
+class StubHelix():
+    def __init__(self) -> None:
+        self.tokens_issued = 0
+        self.user_requests = []
+        # Responses for the next /users requests, before the real answer
+        self.queued = []
+
+    async def token(self, request: web.Request):
+        self.tokens_issued += 1
+        return web.json_response({"access_token": f"token-{self.tokens_issued}", "expires_in": 3600})
+
+    async def users(self, request: web.Request):
+        self.user_requests.append((request.headers["Authorization"], request.query.getall("login", [])))
+        if self.queued:
+            return self.queued.pop(0)()
+        if request.headers["Authorization"] != f"Bearer token-{self.tokens_issued}":
+            return web.json_response({"message": "invalid token"}, status=401)
+        logins = request.query.getall("login", [])
+        return web.json_response({"data": [USERS[login] for login in logins if login in USERS]})
+
+async def start_stub():
+    stub = StubHelix()
+    app = web.Application()
+    app.router.add_post("/token", stub.token)
+    app.router.add_get("/helix/users", stub.users)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    helix = HelixClient(
+        "id", "secret",
+        helix_url=f"http://127.0.0.1:{port}/helix",
+        token_url=f"http://127.0.0.1:{port}/token",
+        scheduler=RequestScheduler(backoff_base=0.01, backoff_cap=0.05)
+    )
+    return stub, helix, runner
+
+def run_with_stub(test):
+    async def run():
+        stub, helix, runner = await start_stub()
+        try:
+            await test(stub, helix)
+        finally:
+            await helix.close()
+            await runner.cleanup()
+    asyncio.run(run())
+
+def test_lookups_are_cached_and_batched():
+    async def test(stub, helix):
+        assert await helix.get_user_ids(["Alice", "bob", "nobody"]) == {"alice": 1, "bob": 2}
+        assert len(stub.user_requests) == 1
+        assert sorted(stub.user_requests[0][1]) == ["alice", "bob", "nobody"]
+
+        assert await helix.get_user_id("alice") == 1
+        assert await helix.get_channel_name(2) == "Bob"
+        assert len(stub.user_requests) == 1
+        assert stub.tokens_issued == 1
+
+    run_with_stub(test)
+
+def test_expired_app_token_is_refreshed_once():
+    async def test(stub, helix):
+        assert await helix.get_user_id("alice") == 1
+        # The stub forgets the token, the next request gets a 401 and has to refresh
+        stub.tokens_issued += 1
+        assert await helix.get_user_id("bob") == 2
+        assert stub.tokens_issued == 3
+        assert [auth for auth, _ in stub.user_requests] == ["Bearer token-1", "Bearer token-1", "Bearer token-3"]
+
+    run_with_stub(test)
+
+def test_rate_limited_request_is_retried():
+    async def test(stub, helix):
+        reset = str(int(time.time()))
+        stub.queued.append(lambda: web.json_response(
+            {"message": "too many requests"}, status=429,
+            headers={"Ratelimit-Limit": "800", "Ratelimit-Remaining": "0", "Ratelimit-Reset": reset}
+        ))
+        assert await helix.get_user_id("alice") == 1
+        assert len(stub.user_requests) == 2
+
+    run_with_stub(test)
+
+@pytest.mark.parametrize("response", [
+    lambda: web.Response(text="<html>Bad Gateway</html>", status=400),
+    lambda: web.json_response(["not", "an", "object"], status=403),
+])
+def test_error_bodies_that_are_not_objects_raise_helix_error(response):
+    async def test(stub, helix):
+        stub.queued.append(response)
+        with pytest.raises(HelixError) as error:
+            await helix.get_user_id("alice")
+        assert error.value.status in (400, 403)
+
+    run_with_stub(test)
+
+def test_job_cancelled_during_its_last_attempt_does_not_break_the_lane():
+    async def run():
+        scheduler = RequestScheduler(max_attempts=1)
+        started = asyncio.Event()
+
+        async def slow_failure():
+            started.set()
+            await asyncio.sleep(0.05)
+            raise RetryableError("busy")
+
+        async def ok():
+            return "ok"
+
+        loop = asyncio.get_running_loop()
+        errors = []
+        loop.set_exception_handler(lambda loop, context: errors.append(context))
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(scheduler.submit(slow_failure), 0.01)
+        await asyncio.sleep(0.1)
+
+        assert await asyncio.wait_for(scheduler.submit(ok), 1) == "ok"
+        assert errors == []
+
+    asyncio.run(run())
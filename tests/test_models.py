@@ -0,0 +1,20 @@
+from ai_streamer_twitch.models import MAX_EVENT_ID, ChatMessage, next_event_id, set_process_id
+
+def test_event_ids_are_ordered_and_exact_as_doubles():
+    set_process_id(255)
+    try:
+        ids = [next_event_id() for _ in range(1000)]
+    finally:
+        set_process_id(0)
+
+    assert ids == sorted(set(ids))
+    assert all(event_id & 0xff == 255 for event_id in ids)
+    assert all(event_id < MAX_EVENT_ID and int(float(event_id)) == event_id for event_id in ids)
+
+def test_ids_of_different_processes_do_not_collide():
+    ids = set()
+    for process_id in range(4):
+        set_process_id(process_id)
+        ids.update(ChatMessage("User", 1, "hi").uuid for _ in range(100))
+    set_process_id(0)
+    assert len(ids) == 400
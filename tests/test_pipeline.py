@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import pytest
+
+from ai_streamer_twitch.pipeline import ChatPipeline, normalize
+
+def chat(content: str, user_id: int = 1) -> SimpleNamespace:
+    return SimpleNamespace(content=content, user_id=user_id)
+
+def test_keywords_match_literally_and_patterns_as_regex():
+    pipeline = ChatPipeline(block_keywords=["c++", "buy.now"], block_patterns=[r"bit\.ly/\w+"])
+
+    assert not pipeline.accept(chat("I love C++"), now=0)
+    assert not pipeline.accept(chat("buy.now please"), now=0)
+    assert not pipeline.accept(chat("see bit.ly/abc"), now=0)
+    # The dot in a keyword is not a wildcard
+    assert pipeline.accept(chat("buy now please"), now=0)
+    assert pipeline.get_stats()["blocked"] == 3
+    assert pipeline.get_stats()["accepted"] == 1
+
+@pytest.mark.parametrize("pattern", [r"(a+)+$", r"(a|aa)*b", r"(\w+\s?)*x", "a" * 300])
+def test_patterns_that_can_backtrack_forever_are_rejected(pattern):
+    with pytest.raises(ValueError):
+        ChatPipeline(block_patterns=[pattern])
+
+def test_near_duplicates_are_suppressed_within_the_window():
+    assert normalize("LOOOOL!!! KEKW KEKW") == normalize("lool kekw")
+    pipeline = ChatPipeline(dedup_window=10)
+
+    assert pipeline.accept(chat("LOOOOL!!!"), now=0)
+    assert not pipeline.accept(chat("lool", user_id=2), now=5)
+    assert pipeline.accept(chat("lool", user_id=2), now=11)
+    assert pipeline.get_stats()["duplicates"] == 1
+
+def test_message_dropped_by_a_later_stage_does_not_count_as_seen():
+    pipeline = ChatPipeline(dedup_window=10, user_rate=0.1, user_burst=1)
+
+    assert pipeline.accept(chat("first", user_id=1), now=0)
+    # Rate limited, so the same text from someone else still gets through
+    assert not pipeline.accept(chat("hello", user_id=1), now=1)
+    assert pipeline.accept(chat("hello", user_id=2), now=1)
+    assert not pipeline.accept(chat("hello", user_id=3), now=2)
+
+    stats = pipeline.get_stats()
+    assert stats["rate_limited"] == 1
+    assert stats["duplicates"] == 1
+
+def test_user_rate_limit_refills_and_priority_skips_it():
+    pipeline = ChatPipeline(user_rate=1, user_burst=2, priority_keywords=["!urgent"])
+
+    assert pipeline.accept(chat("a"), now=0)
+    assert pipeline.accept(chat("b"), now=0)
+    assert not pipeline.accept(chat("c"), now=0)
+    assert pipeline.accept(chat("!urgent d"), now=0)
+    assert pipeline.accept(chat("e"), now=1)
+    # Other users have their own bucket
+    assert pipeline.accept(chat("f", user_id=2), now=1)
+
+def test_sampling_averages_out_at_the_target_rate():
+    pipeline = ChatPipeline(target_rate=50, seed=0)
+    accepted = []
+    # 500 messages a second for 10 seconds
+    for i in range(5000):
+        accepted.append(pipeline.accept(chat(f"msg {i}", user_id=i), now=i / 500))
+
+    # The first second has no rate to go by yet, after it every second keeps about 50
+    assert 400 <= sum(accepted[500:]) <= 500
+    assert pipeline.get_stats()["sampled_out"] == 5000 - sum(accepted)
+
+def test_options_round_trip_through_a_dict():
+    pipeline = ChatPipeline(block_keywords=["spam"], dedup_window=5, target_rate=10)
+    copy = ChatPipeline.from_dict(pipeline.to_dict())
+
+    assert copy.to_dict() == pipeline.to_dict()
+    assert not copy.accept(chat("SPAM"), now=0)
@@ -0,0 +1,320 @@
+import time
+import json
+import asyncio
+import logging
+
+import aiohttp
+import pytest
+from aiohttp import web
+from websockets.exceptions import ConnectionClosed
+
+from ai_streamer_twitch.api import API
+from ai_streamer_twitch.client import TwitchClient
+from ai_streamer_twitch.config import ServerConfig, APIConfig
+from ai_streamer_twitch.service import Service
+from ai_streamer_twitch.supervisor import APISupervisor
+from ai_streamer_twitch.synthetic import SyntheticAPI, fake_chat_message
+from fastsocket import Message
+
+# Recovery after dropped connections, against local fakes of Twitch and of the client link
+
+CONFIG = """
+[ws]
+port = 8000
+host = "127.0.0.1"
+
+[twitch]
+secret = ""
+id = ""
+update_delay = 1
+delivery = "push"
+
+[health]
+interval = 0.1
+unhealthy_checks = 2
+backoff_cap = 0.5
+
+[buffers]
+chat = 1000
+sub = 1000
+cheer = 1000
+"""
+
+@pytest.fixture
+def config(tmp_path) -> ServerConfig:
+    path = tmp_path / "config.toml"
+    path.write_text(CONFIG)
+    return ServerConfig(path)
+
+class FakeTwitch():
+    # Just enough IRC and PubSub for twitchio to connect, join and receive chat
+    def __init__(self) -> None:
+        self.irc = set()
+        self.pubsub = set()
+        self.joined = {}
+        self.down = False
+        self.connects = 0
+
+    async def handle_irc(self, request: web.Request):
+        if self.down:
+            raise web.HTTPServiceUnavailable()
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.irc.add(ws)
+        self.joined[ws] = set()
+        self.connects += 1
+        nick = "test"
+        async for msg in ws:
+            for line in msg.data.split("\r\n"):
+                if line.startswith("NICK"):
+                    nick = line.split()[1]
+                    await ws.send_str(f":tmi.twitch.tv 001 {nick} :Welcome\r\n:tmi.twitch.tv 376 {nick} :>\r\n")
+                elif line.startswith("JOIN"):
+                    for channel in line.split()[1].split(","):
+                        self.joined[ws].add(channel.lstrip("#"))
+                        await ws.send_str(
+                            f":{nick}!{nick}@{nick}.tmi.twitch.tv JOIN {channel}\r\n"
+                            f":{nick}.tmi.twitch.tv 353 {nick} = {channel} :{nick}\r\n"
+                            f":{nick}.tmi.twitch.tv 366 {nick} {channel} :End of /NAMES list\r\n"
+                        )
+                elif line.startswith("PING"):
+                    await ws.send_str("PONG :tmi.twitch.tv\r\n")
+        self.irc.discard(ws)
+        self.joined.pop(ws, None)
+        return ws
+
+    async def handle_pubsub(self, request: web.Request):
+        if self.down:
+            raise web.HTTPServiceUnavailable()
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.pubsub.add(ws)
+        async for msg in ws:
+            data = json.loads(msg.data)
+            if data["type"] == "PING":
+                await ws.send_json({"type": "PONG"})
+            elif data["type"] == "LISTEN":
+                await ws.send_json({"type": "RESPONSE", "nonce": data["nonce"], "error": ""})
+        self.pubsub.discard(ws)
+        return ws
+
+    async def chat(self, channel: str, i: int) -> int:
+        # Sends one message to every connection that joined channel
+        line = (
+            f"@badge-info=;badges=;color=;display-name=User_{i};emotes=;id=msg-{i};mod=0;room-id=1;"
+            f"subscriber=0;tmi-sent-ts={int(time.time() * 1000)};turbo=0;user-id={100000 + i};user-type= "
+            f":user_{i}!user_{i}@user_{i}.tmi.twitch.tv PRIVMSG #{channel} :hello {i}\r\n"
+        )
+        sent = 0
+        for ws, channels in list(self.joined.items()):
+            if channel in channels:
+                await ws.send_str(line)
+                sent += 1
+        return sent
+
+    async def drop(self):
+        for ws in list(self.irc) + list(self.pubsub):
+            await ws.close()
+
+@pytest.fixture
+def fake_twitch(monkeypatch):
+    # Points twitchio at a FakeTwitch on a free port, started inside the test's event loop
+    import twitchio.websocket
+    from twitchio.http import TwitchHTTP
+    from twitchio.ext.pubsub.websocket import PubSubWebsocket
+
+    async def validate(self, *, token: str = None):
+        if not self.session:
+            self.session = aiohttp.ClientSession()
+        self.nick = "test"
+        return {"login": "test", "user_id": "1", "client_id": "test", "scopes": []}
+
+    async def start():
+        fake = FakeTwitch()
+        app = web.Application()
+        app.router.add_get("/irc", fake.handle_irc)
+        app.router.add_get("/pubsub", fake.handle_pubsub)
+        fake.runner = web.AppRunner(app)
+        await fake.runner.setup()
+        site = web.TCPSite(fake.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        monkeypatch.setattr(twitchio.websocket, "HOST", f"ws://127.0.0.1:{port}/irc")
+        monkeypatch.setattr(PubSubWebsocket, "ENDPOINT", f"ws://127.0.0.1:{port}/pubsub")
+        return fake
+
+    monkeypatch.setattr(TwitchHTTP, "validate", validate)
+    return start
+
+class FakeLink():
+    # In-process stand-in for the fastsocket Client, wired straight to the Service handlers.
+    # cut() kills it like a dropped TCP connection: sends fail and nothing arrives.
+    def __init__(self, service: Service) -> None:
+        self._service = service
+        self._handlers = {}
+        self.cut_at = None
+
+    def cut(self):
+        self.cut_at = time.perf_counter()
+
+    def on_message(self, code: str, handler):
+        self._handlers[code] = handler
+
+    async def connect(self):
+        pass
+
+    async def disconnect(self):
+        self.cut()
+
+    async def send_msg(self, msg: Message, blocking=False):
+        if self.cut_at is not None:
+            raise ConnectionError("link is down")
+        msg = Message.from_json(msg.to_json())
+        asyncio.create_task(self._service._handlers[msg.code](msg, self))
+
+    # Server side of the link
+    async def send(self, frame: str):
+        if self.cut_at is not None:
+            raise ConnectionClosed(None, None)
+        msg = Message.from_json(frame)
+        handler = self._handlers.get(msg.code)
+        if handler is not None:
+            asyncio.create_task(handler(msg))
+
+    async def close(self):
+        self.cut()
+
+async def wait_for(condition, timeout: float) -> bool:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if await condition():
+            return True
+        await asyncio.sleep(0.02)
+    return False
+
+def test_twitch_outage_is_recovered_with_a_gap(config, fake_twitch):
+    async def run():
+        fake = await fake_twitch()
+        api = API(APIConfig("token", 1, "test", config), log_level=logging.WARNING)
+        await api.start()
+        await api.set_channels(["one", "two"])
+        supervisor = APISupervisor(
+            {"test": api},
+            interval=config.health_interval,
+            unhealthy_checks=config.health_unhealthy_checks,
+            backoff_cap=config.health_backoff_cap,
+            log_level=logging.WARNING
+        )
+        supervisor.start()
+        sent = 0
+
+        async def chat_flows() -> bool:
+            # Every channel has to deliver again, not just the connection
+            nonlocal sent
+            before = api.get_buffer_stats()
+            for channel in ("one", "two"):
+                sent += 1
+                await fake.chat(channel, sent)
+            await asyncio.sleep(0.05)
+            after = api.get_buffer_stats()
+            return all(
+                after.get(f"chat:{channel}", {"size": 0})["size"] > before.get(f"chat:{channel}", {"size": 0})["size"]
+                for channel in ("one", "two")
+            )
+
+        try:
+            assert await wait_for(chat_flows, 5)
+            fake.down = True
+            await fake.drop()
+            await asyncio.sleep(0.5)
+            fake.down = False
+            assert await wait_for(chat_flows, 15)
+            assert len(api.gaps) == 1
+            gap = api.gaps[0]
+            assert gap["reason"] == "twitch_reconnect"
+            assert gap["until"] - gap["since"] >= 0.3
+        finally:
+            await supervisor.stop()
+            await api.close()
+            await fake.drop()
+            await fake.runner.cleanup()
+
+    asyncio.run(run())
+
+async def start_linked_client(config: ServerConfig):
+    service = Service(config, log_level=logging.ERROR)
+    for dispatcher in service._dispatchers.values():
+        dispatcher.start()
+    api = SyntheticAPI(APIConfig("token", 1, "test", config), log_level=logging.WARNING)
+    await api.start()
+    service.add_api(api)
+
+    links = []
+
+    def factory(url, log_level):
+        links.append(FakeLink(service))
+        return links[-1]
+
+    client = TwitchClient("ws://fake", log_level=logging.ERROR, client_factory=factory, health_interval=0.1, backoff_base=0.05)
+    await client.connect("test", "token", ["test"])
+    return service, api, client, links
+
+async def stop_linked_client(service: Service, client: TwitchClient):
+    await client.disconnect()
+    for dispatcher in service._dispatchers.values():
+        await dispatcher.stop()
+    for key in list(service._apis):
+        await service._close_api(key)
+
+def test_link_drop_resumes_without_losing_events(config):
+    async def run():
+        service, api, client, links = await start_linked_client(config)
+        try:
+            api.handle_chat_message(fake_chat_message(0, "test"))
+            assert await wait_for(lambda: asyncio.sleep(0, len(client.chat_messages) == 1), 2)
+
+            links[-1].cut()
+            # The server keeps buffering while the client is away
+            for i in range(1, 6):
+                api.handle_chat_message(fake_chat_message(i, "test"))
+            assert await wait_for(lambda: asyncio.sleep(0, client.reconnects == 1), 5)
+            assert await wait_for(lambda: asyncio.sleep(0, len(client.chat_messages) == 6), 2)
+
+            assert client.resumed
+            assert client.last_missed == 0
+            assert not client.gaps
+            uuids = [msg["uuid"] for msg in client.chat_messages.get_all()]
+            assert uuids == sorted(set(uuids))
+        finally:
+            await stop_linked_client(service, client)
+
+    asyncio.run(run())
+
+def test_lost_server_session_is_set_up_again_and_flagged(config):
+    async def run():
+        service, api, client, links = await start_linked_client(config)
+        try:
+            await client.set_filter(block_keywords=["spam"])
+            api.handle_chat_message(fake_chat_message(0, "test"))
+            assert await wait_for(lambda: asyncio.sleep(0, len(client.chat_messages) == 1), 2)
+
+            # The server restarts: the link drops and the session is new
+            links[-1].cut()
+            await service._close_api("test")
+            fresh = SyntheticAPI(APIConfig("token", 1, "test", config), log_level=logging.WARNING)
+            await fresh.start()
+            service.add_api(fresh)
+
+            assert await wait_for(lambda: asyncio.sleep(0, client.reconnects == 1), 5)
+            assert not client.resumed
+            assert len(client.gaps) == 1
+            # Channels and filter set through the client are sent to the new session
+            assert fresh.get_conncted_channels() == ["test"]
+            assert fresh.get_pipeline() is not None
+
+            fresh.handle_chat_message(fake_chat_message(1, "test"))
+            assert await wait_for(lambda: asyncio.sleep(0, len(client.chat_messages) == 2), 2)
+        finally:
+            await stop_linked_client(service, client)
+
+    asyncio.run(run())
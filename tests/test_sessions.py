@@ -0,0 +1,53 @@
+import json
+import asyncio
+import logging
+
+import pytest
+
+from ai_streamer_twitch.config import ServerConfig
+from ai_streamer_twitch.service import Service
+from fastsocket import Message
+
+CONFIG = """
+[ws]
+port = 8000
+host = "127.0.0.1"
+
+[twitch]
+secret = ""
+id = ""
+update_delay = 1
+
+[buffers]
+chat = 100
+sub = 100
+cheer = 100
+"""
+
+class FakeWS():
+    def __init__(self) -> None:
+        self.frames = []
+
+    async def send(self, frame: str):
+        self.frames.append(json.loads(frame))
+
+@pytest.mark.parametrize("data", [
+    {"token": "token"},
+    {"token": "token", "user_name": 12345},
+    {"token": "token", "user_name": ["test"]},
+    {"token": "token", "user_name": None},
+    {"token": "token", "user_name": "not a login"},
+])
+def test_start_without_a_login_name_is_refused(tmp_path, data):
+    async def run():
+        path = tmp_path / "config.toml"
+        path.write_text(CONFIG)
+        service = Service(ServerConfig(path), log_level=logging.CRITICAL)
+        ws = FakeWS()
+
+        await service.start_twitch_api(Message(uuid=1, code="StartTwitchAPI", data=data), ws)
+        assert [frame["code"] for frame in ws.frames] == ["ErrorTwitch"]
+        assert not service._apis
+        assert not service._starting
+
+    asyncio.run(run())